@@ -0,0 +1,133 @@
+'''
+Measures the memory held by the cached Gitlab directory for a 10k user, 2k group
+instance, as python-gitlab objects and as the compact records the caches now keep.
+
+The users and groups are generated with the full set of attributes the Gitlab
+API returns. If python-gitlab is installed they are wrapped in RESTObjects, as
+gl.users.list() would return them; otherwise only the attribute dicts are
+measured, which understates the RESTObjects.
+
+Run from the standalone directory:
+    python -m benchmarks.bench_directory_memory
+'''
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from shared.gitlab_directory import UserDirectory, GroupHierarchy
+from shared.gitlab_records import UserRecord, GroupRecord
+
+try:
+    import gitlab
+except ImportError:
+    gitlab = None
+
+
+def user_payload(user_id, rng):
+    username = f'user{user_id}'
+    return {
+        'id': user_id, 'username': username, 'name': f'User {user_id}', 'state': 'active',
+        'locked': False, 'avatar_url': f'https://gitlab.example.com/uploads/-/system/user/avatar/{user_id}/avatar.png',
+        'web_url': f'https://gitlab.example.com/{username}', 'created_at': '2020-01-01T00:00:00.000Z',
+        'bio': '', 'location': '', 'public_email': None, 'skype': '', 'linkedin': '', 'twitter': '',
+        'discord': '', 'website_url': '', 'organization': '', 'job_title': '', 'pronouns': None,
+        'bot': False, 'work_information': None, 'followers': 0, 'following': 0, 'local_time': None,
+        'last_sign_in_at': '2023-06-01T00:00:00.000Z', 'confirmed_at': '2020-01-01T00:00:00.000Z',
+        'last_activity_on': '2023-06-01', 'email': f'{username}@example.com', 'theme_id': 1,
+        'color_scheme_id': 1, 'projects_limit': 100000, 'current_sign_in_at': '2023-06-01T00:00:00.000Z',
+        'identities': [], 'can_create_group': True, 'can_create_project': True,
+        'two_factor_enabled': rng.random() < 0.5, 'external': False, 'private_profile': False,
+        'commit_email': f'{username}@example.com', 'is_admin': rng.random() < 0.01,
+        'note': None, 'namespace_id': user_id, 'created_by': None,
+    }
+
+
+def group_payload(group_id, parent_id, full_path):
+    return {
+        'id': group_id, 'web_url': f'https://gitlab.example.com/groups/{full_path}',
+        'name': full_path.rsplit('/', 1)[-1], 'path': full_path.rsplit('/', 1)[-1], 'description': '',
+        'visibility': 'private', 'share_with_group_lock': False, 'require_two_factor_authentication': False,
+        'two_factor_grace_period': 48, 'project_creation_level': 'developer', 'auto_devops_enabled': None,
+        'subgroup_creation_level': 'maintainer', 'emails_disabled': None, 'mentions_disabled': None,
+        'lfs_enabled': True, 'default_branch_protection': 2, 'avatar_url': None, 'request_access_enabled': True,
+        'full_name': full_path.replace('/', ' / '), 'full_path': full_path, 'created_at': '2020-01-01T00:00:00.000Z',
+        'parent_id': parent_id, 'ldap_cn': None, 'ldap_access': None,
+        'wiki_access_level': 'enabled', 'marked_for_deletion_on': None,
+    }
+
+
+def generate(users, groups, seed=1):
+    rng = random.Random(seed)
+    # round trip through json, so the strings are separate objects as if parsed from responses
+    user_payloads = json.loads(json.dumps([user_payload(i, rng) for i in range(1, users + 1)]))
+    paths = {1: 'top'}
+    group_payloads = [group_payload(1, None, 'top')]
+    for group_id in range(2, groups + 1):
+        parent_id = max(1, (group_id - 2) // 6 + 1)
+        paths[group_id] = f'{paths[parent_id]}/group-{group_id}'
+        group_payloads.append(group_payload(group_id, parent_id, paths[group_id]))
+    return user_payloads, json.loads(json.dumps(group_payloads))
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=2000)
+    args = parser.parse_args()
+
+    if gitlab is not None:
+        gl = gitlab.Gitlab('https://gitlab.example.com')
+
+        def full_users(payloads):
+            return UserDirectory(gitlab.v4.objects.User(gl.users, attrs) for attrs in payloads)
+
+        def full_groups(payloads):
+            return GroupHierarchy(gitlab.v4.objects.Group(gl.groups, attrs) for attrs in payloads)
+        label = 'RESTObject'
+    else:
+        from types import SimpleNamespace
+
+        def full_users(payloads):
+            return UserDirectory(SimpleNamespace(**attrs) for attrs in payloads)
+
+        def full_groups(payloads):
+            return GroupHierarchy(SimpleNamespace(**attrs) for attrs in payloads)
+        label = 'attributes'
+
+    def build_records():
+        user_payloads, group_payloads = generate(args.users, args.groups)
+        return (UserDirectory(UserRecord.from_attributes(attrs) for attrs in user_payloads),
+                GroupHierarchy(GroupRecord.from_attributes(attrs) for attrs in group_payloads))
+
+    def build_full():
+        user_payloads, group_payloads = generate(args.users, args.groups)
+        return full_users(user_payloads), full_groups(group_payloads)
+
+    results = {}
+    for name, build in ((label, build_full), ('records', build_records)):
+        # only what the directory keeps is counted, the listing is released once it's built
+        (users, groups), size = measure(build)
+        results[name] = size
+        print(f'{name:>10}: {len(users)} users, {len(groups)} groups, {size / 2 ** 20:.1f} MiB')
+        del users, groups
+
+    if gitlab is None:
+        print('python-gitlab is not installed, so the full directory is measured as plain attribute objects')
+    print(f'records use {100 * results["records"] / results[label]:.0f}% of the memory')
+
+
+if __name__ == '__main__':
+    main()
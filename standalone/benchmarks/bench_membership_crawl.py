@@ -0,0 +1,96 @@
+'''
+Compares resolving distribution lists against a fake Gitlab with thousands of groups:
+
+- per_expansion: every expansion lists the members of the group and all of its
+  subgroups, as each inbound message used to
+- crawl: one members listing per group per cache generation (GroupMembership.crawl),
+  with every expansion and authorization check then resolved locally
+
+Run from the standalone directory:
+    python -m benchmarks.bench_membership_crawl
+'''
+import argparse
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from shared.gitlab_directory import GroupHierarchy, GroupMembership
+
+
+class FakeGitlab:
+    '''
+    A groups tree with random members, where each members listing costs latency_ms
+    '''
+    def __init__(self, groups=3000, users=10000, members_per_group=15, fanout=6, latency_ms=2.0, seed=1):
+        rng = random.Random(seed)
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.groups = [SimpleNamespace(id=1, parent_id=None)]
+        for group_id in range(2, groups + 1):
+            # a roughly balanced tree with the given fanout
+            self.groups.append(SimpleNamespace(id=group_id, parent_id=max(1, (group_id - 2) // fanout + 1)))
+        self.members = {
+            g.id: [SimpleNamespace(id=user_id, access_level=rng.choice((10, 20, 30, 40, 50)))
+                   for user_id in rng.sample(range(1, users + 1), members_per_group)]
+            for g in self.groups
+        }
+
+    def list_members(self, group_id):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return self.members[group_id]
+
+
+def per_expansion(gitlab, hierarchy, targets):
+    '''
+    The previous behaviour: nothing is kept between messages
+    '''
+    for group_id in targets:
+        recipients = set()
+        for g in (group_id,) + hierarchy.descendant_ids(group_id):
+            recipients.update(m.id for m in gitlab.list_members(g))
+        senders = set()
+        for g in (group_id,) + hierarchy.ancestor_ids(group_id):
+            senders.update(m.id for m in gitlab.list_members(g))
+
+
+def crawl(gitlab, hierarchy, targets, workers):
+    membership = GroupMembership(gitlab.list_members, lambda: hierarchy)
+    membership.crawl(max_workers=workers)
+    for group_id in targets:
+        membership.members(group_id)
+        membership.members_with_ancestors(group_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=3000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--expansions', type=int, default=1000,
+                        help='distribution lists resolved (e.g. one per inbound message)')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='simulated latency per members listing')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent requests during the crawl')
+    args = parser.parse_args()
+
+    gitlab = FakeGitlab(groups=args.groups, users=args.users, latency_ms=args.latency_ms)
+    hierarchy = GroupHierarchy(gitlab.groups)
+    rng = random.Random(2)
+    # skew towards the upper levels of the tree, like real distribution lists
+    targets = [min(rng.randint(1, args.groups), rng.randint(1, args.groups)) for i in range(args.expansions)]
+
+    print(f'{args.groups} groups, {args.users} users, {args.expansions} expansions, ' +
+          f'{args.latency_ms}ms per members listing')
+    for name, run in (('per_expansion', lambda: per_expansion(gitlab, hierarchy, targets)),
+                      ('crawl', lambda: crawl(gitlab, hierarchy, targets, args.workers))):
+        gitlab.calls = 0
+        start = time.monotonic()
+        run()
+        elapsed = time.monotonic() - start
+        print(f'{name:>14}: {gitlab.calls:7d} members listings {elapsed:8.2f}s')
+
+
+if __name__ == '__main__':
+    main()
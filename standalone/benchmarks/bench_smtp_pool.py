@@ -0,0 +1,144 @@
+'''
+Compares sending through a new relay connection per message (as send_smtp used to)
+with sending through SMTPConnectionPool, against a local aiosmtpd sink.
+
+The sink uses implicit TLS (like the SMTP_SSL relay) with a throwaway self signed
+certificate from openssl, and requires AUTH LOGIN, so each new connection pays for
+the TLS handshake, EHLO and LOGIN.
+
+Run from the standalone directory:
+    python -m benchmarks.bench_smtp_pool
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+import logging
+import os
+import smtplib
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from shared.smtp_pool import SMTPConnectionPool
+
+
+class Sink:
+    def __init__(self):
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        with self.lock:
+            self.messages += 1
+        return '250 OK'
+
+
+def authenticator(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def client_factory(tls):
+    if not tls:
+        return smtplib.SMTP
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    def factory(host, port, timeout=60):
+        return smtplib.SMTP_SSL(host, port, timeout=timeout, context=context)
+    return factory
+
+
+def send_unpooled(factory, port, message, recipients):
+    # what send_smtp did for every call
+    server = factory('127.0.0.1', port, timeout=60)
+    server.ehlo()
+    server.login('user', 'password')
+    server.sendmail('sender@example.com', recipients, message)
+    server.quit()
+
+
+def run(name, send, messages, threads):
+    start = time.monotonic()
+    if threads == 1:
+        for i in range(messages):
+            send()
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            for future in [executor.submit(send) for i in range(messages)]:
+                future.result()
+    elapsed = time.monotonic() - start
+    print(f'{name:>24}: {messages} messages in {elapsed:.2f}s, {messages / elapsed:.0f} messages/sec')
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--recipients', type=int, default=45)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--no-tls', dest='tls', action='store_false')
+    args = parser.parse_args()
+    # aiosmtpd logs a deprecation warning about its own authenticator API on every login
+    logging.getLogger('mail.log').setLevel(logging.ERROR)
+
+    message = MIMEText('Benchmark body\n' * 200)
+    message['Subject'] = 'Benchmark'
+    message['From'] = 'sender@example.com'
+    message = message.as_string()
+    recipients = [f'user{i}@example.net' for i in range(args.recipients)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        ssl_context = None
+        if args.tls:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(*make_certificate(directory))
+        sink = Sink()
+        controller = Controller(sink, hostname='127.0.0.1', port=free_port(),
+                                ssl_context=ssl_context, authenticator=authenticator,
+                                auth_require_tls=False, auth_exclude_mechanism=['CRAM-MD5'])
+        controller.start()
+        try:
+            factory = client_factory(args.tls)
+            port = controller.port
+            print(f'{args.recipients} recipients per message, tls={args.tls}')
+
+            for threads in sorted({1, args.threads}):
+                unpooled = run(f'new connection x{threads}',
+                               lambda: send_unpooled(factory, port, message, recipients),
+                               args.messages, threads)
+                pool = SMTPConnectionPool('127.0.0.1', port, 'user', 'password', max_size=threads,
+                                          connection_factory=factory)
+                pooled = run(f'pooled x{threads}',
+                             lambda: pool.sendmail('sender@example.com', recipients, message),
+                             args.messages, threads)
+                pool.close_all()
+                print(f'{"":>24}  {pooled / unpooled:.1f}x, {pool.stats()}')
+        finally:
+            controller.stop()
+        print(f'sink received {sink.messages} messages')
+
+
+if __name__ == '__main__':
+    main()
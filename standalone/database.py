@@ -1,5 +1,8 @@
 # import sqlite3
-from typing import Sequence, List, Dict, TypedDict
+import ast
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Sequence, List, Dict, Tuple, TypedDict
 import aiosqlite
 import logging
 import shared.constants as constants
@@ -9,13 +12,48 @@ class MeetingRecord(TypedDict):
     uuid: str
     meeting_title: str
     email_from: str
-    email: str
+    # the message as received
+    email: bytes
     recurr: bool
     end_date: str
     groups: List[str]
     ics_file_data: str
 
 
+# delivery states of an outbound_recipients row
+OUTBOUND_PENDING = 'pending'
+OUTBOUND_SENDING = 'sending'
+OUTBOUND_SENT = 'sent'
+OUTBOUND_REFUSED = 'refused'
+OUTBOUND_FAILED = 'failed'
+# not sent, because the meeting changed and the current invite is sent instead
+OUTBOUND_SUPERSEDED = 'superseded'
+
+
+class OutboundChunk(TypedDict):
+    message_id: int
+    sender: str
+    email: bytes
+    recipients: List[str]
+
+
+def email_bytes(email: str | bytes | None) -> bytes:
+    '''
+    A stored message as bytes. Older rows of the meetings table hold text: either the
+    message as a string, or the repr of its bytes (b'...').
+    '''
+    if email is None:
+        return b''
+    if isinstance(email, bytes):
+        return email
+    if len(email) >= 3 and email[0] == 'b' and email[1] in '\'"' and email[-1] == email[1]:
+        try:
+            return ast.literal_eval(email)
+        except (ValueError, SyntaxError):
+            return email[2:-1].encode().decode('unicode_escape').encode()
+    return email.encode('utf-8', errors='surrogateescape')
+
+
 class TLDatabase:
     _instance = None
     db_path = None
@@ -27,9 +65,28 @@ class TLDatabase:
         return cls._instance
 
     async def initialize(self):
+        # taken by every write, see transaction()
+        self.write_lock = asyncio.Lock()
         self.conn = await aiosqlite.connect(self.db_path)
         await self._create_tables()
 
+    @asynccontextmanager
+    async def transaction(self):
+        '''
+        Runs the statements in the block as one transaction, committed at the end of the
+        block or rolled back if it raises.
+        The connection is shared by every coroutine, so all writes go through here: otherwise
+        another coroutine's commit would commit a transaction part way through.
+        '''
+        async with self.write_lock:
+            await self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+
     async def _create_tables(self):
         # cursor = self.conn.cursor()
         await self.conn.execute('''
@@ -37,7 +94,7 @@ class TLDatabase:
             uuid TEXT PRIMARY KEY,
             meeting_title TEXT,
             email_from TEXT,
-            email TEXT,
+            email BLOB,
             recurr BOOLEAN,
             end_date TEXT,
             groups TEXT,
@@ -71,9 +128,40 @@ class TLDatabase:
         )
         ''')
 
+        # messages waiting to go out through the relay (the outbound spool)
+        await self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            email BLOB,
+            meeting_uuid TEXT,
+            completed_at TIMESTAMP DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT NULL,
+            updated_at TIMESTAMP DEFAULT NULL
+        )
+        ''')
+
+        # delivery state of each recipient of an outbound message
+        await self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_recipients (
+            message_id INTEGER,
+            email_address TEXT,
+            state TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT NULL,
+            updated_at TIMESTAMP DEFAULT NULL,
+            FOREIGN KEY (message_id) REFERENCES outbound_messages (id) ON DELETE CASCADE,
+            PRIMARY KEY (message_id, email_address)
+        )
+        ''')
+        await self.conn.execute('''
+        CREATE INDEX IF NOT EXISTS outbound_recipients_due ON outbound_recipients (state, next_attempt_at)
+        ''')
 
         # update tables to latest version
-        for table in ['meetings', 'meeting_groups', 'meeting_invites']:
+        for table in ['meetings', 'meeting_groups', 'meeting_invites', 'outbound_messages', 'outbound_recipients']:
             await self.conn.execute(f'''
 CREATE TRIGGER IF NOT EXISTS insert_timestamp_trigger_{table}
 AFTER INSERT 
@@ -115,29 +203,60 @@ ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP DEFAULT NULL;
 
     async def meetings_insert_record(self, record):
         # cursor = self.conn.cursor()
-        await self.conn.execute('''
+        async with self.transaction():
+            await self.conn.execute('''
 INSERT OR REPLACE INTO meetings
 (uuid, meeting_title, email_from, email, recurr, end_date, groups, ics_file_data)
 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (record['uuid'], record['meeting_title'], record['email_from'],
-              record['email'], record['recurr'], record['end_date'],
-              ','.join(record['groups']), record['ics_file_data']))
-        await self.conn.commit()
+            ''', (record['uuid'], record['meeting_title'], record['email_from'],
+                  record['email'], record['recurr'], record['end_date'],
+                  ','.join(record['groups']), record['ics_file_data']))
 
     async def meetings_delete_record(self, uuid):
-        await self.conn.execute('DELETE FROM meetings WHERE uuid = ?', (uuid,))
-        await self.conn.commit()
+        async with self.transaction():
+            await self.conn.execute('DELETE FROM meetings WHERE uuid = ?', (uuid,))
+            await self._outbound_supersede(uuid)
 
     async def meetings_invites_delete(self, uuid):
-        await self.conn.execute('DELETE FROM meeting_invites WHERE uuid = ?', (uuid,))
-        await self.conn.commit()
+        '''
+        Clears the invites of a meeting, so everyone is sent its current invite again
+        '''
+        async with self.transaction():
+            await self.conn.execute('DELETE FROM meeting_invites WHERE uuid = ?', (uuid,))
+            await self._outbound_supersede(uuid)
+
+    async def _outbound_supersede(self, uuid):
+        # copies of the meeting's invite still in the spool are out of date: recipients not
+        # yet sent to are dropped, and recipients being sent to aren't recorded as invited
+        await self.conn.execute(f'''
+            UPDATE outbound_recipients SET state = '{OUTBOUND_SUPERSEDED}'
+            WHERE state = '{OUTBOUND_PENDING}' AND message_id IN (
+                SELECT id FROM outbound_messages WHERE meeting_uuid = ? AND completed_at IS NULL)''', (uuid,))
+        await self.conn.execute(f'''
+            UPDATE outbound_messages SET meeting_uuid = NULL,
+                completed_at = CASE WHEN EXISTS (
+                    SELECT 1 FROM outbound_recipients
+                    WHERE message_id = outbound_messages.id AND state = '{OUTBOUND_SENDING}')
+                THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE meeting_uuid = ? AND completed_at IS NULL''', (uuid,))
 
     async def meetings_invites_set(self, uuid, email_addresses: Sequence[str]):
-        for e in email_addresses:
-            await self.conn.execute('''
-                INSERT OR REPLACE INTO meeting_invites (uuid, email_address)
-                VALUES (?, ?)''', (uuid, e))
-            await self.conn.commit()
+        await self.meetings_invites_set_many({uuid: email_addresses})
+
+    async def meetings_invites_set_many(self, invites: Dict[str, Sequence[str]]):
+        '''
+        Records the invites of several meetings (uuid -> email addresses) in one transaction
+        '''
+        async with self.transaction():
+            await self._insert_invites(invites)
+
+    async def _insert_invites(self, invites: Dict[str, Sequence[str]]):
+        # invites for a meeting that has since been deleted are skipped
+        await self.conn.executemany(
+            '''
+            INSERT OR REPLACE INTO meeting_invites (uuid, email_address)
+            SELECT ?, ? WHERE EXISTS (SELECT 1 FROM meetings WHERE uuid = ?)''',
+            [(uuid, e, uuid) for uuid, email_addresses in invites.items() for e in email_addresses])
     """
     async def meetings_invites_get(self, uuid: str) -> List[str]:
         cursor = await self.conn.execute('''
@@ -171,7 +290,7 @@ VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         records = await cursor.fetchall()
         return [
             {'uuid': r[0], 'meeting_title': r[1], 'email_from': r[2],
-                'email': r[3], 'recurr': r[4], 'end_date': r[5],
+                'email': email_bytes(r[3]), 'recurr': r[4], 'end_date': r[5],
                 'groups': r[6].split(','), 'ics_file_data': r[7]}
             for r in records]
     
@@ -180,10 +299,191 @@ VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         records = await cursor.fetchall()
         return [
             {'uuid': r[0], 'meeting_title': r[1], 'email_from': r[2],
-                'email': r[3], 'recurr': r[4], 'end_date': r[5],
+                'email': email_bytes(r[3]), 'recurr': r[4], 'end_date': r[5],
                 'groups': r[6].split(','), 'ics_file_data': r[7]}
             for r in records]
 
+    async def outbound_enqueue(self, sender: str, email: bytes, recipients: Sequence[str],
+                               meeting_uuid: str = None) -> int:
+        '''
+        Adds a message to the outbound spool, with every recipient pending. Returns its id.
+        '''
+        return (await self.outbound_enqueue_many([(sender, email, recipients, meeting_uuid)]))[0]
+
+    async def outbound_enqueue_many(self,
+                                    messages: Sequence[Tuple[str, bytes, Sequence[str], str | None]]) -> List[int]:
+        '''
+        Adds (sender, email, recipients, meeting_uuid) messages to the outbound spool in one
+        transaction, with every recipient pending. Returns their ids.
+        '''
+        message_ids = []
+        async with self.transaction():
+            for sender, email, recipients, meeting_uuid in messages:
+                cursor = await self.conn.execute('''
+                    INSERT INTO outbound_messages (sender, email, meeting_uuid)
+                    VALUES (?, ?, ?)''', (sender, email, meeting_uuid))
+                message_id = cursor.lastrowid
+                await self.conn.executemany(f'''
+                    INSERT OR IGNORE INTO outbound_recipients (message_id, email_address, state)
+                    VALUES (?, ?, '{OUTBOUND_PENDING}')''', [(message_id, e) for e in recipients])
+                message_ids.append(message_id)
+        return message_ids
+
+    async def outbound_reset_sending(self):
+        '''
+        Makes recipients that were being sent to when the process stopped pending again
+        '''
+        async with self.transaction():
+            await self.conn.execute(f'''
+                UPDATE outbound_recipients SET state = '{OUTBOUND_PENDING}'
+                WHERE state = '{OUTBOUND_SENDING}'
+                ''')
+
+    async def outbound_claim(self, now: float, max_recipients: int) -> List[OutboundChunk]:
+        '''
+        Marks up to max_recipients recipients that are due (at time.time() now) as being sent,
+        and returns them with their messages, one chunk per message.
+        A large message fills the whole chunk; small ones are claimed together.
+        '''
+        async with self.transaction():
+            cursor = await self.conn.execute(f'''
+                SELECT message_id, email_address FROM outbound_recipients
+                WHERE state = '{OUTBOUND_PENDING}' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, message_id, rowid LIMIT ?''', (now, max_recipients))
+            recipients: Dict[int, List[str]] = {}
+            for message_id, email_address in await cursor.fetchall():
+                recipients.setdefault(message_id, []).append(email_address)
+            if len(recipients) == 0:
+                return []
+            await self.conn.executemany(
+                f'''
+                UPDATE outbound_recipients SET state = '{OUTBOUND_SENDING}'
+                WHERE message_id = ? AND email_address = ?''',
+                [(message_id, e) for message_id, emails in recipients.items() for e in emails])
+            placeholders = ','.join('?' for message_id in recipients)
+            cursor = await self.conn.execute(f'''
+                SELECT id, sender, email FROM outbound_messages
+                WHERE id IN ({placeholders})''', list(recipients))
+            messages = {record[0]: record for record in await cursor.fetchall()}
+        return [{'message_id': message_id, 'sender': messages[message_id][1], 'email': messages[message_id][2],
+                 'recipients': emails}
+                for message_id, emails in recipients.items()]
+
+    async def outbound_record(self, results: Sequence[Tuple[int, Sequence[str], Dict[str, str], Dict[str, str]]],
+                              now: float, retry_seconds: float, max_retry_seconds: float, max_attempts: int) -> set:
+        '''
+        Records, in one transaction, the results of sending to claimed recipients, as
+        (message_id, delivered, refused, retry) with refused for good and to retry mapping
+        each address to the error. Recipients delivered a meeting's invite are added to its
+        invites, unless the meeting has changed since the message was spooled.
+        Retries back off exponentially from retry_seconds up to max_retry_seconds, and fail
+        after max_attempts.
+        Returns the ids of the messages every recipient of which has now been dealt with.
+        '''
+        async with self.transaction():
+            for message_id, delivered, refused, retry in results:
+                await self.conn.executemany(f'''
+                    UPDATE outbound_recipients SET state = '{OUTBOUND_SENT}', attempts = attempts + 1, last_error = NULL
+                    WHERE message_id = ? AND email_address = ?''', [(message_id, e) for e in delivered])
+                await self.conn.executemany(
+                    f'''
+                    UPDATE outbound_recipients SET state = '{OUTBOUND_REFUSED}', attempts = attempts + 1, last_error = ?
+                    WHERE message_id = ? AND email_address = ?''',
+                    [(error, message_id, e) for e, error in refused.items()])
+                await self.conn.executemany(
+                    f'''
+                    UPDATE outbound_recipients
+                    SET state = CASE WHEN attempts + 1 >= ? THEN '{OUTBOUND_FAILED}' ELSE '{OUTBOUND_PENDING}' END,
+                        attempts = attempts + 1,
+                        next_attempt_at = ? + MIN(?, ? * (1 << attempts)),
+                        last_error = ?
+                    WHERE message_id = ? AND email_address = ?''',
+                    [(max_attempts, now, max_retry_seconds, retry_seconds, error, message_id, e)
+                     for e, error in retry.items()])
+                # meeting_uuid is cleared when the meeting changes, see _outbound_supersede
+                await self.conn.executemany(
+                    '''
+                    INSERT OR REPLACE INTO meeting_invites (uuid, email_address)
+                    SELECT meeting_uuid, ? FROM outbound_messages m
+                    WHERE id = ? AND EXISTS (SELECT 1 FROM meetings WHERE uuid = m.meeting_uuid)''',
+                    [(e, message_id) for e in delivered])
+
+            done = set()
+            for message_id in {result[0] for result in results}:
+                cursor = await self.conn.execute(f'''
+                    SELECT COUNT(*) FROM outbound_recipients
+                    WHERE message_id = ? AND state IN ('{OUTBOUND_PENDING}', '{OUTBOUND_SENDING}')''', (message_id,))
+                if (await cursor.fetchone())[0] == 0:
+                    done.add(message_id)
+            await self.conn.executemany('UPDATE outbound_messages SET completed_at = CURRENT_TIMESTAMP WHERE id = ?',
+                                        [(message_id,) for message_id in done])
+        return done
+
+    async def outbound_next_attempt(self) -> float | None:
+        '''
+        The time.time() at which the next pending recipient is due, or None
+        '''
+        cursor = await self.conn.execute(f'''
+            SELECT MIN(next_attempt_at) FROM outbound_recipients WHERE state = '{OUTBOUND_PENDING}'
+            ''')
+        return (await cursor.fetchone())[0]
+
+    async def outbound_done(self, message_id: int) -> bool:
+        cursor = await self.conn.execute('SELECT completed_at IS NOT NULL FROM outbound_messages WHERE id = ?',
+                                         (message_id,))
+        record = await cursor.fetchone()
+        return record is None or bool(record[0])
+
+    async def outbound_delivered(self, message_id: int) -> set:
+        cursor = await self.conn.execute(f'''
+            SELECT email_address FROM outbound_recipients
+            WHERE message_id = ? AND state = '{OUTBOUND_SENT}'
+            ''', (message_id,))
+        return {record[0] for record in await cursor.fetchall()}
+
+    async def outbound_queued(self, meeting_uuids: List[str]) -> Dict[str, set]:
+        '''
+        The recipients of each meeting's invite that are still waiting in the spool
+        '''
+        placeholders = ','.join('?' for uuid in meeting_uuids)
+        cursor = await self.conn.execute(f'''
+            SELECT m.meeting_uuid, r.email_address
+            FROM outbound_recipients r JOIN outbound_messages m ON m.id = r.message_id
+            WHERE m.meeting_uuid IN ({placeholders})
+            AND r.state IN ('{OUTBOUND_PENDING}', '{OUTBOUND_SENDING}')''', meeting_uuids)
+        queued: Dict[str, set] = {uuid: set() for uuid in meeting_uuids}
+        for uuid, email_address in await cursor.fetchall():
+            queued[uuid].add(email_address)
+        return queued
+
+    async def outbound_backlog(self, now: float) -> Dict[str, int | float | None]:
+        '''
+        The number of outbound recipients in each state, how many pending are due at now,
+        and the age in seconds of the oldest pending one
+        '''
+        backlog = {state: 0 for state in
+                   (OUTBOUND_PENDING, OUTBOUND_SENDING, OUTBOUND_SENT, OUTBOUND_REFUSED, OUTBOUND_FAILED,
+                    OUTBOUND_SUPERSEDED)}
+        cursor = await self.conn.execute('SELECT state, COUNT(*) FROM outbound_recipients GROUP BY state')
+        backlog.update({state: count for state, count in await cursor.fetchall()})
+        cursor = await self.conn.execute(f'''
+            SELECT SUM(next_attempt_at <= ?), (julianday('now') - julianday(MIN(created_at))) * 86400
+            FROM outbound_recipients WHERE state = '{OUTBOUND_PENDING}'
+            ''', (now,))
+        due, oldest = await cursor.fetchone()
+        backlog['due'] = due or 0
+        backlog['oldest_pending_seconds'] = None if oldest is None else round(oldest)
+        return backlog
+
+    async def outbound_purge(self, hours: float):
+        '''
+        Deletes messages whose delivery finished more than hours ago
+        '''
+        async with self.transaction():
+            await self.conn.execute('''
+                DELETE FROM outbound_messages
+                WHERE completed_at IS NOT NULL AND completed_at < datetime('now', ?)''', (f'-{hours} hours',))
+
     async def close(self):
         if not self.conn:
             return
@@ -10,10 +10,13 @@ import atexit
 import signal
 
 import shared.constants as constants
+import shared.gitlab_helpers as gitlab_helpers
+import shared.mail_utils as mail_utils
 from CustomHandler import CustomHandler
 from database import TLDatabase
 import webhooks
 from shared.actionQueueConsumer import consumer as actionQueueConsumer
+from shared.outbound_spool import outbound_spool
 
 if not constants.ENFORCE_SEC_CHECKS:
     constants.EXPLICIT_ALLOW_EMAILS.append('test@test.test')
@@ -84,12 +87,18 @@ async def main():
     actionQueue = asyncio.PriorityQueue()
     db = TLDatabase()
     await db.initialize()
+    # deliver anything left in the outbound spool, and everything sent from now on
+    await outbound_spool.start()
 
     if constants.DEBUG_MODE:
         logging.info('DEBUG_MODE ENABLED - No email will be sent')
     if constants.TEST_MODE:
         logging.info('TEST_MODE ENABLED - Emails will reflect back to the originator')
 
+    # Route mail from the last known Gitlab directory while it is refreshed in the background
+    if gitlab_helpers.load_snapshot():
+        gitlab_helpers.revalidate_caches()
+
     # webhook_runner = await webhooks.run(actionQueue, loop)
     webhook_thread = threading.Thread(target=webhooks.run, args=(actionQueue, loop))
     webhook_thread.start()
@@ -98,6 +107,9 @@ async def main():
 
     async def shutdown_coro():
         logging.warning('Shutting down...')
+        gitlab_helpers.save_snapshot()
+        await outbound_spool.stop()
+        mail_utils.close_smtp_pool()
         await db.close()
         logging.info('Database closed')
         # await webhook_runner.cleanup()
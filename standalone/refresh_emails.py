@@ -1,9 +1,13 @@
 import logging
+import time
+from email import policy
+from email.parser import BytesHeaderParser
 from icalendar import Calendar
 import traceback
-import shared.mail_utils as mail_utils
 import shared.gitlab_helpers as gitlab_helpers
 import shared.cal_helpers as cal_helpers
+import shared.constants as constants
+from shared.outbound_spool import outbound_spool
 from database import TLDatabase
 db = TLDatabase()
 
@@ -15,12 +19,15 @@ async def refresh_invite_emails(email_uuid=None, group_name=None):
     2. Refresh group membership against each calendar invite
     3. For all who do not have an invite
     3.1 Add to send send_to envelope
-    4. If send_to envelope has at least 1 entry, send the email
+    4. Spool every meeting with at least 1 entry in its send_to envelope together, so they're
+       sent in as few relay sessions as possible, and their invites recorded together
+    5. Report how many invites of each meeting were delivered
+
+    Returns the progress of each meeting that was sent: uuid -> {'meeting_title', 'invites', 'delivered'}
     '''
     try:
         logging.info('refresh_invite_emails...')
-        # flush caches
-        gitlab_helpers.flush_caches()
+        # Group membership is kept current by the member system hooks, so the caches aren't flushed here
 
         # Get all events/emails
         if email_uuid is not None:
@@ -31,47 +38,65 @@ async def refresh_invite_emails(email_uuid=None, group_name=None):
         uuids = [record["uuid"] for record in meetings]
 
         meeting_invites_sent = await db.meetings_invites_get(uuids)
+        # invites still waiting in the outbound spool aren't sent again
+        meeting_invites_queued = await db.outbound_queued(uuids)
 
+        # (meeting, new recipients, message) for each meeting with someone new to invite
+        planned = []
         for m in meetings:
             try:
-                # convert groups to group email addresses
-                groups=gitlab_helpers.groups_to_recipients(m['groups'], as_groups=True)
-                if len(groups['group_emails'])==0:
-                    logging.error(f'No valid group email addresses found for {m["meeting_title"]}')
-                    continue
-                message_data = gitlab_helpers.clean_email_message(m['email_from'], groups['group_emails'], m['email'])
-                m['email'] = message_data['message']
-                groups = message_data['recipients']
-
                 logging.info(f"Meeting: {m['meeting_title']}")
                 cal = Calendar.from_ical(m['ics_file_data'])
                 if cal_helpers.is_event_over(cal):
                     logging.warn(f'This meeting has past, it should be deleted')
                     logging.info(cal)
                     continue
-                # groups = m['groups']
+
+                # convert groups to group email addresses
+                groups = await gitlab_helpers.run_async(gitlab_helpers.groups_to_recipients, m['groups'],
+                                                        as_groups=True)
+                if len(groups['group_emails']) == 0:
+                    logging.error(f'No valid group email addresses found for {m["meeting_title"]}')
+                    continue
+                # the recipients only depend on the headers, so the message isn't parsed yet
+                headers = BytesHeaderParser(policy=policy.default).parsebytes(m['email'])
+                recipients = await gitlab_helpers.run_async(gitlab_helpers.message_recipients,
+                                                            m['email_from'], groups['group_emails'], headers)
 
                 invites_sent = set(meeting_invites_sent.get(m['uuid'], set()))
-                # get the members of the group
-                #group_members = gitlab_helpers.get_group_members(groups)
-                # invites_emails = set(group_members['emails'])
-                # groups = gitlab_helpers.groups_to_recipients(groups, True)
-                invites_emails = set(groups['send_to'])
+                invites_sent.update(meeting_invites_queued.get(m['uuid'], set()))
+                invites_emails = recipients['send_to']
 
                 # remove from send_to people that have already received it (in meetings_invites_sent)
-                # also, don't send to the originator
+                # also, don't send to the originator. send_to is a bitset, so this doesn't list every recipient
                 invites_emails = invites_emails-invites_sent - set([m['email_from']])
-                # add all to the table
-                # logging.info(f'{m} {invites_emails}')
                 if len(invites_emails) > 0:
                     logging.info(f'Send email {invites_emails}')
-                    mail_utils.send_smtp(m['email_from'], invites_emails, m['email'])
-                    # update database to indicate that the invites were sent
-                    await db.meetings_invites_set(m['uuid'], invites_emails)
+                    # only now is the whole message parsed, and handed on parsed so the footer doesn't parse it again
+                    message_data = await gitlab_helpers.run_async(gitlab_helpers.clean_email_message,
+                                                                  m['email_from'], groups['group_emails'], m['email'],
+                                                                  recipients=recipients)
+                    planned.append((m, invites_emails, message_data['message_content_object']))
             except Exception as e:
                 logging.error(e)
                 logging.exception(traceback.format_exc())
             finally:
                 logging.info(f"Meeting {m['meeting_title']}: Done")
+
+        if len(planned) == 0:
+            return {}
+        # the spool records each invite in the database once it's delivered
+        message_ids = await outbound_spool.enqueue_many([(m['email_from'], invites_emails, message, m['uuid'])
+                                                         for m, invites_emails, message in planned])
+        progress = {}
+        deadline = time.monotonic() + constants.SMTP_SPOOL_WAIT_SECONDS
+        for (m, invites_emails, message), message_id in zip(planned, message_ids):
+            delivered = set()
+            if message_id is not None:
+                delivered = await outbound_spool.wait(message_id, max(deadline - time.monotonic(), 0))
+            progress[m['uuid']] = {'meeting_title': m['meeting_title'], 'invites': len(invites_emails),
+                                   'delivered': len(delivered)}
+            logging.info(f"Meeting {m['meeting_title']}: {len(delivered)} of {len(invites_emails)} invites delivered")
+        return progress
     finally:
         logging.info('refresh_invite_emails Done')
@@ -6,7 +6,8 @@ import shared.constants as constants
 import shared.gitlab_helpers as gitlab_helpers
 import shared.gitlab_wiki_helpers as wiki
 
-from shared.mail_utils import get_attachments, send_smtp, mime_email_send
+from shared.mail_utils import get_attachments
+from shared.outbound_spool import mime_email_send, outbound_spool
 from email.utils import getaddresses
 import database
 
@@ -45,14 +46,17 @@ async def process_email(eventinfo: dict):
         mail_subject = message['Subject']
         if mail_from not in constants.EXPLICIT_ALLOW_EMAILS:
             # only allow authorized users to send to distro lists
-            all_users_emails = gitlab_helpers.get_all_user_emails()
+            all_users_emails = await gitlab_helpers.run_async(gitlab_helpers.get_all_user_emails,
+                                                              timeout=constants.GITLAB_ACTION_TIMEOUT_SECONDS)
             if not (mail_from in all_users_emails):
                 logging.error('Unauthorized sender [from=%s] [to=%s] [subject=%s]' % (mail_from, mail_to, mail_subject))
                 return
             
         logging.info(f'process_email(subject=[{mail_subject}], mail_from={mail_from}, mail_to={mail_to})')
         
-        message_data = gitlab_helpers.clean_email_message(mail_from, to_addr, eventinfo['message'])
+        message_data = await gitlab_helpers.run_async(gitlab_helpers.clean_email_message,
+                                                      mail_from, to_addr, eventinfo['message'],
+                                                      timeout=constants.GITLAB_ACTION_TIMEOUT_SECONDS)
         message = message_data['message_content_object']
         groups = message_data['recipients']
 
@@ -65,10 +69,19 @@ async def process_email(eventinfo: dict):
 
         send_to = groups['send_to']
 
+        # a calendar invite is put in the database first, so its invites can be recorded as they're delivered
+        attachments = await get_attachments(message, groups['groups'], send_to, original=envelope.content)
+
         sent_success = set()
         # Send the message
         if len(send_to) > 0:
-            sent_success=send_smtp(mail_from, send_to, message.as_string())
+            # the parsed message is handed over as is, so it isn't serialized and parsed again
+            message_id = await outbound_spool.enqueue(mail_from, send_to, message,
+                                                      meeting_uuid=attachments['calendar_uid'])
+            # the spool delivers in the background; only the authorization reply below lists
+            # who it was delivered to, so only then is it worth holding up the action queue
+            if message_id is not None and len(groups['invalid_access_groups']) > 0:
+                sent_success = await outbound_spool.wait(message_id, constants.SMTP_SPOOL_WAIT_SECONDS)
 
         if len(groups['invalid_access_groups'])>0:
             errbody = f'''
@@ -83,16 +96,15 @@ Successfully sent message to these groups:
 
 {sent_success}
 '''
-            mime_email_send(f"Re: {message['Subject']} - Authorization", to= [mail_from], text=errbody, sender = constants.DEFAULT_FROM)
-        attachments = await get_attachments(message, groups['groups'], send_to)
-
+            await mime_email_send(f"Re: {message['Subject']} - Authorization", to=[mail_from], text=errbody,
+                                  sender=constants.DEFAULT_FROM)
         logging.info('Message processed successfully')
         # if includes a calendar, update the calendar wiki
         if attachments['has_calendar']:
             logging.info('Message has calendar')
             try:
-                if attachments['calendar_uid']:
-                    await db.meetings_invites_set(attachments['calendar_uid'], sent_success)
+                # not under the action deadline: cancelling a rebuild partway through (e.g. just after
+                # the calendar pages were deleted) would leave the wiki incomplete
                 await wiki.update_wiki_calendar_all()
             except Exception as e:
                 logging.exception(traceback.format_exc())
@@ -113,7 +125,8 @@ The reported error:
 {e}
 
             '''
-            mime_email_send(f"Error processing your request", to= [mail_from], text=errbody, sender = constants.DEFAULT_FROM)
+            await mime_email_send("Error processing your request", to=[mail_from], text=errbody,
+                                  sender=constants.DEFAULT_FROM)
         except Exception as e:
             logging.exception(traceback.format_exc())
             logging.exception(e)
@@ -121,7 +134,11 @@ The reported error:
 
 async def refresh_wiki(eventinfo: dict):
     logging.info('refresh_wiki')
-    gitlab_helpers.flush_caches()
+    # a membership change from a system hook is applied to the cache, other system hooks refresh
+    # the data they change, and a refresh without one (e.g. from /refresh-wiki) refreshes everything
+    payload = eventinfo.get('payload') or {}
+    if not await gitlab_helpers.run_async(gitlab_helpers.apply_member_event, payload):
+        gitlab_helpers.flush_caches(payload.get('event_name'))
     await wiki.update_wiki_distrolists()
     await wiki.update_wiki_calendar_all()
     logging.info('refresh_wiki done')
@@ -132,7 +149,6 @@ async def refresh_invites(eventinfo: dict):
     '''
     from refresh_emails import refresh_invite_emails
     logging.info(f'refresh_invites {eventinfo}')
-    gitlab_helpers.flush_caches()
     uuid = eventinfo.get('uuid', None)
     group = eventinfo.get('group', None)
     await refresh_invite_emails(uuid, group)
@@ -157,7 +173,16 @@ async def force_resend_invite(eventinfo: dict):
     await refresh_invites({'uuid': uuid})
 
 async def flush_gitlab_cache(eventinfo: dict):
-    gitlab_helpers.flush_caches()
+    gitlab_helpers.flush_caches(eventinfo.get('event_name'), membership=eventinfo.get('membership', False))
+
+
+async def apply_gitlab_member_event(eventinfo: dict):
+    '''
+    Updates the cached group membership from a Gitlab member system hook.
+    Falls back to refreshing the membership if the change can't be applied.
+    '''
+    if not await gitlab_helpers.run_async(gitlab_helpers.apply_member_event, eventinfo['payload']):
+        gitlab_helpers.flush_caches(eventinfo['payload'].get('event_name'))
 
 
 async def refresh_calendars_published(eventinfo: dict):
@@ -171,6 +196,7 @@ actions = {}
 actions['receive'] = process_email
 actions['refresh_wiki'] = refresh_wiki
 actions['flush_gitlab_cache'] = flush_gitlab_cache
+actions['apply_gitlab_member_event'] = apply_gitlab_member_event
 actions['refresh_invites'] = refresh_invites
 actions['refresh_calendars_published'] = refresh_calendars_published
 actions['force_resend_invite'] = force_resend_invite
@@ -0,0 +1,71 @@
+'''
+Stops calling a dependency that keeps failing, so callers fail fast (and fall back)
+instead of each waiting on their own timeout.
+'''
+import logging
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    '''
+    Opens after failure_threshold consecutive failures. While open, allow() is False
+    until reset_seconds have passed; then one trial call is allowed (half-open), and
+    its result closes the circuit again or reopens it.
+    '''
+    def __init__(self, name: str, failure_threshold=5, reset_seconds=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_progress = False
+        self.times_opened = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.clock() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                self.trial_in_progress = False
+            if self.state == HALF_OPEN and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logging.warning(f'{self.name} circuit closed')
+            self.state = CLOSED
+            self.failures = 0
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = self.clock()
+                self.times_opened += 1
+                logging.error(f'{self.name} circuit opened after {self.failures} failures, ' +
+                              f'retrying in {self.reset_seconds}s')
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
@@ -23,6 +23,70 @@ CERT_PATH = './certs'
 DB_PATH = '/app/database/timelord.db'
 
 GITLAB_CACHE_TIMEOUT_SECONDS = (10*60)
+# After GITLAB_CACHE_TIMEOUT_SECONDS cached Gitlab data is refreshed in the background,
+# but it is still used until this timeout
+GITLAB_CACHE_HARD_TIMEOUT_SECONDS = (60*60)
+# Group membership is kept current from member system hooks, and only fully
+# refetched on this interval (or when a hook can't be applied)
+GITLAB_RECONCILE_SECONDS = (60*60)
+# Maximum number of Gitlab API requests in flight (and pooled connections)
+GITLAB_MAX_CONCURRENCY = 8
+# Items per page for Gitlab list requests (Gitlab allows at most 100)
+GITLAB_PAGE_SIZE = 100
+# The Gitlab users, groups and membership are saved here, and loaded at startup
+# so mail can be routed before Gitlab has been crawled. Set to empty to disable
+GITLAB_SNAPSHOT_PATH = '/app/database/gitlab_snapshot.json'
+# If True, the direct members of every group are fetched in one crawl per membership
+# refresh, and all expansions are resolved locally. If False, they are fetched on demand.
+# After a start without a snapshot they are fetched on demand until the first crawl finishes
+GITLAB_MEMBERSHIP_CRAWL = True
+# If True, the users listing uses keyset pagination, which stays fast for deep pages.
+# Set to False for Gitlab versions that don't support it
+GITLAB_KEYSET_PAGINATION = True
+# Global budget for Gitlab API requests: requests per second on average, in bursts of up
+# to GITLAB_REQUEST_BURST. 0 is unlimited
+GITLAB_REQUESTS_PER_SECOND = 20
+GITLAB_REQUEST_BURST = 40
+# Once fewer than this fraction of Gitlab's RateLimit-Limit remain, requests wait for the reset
+GITLAB_RATELIMIT_RESERVE = 0.1
+# Gitlab GET responses kept to repeat as conditional requests (If-None-Match). 0 disables
+GITLAB_ETAG_CACHE_SIZE = 1000
+# Timeout for each Gitlab API request
+GITLAB_REQUEST_TIMEOUT_SECONDS = 30
+# Deadline for the Gitlab lookups made while processing an inbound message
+GITLAB_ACTION_TIMEOUT_SECONDS = 60
+# Once past their hard timeout, the Gitlab caches wait at most this long for a refresh
+# before using the last known (or snapshot) directory
+GITLAB_CACHE_MAX_WAIT_SECONDS = 10
+# After this many consecutive failed Gitlab requests, no requests are sent for
+# GITLAB_CIRCUIT_RESET_SECONDS, and the cached directory is used
+GITLAB_CIRCUIT_FAILURES = 5
+GITLAB_CIRCUIT_RESET_SECONDS = 30
+# Logged in connections kept open to each SMTP relay (unless SMTP_RELAYS sets them)
+SMTP_POOL_SIZE = 4
+# Pooled SMTP connections unused for this long are closed rather than reused
+SMTP_IDLE_TIMEOUT_SECONDS = 60
+# Relays to send through, comma separated host:port[:weight[:connections]], using the smtp_user_name
+# and smtp_password environment variables. Sessions are spread across them by weight, and moved to
+# another relay when one fails or throttles. If empty, the smtp_address and smtp_port environment variables
+SMTP_RELAYS = ''
+# Relay sessions at once, each over its own pooled connection. With several relays,
+# up to the sum of their connections is useful
+SMTP_SEND_PARALLELISM = 4
+# Most recipients and messages sent to each relay per second (e.g. the SES sending rate), 0 is unlimited.
+# When the relay throttles, both are lowered for a while (from the measured throughput if unlimited)
+SMTP_RECIPIENTS_PER_SECOND = 0
+SMTP_MESSAGES_PER_SECOND = 0
+# Outbound spool: a recipient that couldn't be sent to is retried after SMTP_SPOOL_RETRY_SECONDS,
+# doubling each time up to SMTP_SPOOL_MAX_RETRY_SECONDS, and given up on after SMTP_SPOOL_MAX_ATTEMPTS
+SMTP_SPOOL_MAX_ATTEMPTS = 8
+SMTP_SPOOL_RETRY_SECONDS = 30
+SMTP_SPOOL_MAX_RETRY_SECONDS = 3600
+# How long an invite refresh, or an inbound message the sender gets an authorization reply
+# for, waits for its delivery before reporting who it was delivered to
+SMTP_SPOOL_WAIT_SECONDS = 60
+# Delivered messages are kept in the spool for this long
+SMTP_SPOOL_RETENTION_HOURS = 72
 
 
 def set_constants():
@@ -35,11 +99,25 @@ def set_constants():
         'DOMAIN', 'DEFAULT_FROM', 'EXPLICIT_ALLOW_EMAILS',
         'DB_PATH', 'CERT_PATH',
         'LOGGING',
-        'GITLAB_CACHE_TIMEOUT_SECONDS'
+        'GITLAB_CACHE_TIMEOUT_SECONDS', 'GITLAB_CACHE_HARD_TIMEOUT_SECONDS', 'GITLAB_RECONCILE_SECONDS',
+        'GITLAB_MAX_CONCURRENCY', 'GITLAB_PAGE_SIZE', 'GITLAB_SNAPSHOT_PATH',
+        'GITLAB_MEMBERSHIP_CRAWL', 'GITLAB_KEYSET_PAGINATION',
+        'GITLAB_REQUESTS_PER_SECOND', 'GITLAB_REQUEST_BURST', 'GITLAB_RATELIMIT_RESERVE', 'GITLAB_ETAG_CACHE_SIZE',
+        'GITLAB_REQUEST_TIMEOUT_SECONDS', 'GITLAB_ACTION_TIMEOUT_SECONDS', 'GITLAB_CACHE_MAX_WAIT_SECONDS',
+        'GITLAB_CIRCUIT_FAILURES', 'GITLAB_CIRCUIT_RESET_SECONDS',
+        'SMTP_RELAYS', 'SMTP_POOL_SIZE', 'SMTP_IDLE_TIMEOUT_SECONDS', 'SMTP_SEND_PARALLELISM',
+        'SMTP_RECIPIENTS_PER_SECOND', 'SMTP_MESSAGES_PER_SECOND',
+        'SMTP_SPOOL_MAX_ATTEMPTS', 'SMTP_SPOOL_RETRY_SECONDS', 'SMTP_SPOOL_MAX_RETRY_SECONDS',
+        'SMTP_SPOOL_WAIT_SECONDS', 'SMTP_SPOOL_RETENTION_HOURS'
     ]:
         if var_name in os.environ:
             try:
-                global_vars[var_name] = os.environ[var_name].strip()
+                value = os.environ[var_name].strip()
+                default = global_vars.get(var_name)
+                # Keep numeric settings numeric
+                if isinstance(default, (int, float)) and not isinstance(default, bool):
+                    value = type(default)(value)
+                global_vars[var_name] = value
             except Exception:
                 logging.exception('')
         try:
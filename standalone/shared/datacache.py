@@ -1,7 +1,16 @@
 from datetime import datetime, timedelta
+import logging
+import threading
+import time
 
 
 class DataCache:
+    '''
+    Caches the result of fetch_function for timeout_seconds.
+
+    Thread safe: if several callers find the data expired at once, only one
+    of them calls fetch_function and the others wait for its result.
+    '''
     def __init__(self, fetch_function, timeout_seconds=60, *fetch_function_args, **fetch_function_kwags):
         self.fetch_function = fetch_function
         self.fetch_function_args = fetch_function_args
@@ -11,14 +20,194 @@ class DataCache:
         self.last_updated = datetime.min
         self.cached_data = None
 
+        self.lock = threading.Lock()
+        self.flushes = 0
+        # incremented every time the cached data is replaced
+        self.generation = 0
+        # counters, for reporting
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_seconds = 0.0
+        self.last_refresh_seconds = 0.0
+
     def flush(self):
+        self.flushes += 1
         self.last_updated = datetime.min
 
-    def get_data(self):
-        # Check if it's been more than the timeout_minutes since the last update
-        if datetime.now() - self.last_updated > timedelta(seconds=self.timeout_seconds):
-            # If it has, get fresh data using the provided fetch_function
-            self.cached_data = self.fetch_function(*self.fetch_function_args, **self.fetch_function_kwags)
+    def prime(self, data, stale=False):
+        '''
+        Sets the cached data without fetching, e.g. from a persisted snapshot.
+        If stale, it is treated as just past its timeout.
+        '''
+        with self.lock:
+            self.cached_data = data
+            self.generation += 1
+            self.last_updated = datetime.now()
+            if stale:
+                self.last_updated -= timedelta(seconds=self.timeout_seconds + 1)
+
+    def is_expired(self, timeout_seconds=None):
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
+        return datetime.now() - self.last_updated > timedelta(seconds=timeout_seconds)
+
+    def refresh(self):
+        '''
+        Gets fresh data using the provided fetch_function
+        '''
+        start = time.monotonic()
+        flushes = self.flushes
+        data = self.fetch_function(*self.fetch_function_args, **self.fetch_function_kwags)
+        self.cached_data = data
+        self.generation += 1
+        if flushes == self.flushes:
             self.last_updated = datetime.now()
+        # else flushed mid-fetch, so leave it expired for the next caller to fetch again
+        elapsed = time.monotonic() - start
+        self.refreshes += 1
+        self.refresh_seconds += elapsed
+        self.last_refresh_seconds = elapsed
+        return data
 
+    def get_data(self):
+        # Check if it's been more than the timeout_minutes since the last update
+        if not self.is_expired():
+            self.hits += 1
+            return self.cached_data
+        with self.lock:
+            # another caller may have refreshed while this one was waiting
+            if self.is_expired():
+                self.misses += 1
+                self.refresh()
+            else:
+                self.hits += 1
         return self.cached_data
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_seconds': self.refresh_seconds,
+            'last_refresh_seconds': self.last_refresh_seconds,
+        }
+
+
+class StaleWhileRevalidateDataCache(DataCache):
+    '''
+    A DataCache with separate soft and hard timeouts.
+
+    Before soft_timeout_seconds the cached data is returned as usual. Between the
+    soft and hard timeouts the stale data is still returned immediately, while a
+    single background thread refreshes it. After hard_timeout_seconds (or a flush)
+    callers block on the refresh, as with DataCache.
+
+    If max_wait_seconds is set, callers past the hard timeout wait at most that long
+    for the refresh when there is older data, and get the older data if the refresh
+    is still running or has failed. Only the first caller waits on each refresh: the
+    rest get the older data straight away until it finishes.
+    '''
+    def __init__(self, fetch_function, soft_timeout_seconds=60, hard_timeout_seconds=600,
+                 *fetch_function_args, max_wait_seconds=None, **fetch_function_kwags):
+        super().__init__(fetch_function, soft_timeout_seconds, *fetch_function_args, **fetch_function_kwags)
+        self.hard_timeout_seconds = hard_timeout_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.stale_hits = 0
+        self.fallbacks = 0
+        self.refreshing = False
+        # the number of background refreshes started, and the one a caller has already waited on
+        self.revalidations = 0
+        self.waited_revalidation = 0
+        # guards refreshing only, so checking it never waits on a refresh in progress
+        self.revalidate_lock = threading.Lock()
+        # set whenever no background refresh is running
+        self.revalidated = threading.Event()
+        self.revalidated.set()
+
+    def get_data(self):
+        if not self.is_expired():
+            self.hits += 1
+            return self.cached_data
+        if not self.is_expired(self.hard_timeout_seconds):
+            # stale, but still usable
+            self.stale_hits += 1
+            self.revalidate()
+            return self.cached_data
+        if self.max_wait_seconds is not None and self.cached_data is not None:
+            self.revalidate()
+            with self.revalidate_lock:
+                wait = self.max_wait_seconds if self.waited_revalidation != self.revalidations else 0
+                self.waited_revalidation = self.revalidations
+            if not self.revalidated.wait(wait) or self.is_expired(self.hard_timeout_seconds):
+                # still refreshing, or the refresh failed
+                self.fallbacks += 1
+                logging.warning(f'Using data past its timeout for {getattr(self.fetch_function, "__name__", "")}')
+            return self.cached_data
+        return super().get_data()
+
+    def invalidate(self):
+        '''
+        Marks the data stale, unlike flush(): it is still returned while a background
+        refresh replaces it. Without any data yet, this is the same as flush().
+        '''
+        # also keeps a refresh already running from counting as fresh, see DataCache.refresh
+        self.flush()
+        if self.cached_data is None:
+            return
+        self.last_updated = datetime.now() - timedelta(seconds=self.timeout_seconds + 1)
+        self.revalidate()
+
+    def revalidate(self):
+        '''
+        Starts a background refresh, unless one is already running
+        '''
+        with self.revalidate_lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            self.revalidations += 1
+            self.revalidated.clear()
+        thread = threading.Thread(target=self._revalidate, daemon=True)
+        thread.start()
+
+    def _revalidate(self):
+        try:
+            with self.lock:
+                # a blocking refresh may have happened since this was started
+                if self.is_expired():
+                    self.refresh()
+        except Exception:
+            logging.exception(f'Background refresh failed for {getattr(self.fetch_function, "__name__", "")}')
+        finally:
+            self.refreshing = False
+            self.revalidated.set()
+
+    def stats(self):
+        results = super().stats()
+        results['stale_hits'] = self.stale_hits
+        results['fallbacks'] = self.fallbacks
+        return results
+
+
+class GenerationCache(DataCache):
+    '''
+    A DataCache for data derived from other caches. Rather than a timeout, it is
+    refreshed whenever generation_function() returns a different value.
+    '''
+    def __init__(self, fetch_function, generation_function, *fetch_function_args, **fetch_function_kwags):
+        super().__init__(fetch_function, 0, *fetch_function_args, **fetch_function_kwags)
+        self.generation_function = generation_function
+        self.source_generation = None
+
+    def is_expired(self, timeout_seconds=None):
+        if self.last_updated == datetime.min:
+            return True
+        return self.generation_function() != self.source_generation
+
+    def refresh(self):
+        # taken before fetching, so a change mid-fetch causes another refresh
+        generation = self.generation_function()
+        data = super().refresh()
+        self.source_generation = generation
+        return data
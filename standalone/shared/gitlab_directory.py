@@ -0,0 +1,588 @@
+'''
+In-memory indexes over the Gitlab users and groups listings.
+
+These are built once per cache refresh (see gitlab_helpers) so that
+distribution list expansion never has to scan the raw listings.
+'''
+from collections import deque
+from collections.abc import Iterable as IterableABC, Set
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+def bitset(indexes: Iterable[int]) -> int:
+    '''
+    Returns an int with the given bits set
+    '''
+    indexes = list(indexes)
+    if len(indexes) == 0:
+        return 0
+    # set the bits in a buffer and convert once, rather than building a new int per bit
+    buffer = bytearray((max(indexes) >> 3) + 1)
+    for index in indexes:
+        buffer[index >> 3] |= 1 << (index & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def bitset_indexes(bits: int) -> List[int]:
+    '''
+    Returns the indexes of the set bits, lowest first
+    '''
+    return [index for index, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
+
+
+class UserDirectory:
+    '''
+    Indexes a Gitlab users listing by id and by email address.
+
+    Each user with an email address also gets a dense index, so sets of users
+    can be held as bitsets (see EmailSet).
+    '''
+    def __init__(self, users: Iterable):
+        self.users = list(users)
+        self.by_id = {}
+        self.by_email = {}
+        # email -> {'is_admin': bool} for active users only. This is the format
+        # returned by gitlab_helpers.get_all_user_emails()
+        self.active_emails: Dict[str, Dict] = {}
+        # dense user indexes, for bitsets
+        self.index_by_id: Dict[int, int] = {}
+        self.index_by_email: Dict[str, int] = {}
+        self.emails_by_index: List[str] = []
+        active_indexes = []
+
+        for user in self.users:
+            self.by_id[user.id] = user
+            email = getattr(user, 'email', None)
+            if not email:
+                continue
+            self.by_email[email] = user
+            index = self.index_by_email.get(email)
+            if index is None:
+                index = len(self.emails_by_index)
+                self.index_by_email[email] = index
+                self.emails_by_index.append(email)
+            self.index_by_id[user.id] = index
+            if user.state == 'active':
+                self.active_emails[email] = {'is_admin': getattr(user, 'is_admin', False)}
+                active_indexes.append(index)
+        # every active user with an email address
+        self.active_bits = bitset(active_indexes)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def get(self, user_id):
+        return self.by_id.get(user_id)
+
+    def get_active(self, user_id):
+        '''
+        Returns the user with the given id, or None if not found or not active
+        '''
+        user = self.by_id.get(user_id)
+        if user is None or user.state != 'active':
+            return None
+        return user
+
+    def get_by_email(self, email):
+        return self.by_email.get(email)
+
+    def bits(self, user_ids: Iterable[int]) -> int:
+        '''
+        Returns the bitset of the given users, leaving out those that aren't active
+        '''
+        index_by_id = self.index_by_id
+        return bitset(index_by_id[i] for i in user_ids if i in index_by_id) & self.active_bits
+
+    def bits_for_emails(self, emails: Iterable[str]) -> int:
+        '''
+        Returns the bitset of the given emails. Emails of unknown users are left out.
+        '''
+        index_by_email = self.index_by_email
+        return bitset(index_by_email[e] for e in emails if e in index_by_email)
+
+    def emails(self, bits: int) -> List[str]:
+        emails_by_index = self.emails_by_index
+        return [emails_by_index[index] for index in bitset_indexes(bits)]
+
+
+class EmailSet(Set):
+    '''
+    A read only set of user emails, held as a bitset over a UserDirectory.
+
+    Unions, intersections and differences with other EmailSets (or, for
+    differences and intersections, with any collection of emails) are integer
+    operations. The emails are only listed when the set is iterated.
+    '''
+    __slots__ = ('bits', 'users')
+
+    def __init__(self, bits: int, users: UserDirectory):
+        self.bits = bits
+        self.users = users
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # results that can't be bitsets, e.g. a union with emails outside the directory
+        return frozenset(it)
+
+    def _other_bits(self, other):
+        if isinstance(other, EmailSet) and other.users is self.users:
+            return other.bits
+        return self.users.bits_for_emails(other)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __iter__(self):
+        return iter(self.users.emails(self.bits))
+
+    def __contains__(self, email):
+        index = self.users.index_by_email.get(email)
+        return index is not None and (self.bits >> index) & 1 == 1
+
+    def __sub__(self, other):
+        if not isinstance(other, IterableABC):
+            return NotImplemented
+        return EmailSet(self.bits & ~self._other_bits(other), self.users)
+
+    def __and__(self, other):
+        if not isinstance(other, IterableABC):
+            return NotImplemented
+        return EmailSet(self.bits & self._other_bits(other), self.users)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        if isinstance(other, EmailSet) and other.users is self.users:
+            return EmailSet(self.bits | other.bits, self.users)
+        return super().__or__(other)
+
+    __ror__ = __or__
+
+    def __repr__(self):
+        return f'EmailSet({set(self)})'
+
+
+class GroupHierarchy:
+    '''
+    Parent/child graph over a Gitlab groups listing.
+
+    Every group in the listing carries its parent_id, so ancestors and
+    descendants can be resolved without any further API calls.
+    '''
+    def __init__(self, groups: Iterable):
+        self.groups = list(groups)
+        self.by_id = {}
+        # parent group id -> list of direct child group ids
+        self.children_ids: Dict[int, List[int]] = {}
+        self._ancestor_ids: Dict[int, Tuple[int, ...]] = {}
+        self._descendant_ids: Dict[int, Tuple[int, ...]] = {}
+
+        for group in self.groups:
+            self.by_id[group.id] = group
+        for group in self.groups:
+            parent_id = getattr(group, 'parent_id', None)
+            if parent_id:
+                self.children_ids.setdefault(parent_id, []).append(group.id)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def get(self, group_id):
+        return self.by_id.get(group_id)
+
+    def ancestor_ids(self, group_id) -> Tuple[int, ...]:
+        '''
+        Returns the ids of all ancestors of the group, nearest parent first
+        '''
+        if group_id in self._ancestor_ids:
+            return self._ancestor_ids[group_id]
+        results = []
+        seen = {group_id}
+        group = self.by_id.get(group_id)
+        while group is not None:
+            parent_id = getattr(group, 'parent_id', None)
+            # stop at the top level, or at a parent that isn't in the listing
+            if not parent_id or parent_id in seen or parent_id not in self.by_id:
+                break
+            seen.add(parent_id)
+            results.append(parent_id)
+            group = self.by_id[parent_id]
+        self._ancestor_ids[group_id] = tuple(results)
+        return self._ancestor_ids[group_id]
+
+    def descendant_ids(self, group_id) -> Tuple[int, ...]:
+        '''
+        Returns the ids of all subgroups of the group at any depth (breadth first)
+        '''
+        if group_id in self._descendant_ids:
+            return self._descendant_ids[group_id]
+        results = []
+        seen = {group_id}
+        pending = [group_id]
+        while pending:
+            next_pending = []
+            for parent_id in pending:
+                for child_id in self.children_ids.get(parent_id, []):
+                    if child_id in seen:
+                        continue
+                    seen.add(child_id)
+                    results.append(child_id)
+                    next_pending.append(child_id)
+            pending = next_pending
+        self._descendant_ids[group_id] = tuple(results)
+        return self._descendant_ids[group_id]
+
+    def children(self, group_id) -> List:
+        return [self.by_id[i] for i in self.children_ids.get(group_id, [])]
+
+    def ancestors(self, group_id) -> List:
+        return [self.by_id[i] for i in self.ancestor_ids(group_id)]
+
+    def descendants(self, group_id) -> List:
+        return [self.by_id[i] for i in self.descendant_ids(group_id)]
+
+
+def group_email_name(full_path: str) -> str:
+    '''
+    Returns the email address name for a group: its full path with / replaced by dots,
+    keeping only letters, numbers, dots and dashes
+    '''
+    full_path = full_path.replace('/', '.').replace(' ', '-')
+    return ''.join(e for e in full_path if e.isalnum() or e == '.' or e == '-').lower()
+
+
+class GroupEmailIndex:
+    '''
+    Indexes a Gitlab groups listing by group email, with and without the domain.
+
+    Each entry is {'id', 'name', 'email', 'group'}, where name is the email
+    address without the domain. Entries are shared between the indexes, so
+    callers must not modify them.
+    '''
+    def __init__(self, groups: Iterable, domain: str):
+        self.domain = domain
+        # group email name (no domain) -> entry
+        self.by_name: Dict[str, Dict] = {}
+        # group email -> entry
+        self.by_email: Dict[str, Dict] = {}
+        self.by_id: Dict[int, Dict] = {}
+
+        for group in groups:
+            name = group_email_name(group.full_path)
+            if name in self.by_name:
+                # two paths that only differ by filtered characters, the first one wins
+                logging.warning(f'Group {group.full_path} has the same email as ' +
+                                f'{self.by_name[name]["group"].full_path}')
+                continue
+            entry = {'id': group.id, 'name': name, 'email': f'{name}@{domain}', 'group': group}
+            self.by_name[name] = entry
+            self.by_email[entry['email']] = entry
+            self.by_id[group.id] = entry
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_email(self, email):
+        return self.by_email.get(email)
+
+
+class GroupMembership:
+    '''
+    Direct and transitive membership of Gitlab groups.
+
+    Each group's direct members are fetched at most once for the life of this
+    object (one cache generation). Transitive member sets are derived from the
+    direct members using the group hierarchy, and memoized.
+
+    fetch_direct_members(group_id) must return the group's direct members,
+    each with an id and access_level.
+    hierarchy_getter() must return the current GroupHierarchy.
+    preloaded is {group id: {user id: access level}} for groups already known,
+    e.g. from a snapshot.
+    '''
+    def __init__(self, fetch_direct_members: Callable, hierarchy_getter: Callable,
+                 preloaded: Dict[int, Dict[int, int]] = None):
+        self.fetch_direct_members = fetch_direct_members
+        self.get_hierarchy = hierarchy_getter
+        # group id -> {user id: access level}
+        self.direct: Dict[int, Dict[int, int]] = dict(preloaded or {})
+        # API call counts and latency, for reporting
+        self.fetch_count = 0
+        self.fetch_seconds = 0.0
+        self.fetch_max_seconds = 0.0
+        self._stats_lock = threading.Lock()
+        # True once every group in the hierarchy has been fetched, see crawl()
+        self.complete = False
+        # incremented for every membership change applied after the initial fetch
+        self.version = 0
+        # the recent changes, (version, group id, user id, access level or None if removed), so
+        # members fetched while a change was applied can include it too, see _store()
+        self._changes = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+        # memoized closures, only valid for the hierarchy they were built from
+        self._closures: Dict[Tuple, Dict[int, int]] = {}
+        self._closures_hierarchy = None
+
+    def direct_members(self, group_id) -> Dict[int, int]:
+        '''
+        Returns {user id: access level} for the direct members of the group
+        '''
+        members = self.direct.get(group_id)
+        if members is None:
+            version = self.version
+            members = self._store(group_id, self._fetch(group_id), version)
+        return members
+
+    def _store(self, group_id, members: Dict[int, int], version) -> Dict[int, int]:
+        '''
+        Stores the members of a group fetched since version, with any changes applied since
+        '''
+        with self._lock:
+            if self.version != version:
+                if self._changes and self._changes[0][0] > version + 1:
+                    # too many changes to replay, so it's fetched again next time
+                    logging.warning(f'GroupMembership: group {group_id} changed while being fetched, not cached')
+                    return members
+                for change_version, change_group_id, user_id, access_level in self._changes:
+                    if change_version > version and change_group_id == group_id:
+                        _apply_change(members, user_id, access_level)
+            self.direct[group_id] = members
+        return members
+
+    def _fetch(self, group_id) -> Dict[int, int]:
+        start = time.monotonic()
+        members = {m.id: m.access_level for m in self.fetch_direct_members(group_id)}
+        elapsed = time.monotonic() - start
+        with self._stats_lock:
+            self.fetch_count += 1
+            self.fetch_seconds += elapsed
+            self.fetch_max_seconds = max(self.fetch_max_seconds, elapsed)
+        return members
+
+    def prefetch(self, group_ids: Iterable[int], max_workers=8):
+        '''
+        Fetches the direct members of any of the groups that haven't been fetched yet,
+        with up to max_workers requests in flight at once.
+        '''
+        pending = [group_id for group_id in dict.fromkeys(group_ids) if group_id not in self.direct]
+        if len(pending) == 0:
+            return
+        start = time.monotonic()
+        calls = self.fetch_count
+        call_seconds = self.fetch_seconds
+        version = self.version
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gitlab-members') as executor:
+            # results are stored from this thread only, as each fetch completes
+            for group_id, members in zip(pending, executor.map(self._fetch, pending)):
+                self._store(group_id, members, version)
+        calls = self.fetch_count - calls
+        logging.info(f'GroupMembership.prefetch: {len(pending)} groups in {time.monotonic() - start:.2f}s ' +
+                     f'({calls} calls, avg {1000 * (self.fetch_seconds - call_seconds) / calls:.0f}ms, ' +
+                     f'max {1000 * self.fetch_max_seconds:.0f}ms, workers={max_workers})')
+
+    def crawl(self, max_workers=8):
+        '''
+        Fetches the direct members of every group in the hierarchy (one paginated
+        members listing per group), so that all expansions and authorization checks
+        after this are answered locally.
+        '''
+        self.prefetch([group.id for group in self.get_hierarchy()], max_workers=max_workers)
+        self.complete = True
+
+    def apply_member_update(self, group_id, user_id, access_level) -> bool:
+        '''
+        Records that the user is now a direct member of the group with the given access level.
+        Returns False if the group isn't known, in which case the change couldn't be applied.
+        '''
+        if self.get_hierarchy().get(group_id) is None:
+            return False
+        self._apply(group_id, user_id, access_level)
+        return True
+
+    def apply_member_removal(self, group_id, user_id) -> bool:
+        '''
+        Records that the user is no longer a direct member of the group.
+        Returns False if the group isn't known, in which case the change couldn't be applied.
+        '''
+        if self.get_hierarchy().get(group_id) is None:
+            return False
+        self._apply(group_id, user_id, None)
+        return True
+
+    def changes_since(self, version) -> List[Tuple] | None:
+        '''
+        The changes applied after version, as (group id, user id, access level or None if
+        removed), or None if they're no longer all kept
+        '''
+        with self._lock:
+            changes = [change[1:] for change in self._changes if change[0] > version]
+            if len(changes) < self.version - version:
+                return None
+            return changes
+
+    def apply_changes(self, changes: Iterable[Tuple]):
+        '''
+        Applies changes from changes_since() of another GroupMembership
+        '''
+        for group_id, user_id, access_level in changes:
+            self._apply(group_id, user_id, access_level)
+
+    def _apply(self, group_id, user_id, access_level):
+        with self._lock:
+            members = self.direct.get(group_id)
+            if members is not None:
+                # copy on write, so readers never see a dictionary change size mid-iteration
+                members = dict(members)
+                _apply_change(members, user_id, access_level)
+                self.direct[group_id] = members
+            # if the group hasn't been fetched yet (or is being fetched), it will include the change when it is
+            self._invalidate_closures()
+            self._changes.append((self.version, group_id, user_id, access_level))
+
+    def _invalidate_closures(self):
+        self._closures = {}
+        self.version += 1
+
+    def _get_closures(self, hierarchy):
+        if hierarchy is not self._closures_hierarchy:
+            self._closures = {}
+            self._closures_hierarchy = hierarchy
+        return self._closures
+
+    def members(self, group_id, recursive=True, filter_access_level=None) -> Dict[int, int]:
+        '''
+        Returns {user id: highest access level} for members of the group,
+        and of all its subgroups if recursive.
+        '''
+        hierarchy = self.get_hierarchy()
+        closures = self._get_closures(hierarchy)
+        key = ('members', group_id, recursive, filter_access_level)
+        if key in closures:
+            return closures[key]
+
+        results = _filter_access_level(self.direct_members(group_id), filter_access_level)
+        if recursive:
+            # each child's closure already includes its own subgroups
+            for child_id in hierarchy.children_ids.get(group_id, []):
+                _merge_access_levels(results, self.members(child_id, True, filter_access_level))
+        closures[key] = results
+        return results
+
+    def members_with_ancestors(self, group_id, filter_access_level=None) -> Dict[int, int]:
+        '''
+        Returns {user id: highest access level} for direct members of the group
+        and of each of its ancestors.
+        '''
+        hierarchy = self.get_hierarchy()
+        closures = self._get_closures(hierarchy)
+        key = ('ancestors', group_id, filter_access_level)
+        if key in closures:
+            return closures[key]
+
+        results = _filter_access_level(self.direct_members(group_id), filter_access_level)
+        ancestor_ids = hierarchy.ancestor_ids(group_id)
+        if ancestor_ids:
+            # the nearest parent's result already includes the rest of the chain
+            _merge_access_levels(results, self.members_with_ancestors(ancestor_ids[0], filter_access_level))
+        closures[key] = results
+        return results
+
+
+def _apply_change(members: Dict[int, int], user_id, access_level):
+    if access_level is None:
+        members.pop(user_id, None)
+    else:
+        members[user_id] = access_level
+
+
+def _filter_access_level(members: Dict[int, int], filter_access_level=None) -> Dict[int, int]:
+    if filter_access_level is None:
+        return dict(members)
+    return {user_id: level for user_id, level in members.items() if level >= filter_access_level}
+
+
+def _merge_access_levels(results: Dict[int, int], members: Dict[int, int]):
+    for user_id, level in members.items():
+        if level > results.get(user_id, -1):
+            results[user_id] = level
+
+
+class MembershipBitsets:
+    '''
+    Transitive group membership as bitsets of active users, memoized for the
+    life of this object (one cache generation).
+    '''
+    def __init__(self, membership: GroupMembership, users: UserDirectory):
+        self.membership = membership
+        self.users = users
+        self._bits: Dict[Tuple, int] = {}
+
+    def members(self, group_id, recursive=True) -> int:
+        '''
+        Returns the bitset of active members of the group, and of all its subgroups if recursive
+        '''
+        key = (group_id, recursive)
+        bits = self._bits.get(key)
+        if bits is None:
+            bits = self.users.bits(self.membership.direct_members(group_id))
+            if recursive:
+                # each child's bitset already includes its own subgroups
+                for child_id in self.membership.get_hierarchy().children_ids.get(group_id, []):
+                    bits |= self.members(child_id, True)
+            self._bits[key] = bits
+        return bits
+
+    def emails(self, bits: int) -> EmailSet:
+        return EmailSet(bits, self.users)
+
+
+class SenderAuthorizationIndex:
+    '''
+    Maps each group email to the emails of the active users allowed to send to it:
+    the direct members of the group and of each of its ancestors.
+
+    Each group's senders are resolved the first time they are needed, and kept for
+    the life of this object (one cache generation).
+    '''
+    def __init__(self, group_ids_by_email: Dict[str, int], membership: GroupMembership, users: UserDirectory):
+        self.group_ids_by_email = group_ids_by_email
+        self.membership = membership
+        self.users = users
+        self._senders: Dict[str, frozenset] = {}
+
+    def senders(self, group_email) -> frozenset:
+        '''
+        Returns the emails allowed to send to the group, or an empty set if it isn't a group
+        '''
+        results = self._senders.get(group_email)
+        if results is None:
+            group_id = self.group_ids_by_email.get(group_email)
+            results = set()
+            if group_id is not None:
+                for user_id in self.membership.members_with_ancestors(group_id):
+                    user = self.users.get_active(user_id)
+                    if user:
+                        results.add(user.email)
+            results = frozenset(results)
+            self._senders[group_email] = results
+        return results
+
+    def is_authorized(self, group_email, sender) -> bool:
+        return sender in self.senders(group_email)
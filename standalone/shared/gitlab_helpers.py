@@ -1,15 +1,27 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import email
+import functools
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import getaddresses, parseaddr
 import os
+import threading
+import time
 import traceback
 from typing import Sequence, List, Dict, TypedDict
 import gitlab
+import requests
 from icalendar import Calendar
 
 import shared.constants as constants
-from shared.datacache import DataCache
+from shared.datacache import StaleWhileRevalidateDataCache, GenerationCache
+from shared.gitlab_directory import UserDirectory, GroupHierarchy, GroupMembership, SenderAuthorizationIndex, \
+    GroupEmailIndex, MembershipBitsets, EmailSet
+from shared.gitlab_records import UserRecord, GroupRecord
+from shared.circuitbreaker import CircuitBreaker
+from shared.gitlab_transport import GitlabTransportAdapter
+import shared.gitlab_snapshot as gitlab_snapshot
 import logging
 
 gitlab_url = os.environ.get("gitlab_url")
@@ -17,55 +29,353 @@ access_token = os.environ.get("gitlab_access_token")
 
 gitlab_calendar_wiki_project_id = os.environ.get("gitlab_calendar_wiki_project_id")
 
-gl = gitlab.Gitlab(gitlab_url, private_token=access_token)
+
+# every Gitlab request goes through this, see gitlab_transport
+gitlab_transport = GitlabTransportAdapter(requests_per_second=constants.GITLAB_REQUESTS_PER_SECOND,
+                                          burst=constants.GITLAB_REQUEST_BURST,
+                                          rate_limit_reserve=constants.GITLAB_RATELIMIT_RESERVE,
+                                          etag_cache_size=constants.GITLAB_ETAG_CACHE_SIZE,
+                                          breaker=CircuitBreaker('Gitlab',
+                                                                 constants.GITLAB_CIRCUIT_FAILURES,
+                                                                 constants.GITLAB_CIRCUIT_RESET_SECONDS),
+                                          pool_connections=1,
+                                          pool_maxsize=constants.GITLAB_MAX_CONCURRENCY)
+
+
+def _build_gitlab_session() -> requests.Session:
+    '''
+    A keep-alive session with one pooled connection per Gitlab worker thread
+    '''
+    session = requests.Session()
+    session.mount('https://', gitlab_transport)
+    session.mount('http://', gitlab_transport)
+    return session
+
+
+gl = gitlab.Gitlab(gitlab_url, private_token=access_token,
+                   session=_build_gitlab_session(),
+                   per_page=constants.GITLAB_PAGE_SIZE,
+                   timeout=constants.GITLAB_REQUEST_TIMEOUT_SECONDS)
+
+# python-gitlab is blocking, so calls made from coroutines run on these threads
+gitlab_executor = ThreadPoolExecutor(max_workers=constants.GITLAB_MAX_CONCURRENCY, thread_name_prefix='gitlab')
+
+
+async def run_async(func, *args, timeout=None, **kwargs):
+    '''
+    Runs a blocking function that calls Gitlab (directly, or through one of the caches)
+    on the Gitlab worker threads, so it doesn't block the event loop.
+    If timeout is set, raises asyncio.TimeoutError if it doesn't finish in time
+    (the function itself carries on in the background).
+    '''
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(gitlab_executor, functools.partial(func, *args, **kwargs))
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
 
 
 def listAllGitlabGroups():
-    return gl.groups.list(all=True)
+    '''
+    Returns a generator over all groups, which requests each page as the previous one is consumed.
+    Gitlab only supports keyset pagination of groups for unauthenticated requests, so this is by offset.
+    '''
+    return gl.groups.list(iterator=True)
 
 
 def listAllGitlabUsers():
-    return gl.users.list(all=True)
+    '''
+    Returns a generator over all users, which requests each page as the previous one is consumed
+    '''
+    if constants.GITLAB_KEYSET_PAGINATION:
+        return gl.users.list(iterator=True, pagination='keyset', order_by='id', sort='asc')
+    return gl.users.list(iterator=True)
+
+
+def _stream_records(listing, record_type, name):
+    '''
+    Converts each object to a record as its page arrives, so only one page of RESTObjects is held at a time
+    '''
+    start = time.monotonic()
+    count = 0
+    for o in listing:
+        count += 1
+        yield record_type.from_object(o)
+    logging.info(f'gitlab_helpers.{name}: {count} in {time.monotonic() - start:.2f}s')
+
+
+# The directory is only swapped into the cache once complete; until then lookups use the
+# previous (or snapshot) directory. A partial one would wrongly reject senders and drop recipients
+def buildGitlabUserDirectory() -> UserDirectory:
+    # only the fields Timelord reads are kept, not the RESTObjects
+    return UserDirectory(_stream_records(listAllGitlabUsers(), UserRecord, 'listAllGitlabUsers'))
+
+
+def buildGitlabGroupHierarchy() -> GroupHierarchy:
+    return GroupHierarchy(_stream_records(listAllGitlabGroups(), GroupRecord, 'listAllGitlabGroups'))
+
+
+def listGitlabGroupMembers(group_id):
+    # lazy, so only the members are requested and not the group itself
+    return gl.groups.get(group_id, lazy=True).members.list(iterator=True)
+
+
+# guards handing a crawled membership over to the cache, see _crawl_membership()
+_membership_lock = threading.Lock()
+# the last crawled membership, which member system hooks are applied to as well until it's cached
+_incoming_membership: GroupMembership = None
+
+
+def buildGitlabGroupMembership() -> GroupMembership:
+    # direct members are fetched once per cache generation, either all up front, or on demand
+    if not constants.GITLAB_MEMBERSHIP_CRAWL:
+        return GroupMembership(listGitlabGroupMembers, groupDataCache.get_data)
+    if groupMembershipCache.cached_data is None:
+        # a cold start without a snapshot: crawling every group takes minutes, so until the
+        # first crawl is done (in the background) lookups fetch the groups they need on demand
+        threading.Thread(target=_crawl_in_background, daemon=True).start()
+        return GroupMembership(listGitlabGroupMembers, groupDataCache.get_data)
+    return _crawl_membership()
+
+
+def _crawl_membership() -> GroupMembership:
+    global _incoming_membership
+    previous = groupMembershipCache.cached_data
+    version = previous.version if previous is not None else 0
+    membership = GroupMembership(listGitlabGroupMembers, groupDataCache.get_data)
+    membership.crawl(max_workers=constants.GITLAB_MAX_CONCURRENCY)
+    with _membership_lock:
+        # member hooks that arrived during the crawl were applied to the cached membership (on a
+        # cold start, one created since), and a group fetched before a hook won't include it
+        current = groupMembershipCache.cached_data
+        if current is not None:
+            changes = current.changes_since(version if current is previous else 0)
+            if changes is None:
+                logging.warning('Too many member changes during the Gitlab membership crawl to replay, ' +
+                                'some may be missing until the next crawl')
+            else:
+                membership.apply_changes(changes)
+        # hooks from now on are applied to both, until the cache has swapped this one in
+        _incoming_membership = membership
+    save_snapshot(membership=membership)
+    return membership
+
+
+def _crawl_in_background():
+    try:
+        membership = _crawl_membership()
+    except Exception:
+        logging.exception('Gitlab group membership crawl failed, group members are still fetched on demand')
+        return
+    groupMembershipCache.prime(membership)
+    logging.info('gitlab_helpers: group membership crawl complete')
+
+
+# The users and groups listings are refetched in the background once stale, so
+# the SMTP, webhook and action queue threads keep using them in the meantime
+# If Gitlab is slow or down (see gitlab_transport), they keep using the last known directory
+groupDataCache = StaleWhileRevalidateDataCache(buildGitlabGroupHierarchy,
+                                               constants.GITLAB_CACHE_TIMEOUT_SECONDS,
+                                               constants.GITLAB_CACHE_HARD_TIMEOUT_SECONDS,
+                                               max_wait_seconds=constants.GITLAB_CACHE_MAX_WAIT_SECONDS)
+userDataCache = StaleWhileRevalidateDataCache(buildGitlabUserDirectory,
+                                              constants.GITLAB_CACHE_TIMEOUT_SECONDS,
+                                              constants.GITLAB_CACHE_HARD_TIMEOUT_SECONDS,
+                                              max_wait_seconds=constants.GITLAB_CACHE_MAX_WAIT_SECONDS)
+# kept current by member system hooks (see apply_member_event()), and recrawled
+# in the background every GITLAB_RECONCILE_SECONDS
+groupMembershipCache = StaleWhileRevalidateDataCache(buildGitlabGroupMembership,
+                                                     constants.GITLAB_RECONCILE_SECONDS,
+                                                     2 * constants.GITLAB_RECONCILE_SECONDS,
+                                                     max_wait_seconds=constants.GITLAB_CACHE_MAX_WAIT_SECONDS)
+
+
+def flush_caches(event_name: str = None, membership=False):
+    '''
+    Refreshes the cached Gitlab data that a system hook event_name changes, or all of it
+    if event_name is None, and the group membership if membership is set. The users and
+    groups listings are fetched again by the next lookup; the group membership, whose crawl
+    takes minutes, is still used while it's crawled again in the background.
+    '''
+    if event_name is None or event_name in GITLAB_USER_EVENTS + GITLAB_MEMBER_EVENTS:
+        userDataCache.flush()
+    if event_name is None or event_name in GITLAB_GROUP_EVENTS:
+        groupDataCache.flush()
+    if event_name is None or event_name in GITLAB_MEMBER_EVENTS or membership:
+        groupMembershipCache.invalidate()
+    logging.info(f'gitlab_helpers.flush_caches({event_name})')
+
+
+def stats() -> Dict:
+    '''
+    Gitlab request counts and latency per endpoint, and cache hit rates
+    '''
+    return {
+        'requests': gitlab_transport.stats(),
+        'caches': {name: cache.stats() for name, cache in (
+            ('users', userDataCache), ('groups', groupDataCache), ('membership', groupMembershipCache))},
+    }
+
+
+def save_snapshot(membership: GroupMembership = None):
+    '''
+    Saves the cached Gitlab directory (or the given membership, if it's not cached yet),
+    so it can be loaded at the next startup
+    '''
+    if not constants.GITLAB_SNAPSHOT_PATH:
+        return
+    users = userDataCache.cached_data
+    groups = groupDataCache.cached_data
+    if membership is None:
+        membership = groupMembershipCache.cached_data
+    if users is None or groups is None or membership is None:
+        return
+    try:
+        members = dict(membership.direct)
+        gitlab_snapshot.save(constants.GITLAB_SNAPSHOT_PATH,
+                             gitlab_snapshot.to_records(users, gitlab_snapshot.USER_FIELDS),
+                             gitlab_snapshot.to_records(groups, gitlab_snapshot.GROUP_FIELDS),
+                             members)
+        logging.info(f'gitlab_helpers.save_snapshot: {len(users)} users, {len(groups)} groups, ' +
+                     f'{len(members)} group memberships')
+    except Exception:
+        logging.exception(f'Unable to save Gitlab snapshot {constants.GITLAB_SNAPSHOT_PATH}')
+
+
+def load_snapshot() -> bool:
+    '''
+    Loads the caches from the last saved snapshot. They are treated as stale, so they are
+    refetched in the background on first use, or by calling revalidate_caches().
+    Returns False if there was no snapshot to load.
+    '''
+    if not constants.GITLAB_SNAPSHOT_PATH:
+        return False
+    snapshot = gitlab_snapshot.load(constants.GITLAB_SNAPSHOT_PATH)
+    if snapshot is None:
+        return False
+    users = UserDirectory(UserRecord.from_attributes(attrs) for attrs in snapshot['users'])
+    groups = GroupHierarchy(GroupRecord.from_attributes(attrs) for attrs in snapshot['groups'])
+    userDataCache.prime(users, stale=True)
+    groupDataCache.prime(groups, stale=True)
+    # without a crawl, a refetch would just discard the snapshot, so it's kept until reconciled
+    groupMembershipCache.prime(GroupMembership(listGitlabGroupMembers, groupDataCache.get_data,
+                                               snapshot['members']),
+                               stale=constants.GITLAB_MEMBERSHIP_CRAWL)
+    logging.info(f'gitlab_helpers.load_snapshot: {len(users)} users, {len(groups)} groups, ' +
+                 f'{len(snapshot["members"])} group memberships saved at {snapshot["saved_at"]}')
+    return True
+
+
+def revalidate_caches():
+    '''
+    Starts background refreshes of any stale caches, e.g. after loading a snapshot
+    '''
+    for cache in (userDataCache, groupDataCache, groupMembershipCache):
+        if cache.is_expired():
+            cache.revalidate()
 
 
-groupDataCache = DataCache(listAllGitlabGroups, constants.GITLAB_CACHE_TIMEOUT_SECONDS)
-userDataCache = DataCache(listAllGitlabUsers, constants.GITLAB_CACHE_TIMEOUT_SECONDS)
+# Gitlab system hook events for group membership changes
+GITLAB_MEMBER_EVENTS = ('user_add_to_group', 'user_update_for_group', 'user_remove_from_group')
+# and for changes to the users and groups listings. A new group's members are fetched when it's first used
+GITLAB_USER_EVENTS = ('user_create', 'user_destroy', 'user_rename')
+GITLAB_GROUP_EVENTS = ('group_create', 'group_destroy', 'group_rename')
 
+GITLAB_ACCESS_LEVELS = {
+    'no access': 0,
+    'minimal access': 5,
+    'guest': 10,
+    'reporter': 20,
+    'developer': 30,
+    'maintainer': 40,
+    'owner': 50,
+}
 
-def flush_caches():
-    groupDataCache.flush()
-    userDataCache.flush()
-    getAllGroupsWithDomainsCache.flush()
-    logging.info('gitlab_helpers.flush_caches')
+
+def apply_member_event(payload: Dict) -> bool:
+    '''
+    Applies a Gitlab group member system hook to the cached group membership,
+    rather than refetching everything.
+
+    Returns False if the payload isn't a member event, or the change couldn't
+    be applied. In that case the caller should call flush_caches(event_name).
+    '''
+    event_name = payload.get('event_name')
+    if event_name not in GITLAB_MEMBER_EVENTS:
+        return False
+    try:
+        group_id = payload['group_id']
+        user_id = payload['user_id']
+        membership = groupMembershipCache.get_data()
+        with _membership_lock:
+            applied = _apply_member_payload(membership, payload)
+            if _incoming_membership is not None and _incoming_membership is not membership:
+                # a crawl that's just finished, about to replace membership
+                _apply_member_payload(_incoming_membership, payload)
+    except Exception:
+        logging.exception(f'Unable to apply {event_name}')
+        return False
+    if not applied:
+        logging.warning(f'Unable to apply {event_name}, group {group_id} is not cached')
+        return False
+
+    if userDataCache.get_data().get(user_id) is None:
+        # a new user, so the users listing is out of date (membership is still current)
+        userDataCache.flush()
+    logging.info(f'gitlab_helpers.apply_member_event({event_name}, group={group_id}, user={user_id}) ' +
+                 f'version={membership.version}')
+    return True
+
+
+def _apply_member_payload(membership: GroupMembership, payload: Dict) -> bool:
+    if payload['event_name'] == 'user_remove_from_group':
+        return membership.apply_member_removal(payload['group_id'], payload['user_id'])
+    access_level = GITLAB_ACCESS_LEVELS[payload['group_access'].lower()]
+    return membership.apply_member_update(payload['group_id'], payload['user_id'], access_level)
+
+
+def cache_generation():
+    '''
+    Changes whenever the cached Gitlab data changes: a refresh of the users,
+    groups or membership caches, or a membership change from a system hook.
+    '''
+    membership = groupMembershipCache.get_data()
+    userDataCache.get_data()
+    groupDataCache.get_data()
+    return (userDataCache.generation, groupDataCache.generation,
+            groupMembershipCache.generation, membership.version)
 
 
 def get_all_user_emails() -> Dict:
-    users = userDataCache.get_data()  # gl.users.list(all=True)
-    all_user_emails = {}
-    for user in users:
-        if user.state != 'active':
-            continue
-        all_user_emails[user.email] = {'is_admin': user.is_admin}
-    # pp.pprint(all_user_emails)
-    return all_user_emails
+    '''
+    Returns {email: {'is_admin': bool}} for all active users.
+    This is the prebuilt directory index, so callers must not modify it.
+    '''
+    return userDataCache.get_data().active_emails
+
+
+def _group_data_generation():
+    groupDataCache.get_data()
+    return groupDataCache.generation
+
+
+def buildGroupEmailIndex() -> GroupEmailIndex:
+    return GroupEmailIndex(groupDataCache.get_data(), constants.DOMAIN)
+
+
+# group email <-> group id <-> group, rebuilt from each groups listing. All the
+# lookups by group email (with or without the domain) go through this index
+groupEmailIndexCache = GenerationCache(buildGroupEmailIndex, _group_data_generation)
 
 
 def get_groups_by_email():
-    results = {}
-    # Get all groups
-    # groups = groupDataCache.get_data() #gl.groups.list(all=True)
-    groups = gl.groups.list(all=True)
-    # Iterate over the groups and print their names
-    for group in groups:
-        # make an email address from the group name. Extract only letters and numbers and dots from the group name.
-        full_path = group.full_path.replace('/', '.').replace(' ', '-')
-        group_name = ''.join(e for e in full_path if e.isalnum() or e == '.' or e == '-').lower()
-        group_email = group_name + '@' + constants.DOMAIN
-        results[group_email] = {'id': group.id, 'name': group_name, 'email': group_email, 'group': group}
-    return results
+    '''
+    Returns {group email: {'id', 'name', 'email', 'group'}}
+    '''
+    return groupEmailIndexCache.get_data().by_email
 
 
-groupEmailCache = DataCache(get_groups_by_email, constants.GITLAB_CACHE_TIMEOUT_SECONDS)
+groupEmailCache = GenerationCache(get_groups_by_email, _group_data_generation)
 
 
 def get_group_by_email(email):
@@ -74,96 +384,80 @@ def get_group_by_email(email):
         return groups[email]
     return None
 
-def get_parent_groups(gl, group):
-    parent_groups = []
-    while group.parent_id:
-        group = gl.groups.get(group.parent_id)
-        parent_groups.append(group)
-    return parent_groups
 
-def get_group_and_ancestors_members(group, filter_access_level=None):
-    results = set()
-    members = group.members.list()
-    users = userDataCache.get_data()
-    for member in members:
-        # access level is by group, so users can be in multiple groups at different access levels
-        # access_level = member.access_level
-        if filter_access_level is not None:
-            if member.access_level < filter_access_level:
-                continue
-        user = None
-        for u in users:
-            if u.id == member.id:
-                user = u
-                break
-        if not user:
-            continue
-        if user.state != 'active':
-            continue
-        # name = member.name
-        email = user.email
+def buildSenderAuthorizationIndex() -> SenderAuthorizationIndex:
+    group_ids_by_email = {group_email: g['id'] for group_email, g in groupEmailIndexCache.get_data().by_email.items()}
+    return SenderAuthorizationIndex(group_ids_by_email, groupMembershipCache.get_data(), userDataCache.get_data())
 
-        results.add(email)
 
-    parent_groups = get_parent_groups(gl, group)
+# group email -> permitted senders, rebuilt for each cache generation
+senderAuthorizationCache = GenerationCache(buildSenderAuthorizationIndex, lambda: cache_generation())
 
-    print("\nParent Groups:")
-    for parent in parent_groups:
-        results.update(get_group_and_ancestors_members(parent, filter_access_level=filter_access_level))
-    return results
 
-def get_group_member_emails(group, recursive=True, filter_access_level=None):
-    results = set()
+def get_authorized_senders(group_emails: Sequence[str]) -> Dict[str, List[str]]:
+    '''
+    Returns {group email: sorted emails of the users allowed to send to it}
+    '''
+    index = senderAuthorizationCache.get_data()
+    return {group_email: sorted(index.senders(group_email)) for group_email in group_emails}
+
+
+def get_parent_groups(group):
+    '''
+    Returns all ancestors of the group, nearest parent first
+    '''
+    return groupDataCache.get_data().ancestors(_group_id(group))
+
+
+def _group_id(group):
+    # accept either a group object, or its attributes dictionary
+    if isinstance(group, dict):
+        return group['id']
+    return group.id
+
+
+def buildMembershipBitsets() -> MembershipBitsets:
+    return MembershipBitsets(groupMembershipCache.get_data(), userDataCache.get_data())
+
+
+# transitive group members as bitsets over the user directory, rebuilt for each cache generation
+membershipBitsetsCache = GenerationCache(buildMembershipBitsets, lambda: cache_generation())
+
+
+def _active_user_emails(member_ids) -> EmailSet:
     users = userDataCache.get_data()
-    #members = group.members_all.list(get_all=False)
-    members = group.members.list(get_all=True)
-
-    for member in members:
-        # access level is by group, so users can be in multiple groups at different access levels
-        # access_level = member.access_level
-        if filter_access_level is not None:
-            if member.access_level < filter_access_level:
-                continue
-        user = None
-        for u in users:
-            if u.id == member.id:
-                user = u
-                break
-        if not user:
-            continue
-        if user.state != 'active':
-            continue
-        # name = member.name
-        email = user.email
+    return EmailSet(users.bits(member_ids), users)
 
-        results.add(email)
 
-    if recursive:
-        descendant_groups = group.descendant_groups.list()
-        for g in descendant_groups:
-            desc_group = gl.groups.get(g.id)
-            results = results.union(get_group_member_emails(group=desc_group, 
-                                                            recursive=recursive, 
-                                                            filter_access_level=filter_access_level))
+def get_group_and_ancestors_members(group, filter_access_level=None):
+    '''
+    Returns the emails of active users that are direct members of the group or any of its ancestors
+    '''
+    membership = groupMembershipCache.get_data()
+    # access level is by group, so users can be in multiple groups at different access levels
+    members = membership.members_with_ancestors(_group_id(group), filter_access_level=filter_access_level)
+    return _active_user_emails(members)
 
-    return results
 
+def get_group_member_emails(group, recursive=True, filter_access_level=None):
+    '''
+    Returns the emails of active users that are members of the group, or (if recursive) any of its subgroups
+    '''
+    if filter_access_level is None:
+        bitsets = membershipBitsetsCache.get_data()
+        return bitsets.emails(bitsets.members(_group_id(group), recursive=recursive))
+    membership = groupMembershipCache.get_data()
+    members = membership.members(_group_id(group), recursive=recursive, filter_access_level=filter_access_level)
+    return _active_user_emails(members)
 
-def get_group_members_list(group, recursive=True, filter_access_level=None):
-    results = set()
-    members = group.members.list(get_all=True)
-    for member in members:
-        if filter_access_level is not None:
-            if member.access_level < filter_access_level:
-                continue
 
-        results.add(member)
-    if recursive:
-        descendant_groups = group.descendant_groups.list()
-        for g in descendant_groups:
-            desc_group = gl.groups.get(g.id)
-            results = results.union(get_group_members_list(desc_group, recursive, filter_access_level))
-    return results
+def get_group_members_list(group, recursive=True, filter_access_level=None) -> Dict[int, int]:
+    '''
+    Returns {user id: access level} for members of the group, or (if recursive) any of its subgroups.
+    Where a user is in several of those groups, their highest access level is used.
+    '''
+    membership = groupMembershipCache.get_data()
+    return membership.members(_group_id(group), recursive=recursive, filter_access_level=filter_access_level)
 
 
 # Create a GitLab API client
@@ -171,17 +465,19 @@ def get_all_groups(add_domain=False, recursive=True) -> Dict:
     group_members = {}
 
     # Get all groups
-    groups = groupDataCache.get_data()  # gl.groups.list(all=True)
+    groups = groupEmailIndexCache.get_data()
     # need to get list of users to get email addresses
     users = userDataCache.get_data()  # gl.users.list(all=True)
 
+    # fetch the direct members of every group concurrently, each group's
+    # members (and subgroup members) are then resolved from the cache
+    groupMembershipCache.get_data().prefetch([entry['id'] for entry in groups],
+                                             max_workers=constants.GITLAB_MAX_CONCURRENCY)
+
     # Iterate over the groups and print their names
-    for group in groups:
-        # make an email address from the group name. Extract only letters and numbers and dots from the group name.
-        full_path = group.full_path.replace('/', '.').replace(' ', '-')
-        group_email = ''.join(e for e in full_path if e.isalnum() or e == '.' or e == '-').lower()
-        if add_domain:
-            group_email = group_email + '@' + constants.DOMAIN
+    for entry in groups:
+        group = entry['group']
+        group_email = entry['email'] if add_domain else entry['name']
 
         # print('Group: %s - %s' % (group.name, group_email))
         members = get_group_members_list(group, recursive)
@@ -191,35 +487,37 @@ def get_all_groups(add_domain=False, recursive=True) -> Dict:
             'info': group.attributes,
             'members': {}
         }
-        for member in members:
+        for member_id, access_level in members.items():
             # user = gl.users.get(member.id)
-            user = None
-            for u in users:
-                if u.id == member.id:
-                    user = u
-                    break
+            user = users.get_active(member_id)
             if not user:
                 continue
-            if user.state != 'active':
-                continue
             # name = member.name
             email = user.email
             # access level is by group, so users can be in multiple groups at different access levels
-            access_level = member.access_level
             # print('  %s - %s' % (name, email))
             group_members[group_email]['members'][email] = {'access_level': access_level}
+
+    # the snapshot isn't saved here, as this is rebuilt on every membership change; the
+    # periodic crawl (see buildGitlabGroupMembership) and shutdown save it
     return group_members
 
 
-getAllGroupsWithDomainsCache = DataCache(get_all_groups,
-                                         constants.GITLAB_CACHE_TIMEOUT_SECONDS,
-                                         add_domain=True,
-                                         recursive=True)
+def get_all_groups_without_domains() -> Dict:
+    '''
+    get_all_groups(add_domain=False), keyed from the cached groups with domains
+    '''
+    return {group_email.rsplit('@', 1)[0]: group
+            for group_email, group in getAllGroupsWithDomainsCache.get_data().items()}
+
+
+# views over the group email index, rebuilt for each cache generation
+getAllGroupsWithDomainsCache = GenerationCache(get_all_groups,
+                                               lambda: cache_generation(),
+                                               add_domain=True,
+                                               recursive=True)
 
-getAllGroupsWithoutDomainsCache = DataCache(get_all_groups,
-                                         constants.GITLAB_CACHE_TIMEOUT_SECONDS,
-                                         add_domain=False,
-                                         recursive=True)
+getAllGroupsWithoutDomainsCache = GenerationCache(get_all_groups_without_domains, lambda: cache_generation())
 
 
 def get_group_members_direct(group_name, recursive=True, access_level=None):
@@ -246,7 +544,7 @@ def get_group_members(group_list: List[str]) -> GroupMembers:
     group_members = {}
 
     # Get all groups
-    groups = groupDataCache.get_data()  # gl.groups.list(all=True)
+    groups = groupEmailIndexCache.get_data()
     users = userDataCache.get_data()  # gl.users.list(all=True)
     emails = set()
     group_info = {}
@@ -263,14 +561,15 @@ def get_group_members(group_list: List[str]) -> GroupMembers:
         group_list.remove(group_email)
 
     if len(group_list) > 0:
-        # Iterate over the groups and print their names
-        for group in groups:
-            # make an email address from the group name. Extract only letters and numbers from the group name.
-            full_path = group.full_path.replace('/', '.').replace(' ', '-')
-            group_email = ''.join(e for e in full_path if e.isalnum() or e == '.' or e == '-').lower()
-            if group_email not in group_list:
-                # print('Group [%s] not in group list [%s]' % (group_email, group_list))
-                continue
+        membership = groupMembershipCache.get_data()
+        # fetch the direct members of the requested groups concurrently
+        entries = [groups.get_by_name(group_email) for group_email in dict.fromkeys(group_list)]
+        entries = [entry for entry in entries if entry is not None]
+        membership.prefetch([entry['id'] for entry in entries],
+                            max_workers=constants.GITLAB_MAX_CONCURRENCY)
+        for entry in entries:
+            group = entry['group']
+            group_email = entry['name']
             # group_url = group.web_url
             group_info[group_email] = {
                 'full_name': group.full_name,
@@ -278,15 +577,11 @@ def get_group_members(group_list: List[str]) -> GroupMembers:
             }
             group_list.remove(group_email)
             # print('Group: %s - %s' % (group.name, group_email))
-            members = group.members.list(all=True)
+            members = membership.direct_members(group.id)
             group_members[group_email] = []
-            for member in members:
+            for member_id in members:
                 # user = gl.users.get(member.id)
-                user = None
-                for u in users:
-                    if u.id == member.id:
-                        user = u
-                        break
+                user = users.get(member_id)
                 if not user:
                     continue
                 # name = member.name
@@ -299,19 +594,53 @@ def get_group_members(group_list: List[str]) -> GroupMembers:
 
 
 class Recipients(TypedDict):
-    groups: List[str]
-    group_emails: List[str]
-    send_to: List[str]
-    valid: List[str]
-    invalid_access_groups: List[str]
+    groups: Sequence[str]
+    group_emails: frozenset
+    send_to: EmailSet
+    valid: frozenset
+    invalid_access_groups: frozenset
+
+
+RECIPIENTS_CACHE_SIZE = 1024
+
+
+def buildRecipientsLookup():
+    # memoized for one cache generation, so a new generation starts with an empty memo
+    return functools.lru_cache(maxsize=RECIPIENTS_CACHE_SIZE)(_frozen_recipients)
+
+
+def _frozen_recipients(to_addr: frozenset, sender, as_groups) -> Recipients:
+    results = _groups_to_recipients(sorted(to_addr), as_groups=as_groups, sender=sender)
+    # send_to is an EmailSet, which is already read only
+    results['groups'] = tuple(results['groups'])
+    for k in ('group_emails', 'valid', 'invalid_access_groups'):
+        results[k] = frozenset(results[k])
+    return results
+
+
+# (recipient addresses, sender, as_groups) -> Recipients, rebuilt for each cache generation
+recipientsCache = GenerationCache(buildRecipientsLookup, lambda: cache_generation())
+
 
 def groups_to_recipients(mail_to: Sequence[str], as_groups=False, sender=None) -> Recipients:
     '''
     Parses out a list of email addresses and identifies any Gitlab user email
     addresses that are included in those groups.
     Returns the list of valid groups, and the user email addresses
+
+    Results are cached until the Gitlab membership changes. The returned values are
+    shared with the cache, so they are immutable (groups is a tuple, the rest are frozen sets).
     '''
-    recipients = set()
+    to_addr = frozenset(email for name, email in getaddresses(mail_to))
+    if sender is not None:
+        (sender_name, sender) = parseaddr(sender)
+    return dict(recipientsCache.get_data()(to_addr, sender, as_groups))
+
+
+def _groups_to_recipients(mail_to: Sequence[str], as_groups=False, sender=None) -> Recipients:
+    # recipients are unioned as bitsets, and only listed as emails when they're used
+    bitsets = membershipBitsetsCache.get_data()
+    recipient_bits = 0
 
     groups: list[str] = []
     group_emails: set[str]=set()
@@ -356,7 +685,7 @@ def groups_to_recipients(mail_to: Sequence[str], as_groups=False, sender=None) -
                     logging.error(f'{sender} is not authorized to send to group {target}')
                     continue
                         
-                recipients.update(all_users.keys())
+                recipient_bits |= bitsets.users.active_bits
                 groups.append('+all')
                 group_emails.add(target)
                 logging.info('send to all users')
@@ -370,21 +699,19 @@ def groups_to_recipients(mail_to: Sequence[str], as_groups=False, sender=None) -
                     #                                    recursive=False, 
                     #                                    inherited=True,
                     #                                    filter_access_level=None)
-                    group_senders = get_group_and_ancestors_members(group=group_info['group'])
-                    if sender not in group_senders:
+                    sender_authorizations = senderAuthorizationCache.get_data()
+                    if not sender_authorizations.is_authorized(target, sender):
                         invalid_access_groups.add(target)
                         logging.error(f'{sender} is not authorized to send to group {target}')
-                        logging.info(group_senders)
+                        logging.info(sender_authorizations.senders(target))
                         continue
 
                 # recursive members receive
-                group_members = get_group_member_emails(group=group_info['group'], 
-                                                        recursive=True, 
-                                                        filter_access_level=None)
+                group_members = bitsets.members(group_info['id'], recursive=True)
                 groups.append(group_info['name'])
                 group_emails.add(target)
-                recipients.update(group_members)
-                logging.debug(group_members)
+                recipient_bits |= group_members
+                logging.debug(f'{target} has {group_members.bit_count()} members')
             else:
                 logging.error(f'Group not found {target}')
         except Exception as e:
@@ -395,23 +722,55 @@ def groups_to_recipients(mail_to: Sequence[str], as_groups=False, sender=None) -
                 traceback.print_exception(type(e), e, e.__traceback__)
     if len(invalid_groups) > 0:
         logging.error(f'groups_to_recipients(groups={groups}) Invalid => {invalid_groups}')
-    logging.debug(f'groups_to_recipients(groups={groups}) => recipients={recipients})')
+    logging.debug(f'groups_to_recipients(groups={groups}) => {recipient_bits.bit_count()} recipients')
 
     # If a recepient was in the original envelope, then don't send
     # from this system because they'll receive multiple copies
-    recipients = recipients - valid_addresses
+    recipients = bitsets.emails(recipient_bits) - valid_addresses
 
     return {'groups': groups, 'group_emails':group_emails, 'valid': valid_addresses, 'send_to': recipients, 'invalid_access_groups': invalid_access_groups}
 
 
 class MessageData(TypedDict):
-    message_content: str
     message_content_object: email.message.Message
     recipients: Recipients
 
-def clean_email_message(mail_from:str, to_addr:Sequence[str], message_content: str) -> MessageData | None:# -> aiosmtpd.smtp.EmailMessage
+
+def message_sender(mail_from: str, message: email.message.Message) -> str:
+    '''
+    The sender a message is authorized as: mail_from, unless the message was relayed
+    from DEFAULT_FROM, in which case the original sender from its headers.
+    Only the headers of message are used, so it can be parsed with a header parser.
+    '''
+    if mail_from != constants.DEFAULT_FROM:
+        return mail_from
+    if 'Reply-To' in message:
+        return parseaddr(message['Reply-To'])[1]
+    if message['From'] != constants.DEFAULT_FROM:
+        # clean_email_message adds this as the Reply-To
+        return parseaddr(message['From'])[1]
+    if 'X-Original-Sender' in message:
+        return parseaddr(message['X-Original-Sender'])[1]
+    return mail_from
+
+
+def message_recipients(mail_from: str, to_addr: Sequence[str], message: email.message.Message) -> Recipients:
+    '''
+    Who a message to to_addr goes to, checking the sender may send to each group.
+    Only the headers of message are used.
+    '''
+    mail_from = message_sender(mail_from, message)
+    if mail_from not in constants.EXPLICIT_ALLOW_EMAILS:
+        return groups_to_recipients(mail_to=to_addr, sender=mail_from)
+    # allow certain senders to send to any group
+    return groups_to_recipients(mail_to=to_addr)
+
+
+def clean_email_message(mail_from: str, to_addr: Sequence[str], message_content: str | bytes | email.message.Message,
+                        recipients: Recipients = None) -> MessageData | None:  # -> aiosmtpd.smtp.EmailMessage
     '''
     Modifies the provided email message to a form appropriate for storage and forwarding.
+    recipients is message_recipients(), if the caller already has it.
 
     Returns the updated message, actual To list for the envelope 
     '''
@@ -441,6 +800,10 @@ def clean_email_message(mail_from:str, to_addr:Sequence[str], message_content: s
         "Source",
         "Sender"
     ]
+    groups = recipients
+    if groups is None:
+        groups = message_recipients(mail_from, to_addr, message)
+
     # Strip out the ARC and DKIM headers
     for header in strip_headers:
         try:
@@ -454,25 +817,6 @@ def clean_email_message(mail_from:str, to_addr:Sequence[str], message_content: s
         message.replace_header("From", constants.DEFAULT_FROM)
         message.add_header("Reply-To", original_from)
         message.add_header("X-Original-Sender", original_from)
-    else:
-        if 'Reply-To' in message:
-            (sender_name, sender) = parseaddr(message['Reply-To']) 
-            original_from = sender
-    if mail_from == constants.DEFAULT_FROM:
-        if 'Reply-To' in message:
-            (sender_name, sender) = parseaddr(message['Reply-To']) 
-            mail_from = sender
-        elif 'X-Original-Sender' in message:
-            (sender_name, sender) = parseaddr(message['X-Original-Sender']) 
-            mail_from = sender
-
-    groups: list[str] = []
-
-    if mail_from not in constants.EXPLICIT_ALLOW_EMAILS:
-        groups = groups_to_recipients(mail_to=to_addr, sender=mail_from)
-    else:
-        # allow certain senders to send to any group
-        groups = groups_to_recipients(mail_to=to_addr)
 
     # Replace the message body To: with only the groups we are sending to
     try:
@@ -568,8 +912,8 @@ def clean_email_message(mail_from:str, to_addr:Sequence[str], message_content: s
                 logging.exception(e)
                 logging.exception(traceback.format_exc())
                 
+    # the message stays parsed; it's rendered once, when it's sent
     return {
-        'message': message.as_string(),
         'message_content_object': message,
         'recipients': groups
     }
@@ -0,0 +1,61 @@
+'''
+Compact records for the Gitlab users and groups kept in the caches.
+
+A python-gitlab RESTObject keeps every attribute Gitlab returned (around 40 for a
+user), plus a manager reference and instance dicts. Timelord only reads the few
+attributes below, so the caches keep these slotted records instead, with
+strings interned so repeated values (states, path prefixes) are stored once.
+'''
+import sys
+from typing import Dict
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class _Record:
+    __slots__ = ()
+
+    def __init__(self, **attributes):
+        for field in self.__slots__:
+            object.__setattr__(self, field, _intern(attributes.get(field)))
+
+    @classmethod
+    def from_object(cls, o):
+        '''
+        Copies the record's fields from a python-gitlab object, or any object with those attributes
+        '''
+        return cls(**{field: getattr(o, field, None) for field in cls.__slots__})
+
+    @classmethod
+    def from_attributes(cls, attributes: Dict):
+        return cls(**attributes)
+
+    @property
+    def attributes(self) -> Dict:
+        '''
+        The fields as a new dict, like RESTObject.attributes
+        '''
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __setattr__(self, name, value):
+        # shared between threads and cache generations, so read only
+        raise AttributeError(f'{type(self).__name__} is read only')
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.attributes == other.attributes
+
+    def __hash__(self):
+        return hash((type(self), self.id))
+
+    def __repr__(self):
+        return f'<{type(self).__name__} id:{self.id}>'
+
+
+class UserRecord(_Record):
+    __slots__ = ('id', 'username', 'name', 'email', 'state', 'is_admin')
+
+
+class GroupRecord(_Record):
+    __slots__ = ('id', 'name', 'full_name', 'full_path', 'parent_id', 'web_url')
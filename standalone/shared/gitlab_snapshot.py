@@ -0,0 +1,69 @@
+'''
+Persists the Gitlab directory (users, groups and group membership) to a file,
+so the caches can be loaded at startup instead of waiting on a full crawl.
+'''
+from datetime import datetime
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, TypedDict
+
+from shared.gitlab_records import UserRecord, GroupRecord
+
+SNAPSHOT_VERSION = 1
+
+# The only attributes Timelord reads from Gitlab users and groups
+USER_FIELDS = UserRecord.__slots__
+GROUP_FIELDS = GroupRecord.__slots__
+
+
+class Snapshot(TypedDict):
+    version: int
+    saved_at: str
+    users: List[Dict]
+    groups: List[Dict]
+    # group id -> {user id: access level}
+    members: Dict[int, Dict[int, int]]
+
+
+def to_records(objects: Iterable, fields: Iterable[str]) -> List[Dict]:
+    return [{field: getattr(o, field, None) for field in fields} for o in objects]
+
+
+def save(path: str, users: List[Dict], groups: List[Dict], members: Dict[int, Dict[int, int]]):
+    '''
+    Writes the snapshot. The file is replaced atomically, so a crash never leaves a partial snapshot.
+    '''
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': datetime.now().isoformat(),
+        'users': users,
+        'groups': groups,
+        'members': {str(group_id): {str(user_id): level for user_id, level in m.items()}
+                    for group_id, m in members.items()},
+    }
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+
+def load(path: str) -> Snapshot | None:
+    '''
+    Returns the snapshot, or None if there isn't a usable one
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except Exception:
+        logging.exception(f'Unable to read Gitlab snapshot {path}')
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        logging.warning(f'Ignoring Gitlab snapshot {path} with version {snapshot.get("version")}')
+        return None
+    # json keys are always strings
+    snapshot['members'] = {int(group_id): {int(user_id): level for user_id, level in m.items()}
+                           for group_id, m in snapshot['members'].items()}
+    return snapshot
@@ -0,0 +1,243 @@
+'''
+The HTTP transport under gitlab_helpers.gl.
+
+Every Gitlab API request goes through GitlabTransportAdapter, which:
+- holds requests to a global budget (requests per second, with bursts)
+- honours Gitlab's RateLimit-* and Retry-After headers, pausing all requests
+  (not just the one that was throttled) until the limit resets
+- repeats GET requests with If-None-Match, and answers from its own copy when
+  Gitlab says the listing hasn't changed (304)
+- stops sending requests while Gitlab is failing (see CircuitBreaker), raising
+  GitlabUnavailableError straight away so callers can fall back to cached data
+- counts calls and latency per endpoint, see stats()
+'''
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+from typing import Dict, NamedTuple
+from urllib.parse import urlsplit
+
+import requests
+
+from shared.circuitbreaker import CircuitBreaker
+from shared.ratelimit import TokenBucket
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# never pause longer than this for a rate limit, in case of a bad reset time
+MAX_PAUSE_SECONDS = 60
+# headers that describe the encoded body, not the content that is cached
+_BODY_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding')
+
+
+def endpoint_name(method: str, url: str) -> str:
+    '''
+    The endpoint of a request for reporting, e.g. 'GET /groups/:id/members'
+    '''
+    path = urlsplit(url).path
+    path = re.sub(r'^.*/api/v4', '', path)
+    # ids and url encoded paths
+    path = re.sub(r'/(\d+|[^/]*%2F[^/]*)(?=/|$)', '/:id', path)
+    return f'{method} {path}'
+
+
+class GitlabUnavailableError(requests.exceptions.ConnectionError):
+    '''
+    Raised without sending the request while the Gitlab circuit is open
+    '''
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    content: bytes
+    headers: Dict[str, str]
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.rate_limited = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # one count per LATENCY_BUCKETS_MS, plus one for anything slower
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, status_code, seconds, not_modified):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        if not_modified:
+            self.not_modified += 1
+        elif status_code == 429:
+            self.rate_limited += 1
+        elif status_code >= 400:
+            self.errors += 1
+        ms = 1000 * seconds
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'not_modified': self.not_modified,
+            'rate_limited': self.rate_limited,
+            'avg_ms': round(1000 * self.seconds / self.calls, 1) if self.calls else 0,
+            'max_ms': round(1000 * self.max_seconds, 1),
+            'histogram_ms': {f'<={bound}': count for bound, count in zip(LATENCY_BUCKETS_MS, self.histogram)} |
+                            {'>': self.histogram[-1]},
+        }
+
+
+class GitlabTransportAdapter(requests.adapters.HTTPAdapter):
+    '''
+    requests_per_second and burst set the global budget (0 is unlimited).
+    rate_limit_reserve is the fraction of Gitlab's limit kept in reserve: once fewer
+    requests than that remain, requests wait for the limit to reset.
+    etag_cache_size is the number of GET responses kept for conditional requests.
+    breaker is opened by connection errors, timeouts and 5xx responses.
+    Any other arguments are passed to HTTPAdapter.
+    '''
+    def __init__(self, requests_per_second=0, burst=None, rate_limit_reserve=0.1, etag_cache_size=1000,
+                 breaker: CircuitBreaker = None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = TokenBucket(requests_per_second, burst)
+        self.breaker = breaker or CircuitBreaker('Gitlab')
+        self.rate_limit_reserve = rate_limit_reserve
+        self.etag_cache_size = etag_cache_size
+        # time.monotonic() until which no requests are sent
+        self.paused_until = 0.0
+        self.pauses = 0
+        self.pause_seconds = 0.0
+        # the latest RateLimit-* headers
+        self.rate_limit: Dict[str, int] = {}
+        # url -> CachedResponse, least recently used first
+        self.etags: OrderedDict = OrderedDict()
+        self.endpoints: Dict[str, EndpointStats] = {}
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        if not self.breaker.allow():
+            raise GitlabUnavailableError(f'Gitlab circuit is open, not sending {request.method} {request.url}',
+                                         request=request)
+        self._wait()
+        cached = None
+        if request.method == 'GET' and self.etag_cache_size > 0:
+            with self.lock:
+                cached = self.etags.get(request.url)
+                if cached is not None:
+                    self.etags.move_to_end(request.url)
+            if cached is not None:
+                request.headers['If-None-Match'] = cached.etag
+
+        start = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.breaker.record_failure()
+            raise
+        elapsed = time.monotonic() - start
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        self._update_rate_limit(response)
+        not_modified = response.status_code == 304 and cached is not None
+        if not_modified:
+            # reads the (empty) body and releases the connection back to the pool, since
+            # callers only see the cached content
+            response.content
+            response.close()
+            self._from_cache(response, cached)
+        elif request.method == 'GET' and response.status_code == 200 and not kwargs.get('stream'):
+            self._cache(request.url, response)
+
+        with self.lock:
+            endpoint = endpoint_name(request.method, request.url)
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.record(response.status_code, elapsed, not_modified)
+        return response
+
+    def _wait(self):
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        self.budget.acquire()
+
+    def _pause(self, seconds, reason):
+        seconds = min(max(seconds, 0), MAX_PAUSE_SECONDS)
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until <= self.paused_until:
+                return
+            self.paused_until = until
+            self.pauses += 1
+            self.pause_seconds += seconds
+        logging.warning(f'Gitlab requests paused for {seconds:.1f}s: {reason}')
+
+    def _update_rate_limit(self, response):
+        headers = response.headers
+        if response.status_code == 429:
+            try:
+                retry_after = float(headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1
+            self._pause(retry_after, 'rate limited (429)')
+            return
+        if 'RateLimit-Remaining' not in headers:
+            return
+        try:
+            rate_limit = {name: int(headers[f'RateLimit-{name.capitalize()}'])
+                          for name in ('limit', 'remaining', 'reset') if f'RateLimit-{name.capitalize()}' in headers}
+        except ValueError:
+            return
+        self.rate_limit = rate_limit
+        limit = rate_limit.get('limit')
+        if limit and 'reset' in rate_limit and rate_limit['remaining'] <= limit * self.rate_limit_reserve:
+            # RateLimit-Reset is a unix time
+            self._pause(rate_limit['reset'] - time.time(), f'{rate_limit["remaining"]} of {limit} requests remaining')
+
+    def _cache(self, url, response):
+        etag = response.headers.get('ETag')
+        if not etag:
+            return
+        headers = {k: v for k, v in response.headers.items() if k not in _BODY_HEADERS}
+        with self.lock:
+            self.etags[url] = CachedResponse(etag, response.content, headers)
+            self.etags.move_to_end(url)
+            while len(self.etags) > self.etag_cache_size:
+                self.etags.popitem(last=False)
+
+    @staticmethod
+    def _from_cache(response, cached: CachedResponse):
+        # Gitlab said the listing hasn't changed, so callers see the original response
+        response.status_code = 200
+        response.reason = 'OK'
+        response._content = cached.content
+        for k, v in cached.headers.items():
+            if k not in response.headers:
+                response.headers[k] = v
+
+    def stats(self):
+        with self.lock:
+            endpoints = {endpoint: stats.to_dict() for endpoint, stats in sorted(self.endpoints.items())}
+            return {
+                'endpoints': endpoints,
+                'calls': sum(e['calls'] for e in endpoints.values()),
+                'rate_limit': dict(self.rate_limit),
+                'pauses': self.pauses,
+                'pause_seconds': round(self.pause_seconds, 1),
+                'etag_cache_entries': len(self.etags),
+                'circuit': self.breaker.stats(),
+            }
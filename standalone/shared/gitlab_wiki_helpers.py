@@ -21,6 +21,24 @@ def get_calendar_project():
     return project
 
 
+def save_wiki_page(project, page_slug, content):
+    '''
+    Creates or updates a wiki page, skipping the update if the content hasn't changed.
+    This makes blocking Gitlab calls, so call it through gitlab_helpers.run_async
+    '''
+    try:
+        page = project.wikis.get(page_slug)
+        if page.content == content:
+            # no changes, so skip update
+            return
+        page.content = content
+    except Exception:
+        # create the page
+        page = project.wikis.create({'title': page_slug,
+                                    'content': content})
+    page.save()
+
+
 def to_html_ul(elements):
     string = "<ul>"
     string += "".join(["<li>" + str(s) + "</li>" for s in elements])
@@ -55,10 +73,10 @@ async def update_wiki_distrolists():
     page_slug = 'Distribution Lists'
     logging.info(f'update_wiki_distrolists: Updating {page_slug}')
     try:
-        project = get_calendar_project()
+        project = await gitlab_helpers.run_async(get_calendar_project)
         # Get all distro lists
         #groups = gitlab_helpers.get_all_groups(True, True)
-        groups = gitlab_helpers.getAllGroupsWithDomainsCache.get_data()
+        groups = await gitlab_helpers.run_async(gitlab_helpers.getAllGroupsWithDomainsCache.get_data)
 
         # logging.info(groups)
         content = "<!-- WARNING: Do not edit this page. Timelord will overwrite changes the next time it runs.-->"
@@ -80,18 +98,7 @@ async def update_wiki_distrolists():
 '''
         content += "</table>"
 
-        try:
-            page = project.wikis.get(page_slug)
-            if page.content == content:
-                # no changes, so skip update
-                return
-            page.content = content
-            # logging.info(f'Updating {page_slug} DONE')
-        except Exception as e:
-            # Create
-            page = project.wikis.create({'title': page_slug,
-                                        'content': content})
-        page.save()
+        await gitlab_helpers.run_async(save_wiki_page, project, page_slug, content)
     finally:
         logging.info(f'Updating {page_slug} DONE')
 
@@ -102,10 +109,10 @@ async def delete_all_calendar_pages(project):
     '''
     logging.info('delete_all_calendar_pages: Start')
     try:
-        pages = project.wikis.list()
+        pages = await gitlab_helpers.run_async(project.wikis.list, get_all=True)
         for p in pages:
             if p.slug[:8]=='meetings':
-                p.delete()
+                await gitlab_helpers.run_async(p.delete)
     except Exception as e:
             logging.error(e)
             logging.exception(traceback.format_exc())
@@ -132,12 +139,9 @@ async def update_wiki_calendar_invite_page(project, meeting, cal, events,
         email_body = ''
 
         try:
-            # email_content=m['email'].decode('utf-8', errors='replace')
-            msg = meeting['email']
-            msg = msg[2:-1]  # Removing the leading b' and trailing '
-            msg_bytes = msg.encode().decode('unicode_escape').encode()
+            # the message as received (older meetings are converted by the database)
             parser = BytesParser(policy=policy.default)
-            email_message = parser.parsebytes(msg_bytes)
+            email_message = parser.parsebytes(meeting['email'])
 
             email_body = get_email_body(email_message)
         except Exception as e:
@@ -151,19 +155,7 @@ async def update_wiki_calendar_invite_page(project, meeting, cal, events,
         for entry in meeting_invites_sent:
             content += f" - {entry}\n"
 
-        try:
-            page = project.wikis.get(page_slug)
-            if page.content == content:
-                # no changes, so skip update
-                return
-            page.content = content
-            page.save()
-        except Exception as e:
-            # create the page
-            page = project.wikis.create({
-                                        'title': page_slug,
-                                        'content': content})
-            page.save()
+        await gitlab_helpers.run_async(save_wiki_page, project, page_slug, content)
     except Exception as e:
         logging.exception(e)
         logging.exception(traceback.format_exc())
@@ -176,13 +168,15 @@ async def update_wiki_group_page(group_email, group_info):
     '''
     page_slug = f"groups/{group_email}"
     logging.info(f'update_wiki_group_page: Updating {page_slug}')
-    project = get_calendar_project()
+    project = await gitlab_helpers.run_async(get_calendar_project)
 
     # get group info
-    authorized_senders = gitlab_helpers.get_group_and_ancestors_members(group_info['info'])
-    group_members = gitlab_helpers.get_group_member_emails(group=group_info['info'], 
-                                            recursive=True, 
-                                            filter_access_level=None)
+    authorized_senders = await gitlab_helpers.run_async(gitlab_helpers.get_group_and_ancestors_members,
+                                                        group_info['info'])
+    group_members = await gitlab_helpers.run_async(gitlab_helpers.get_group_member_emails,
+                                                   group=group_info['info'],
+                                                   recursive=True,
+                                                   filter_access_level=None)
     
     content=f'''
 # {group_info['info']['name']}
@@ -221,19 +215,7 @@ async def update_wiki_group_page(group_email, group_info):
 </table>
 '''
 
-        try:
-            page = project.wikis.get(page_slug)
-            if page.content == content:
-                # no changes, so skip update
-                return
-            page.content = content
-            page.save()
-        except Exception as e:
-            # create the page
-            page = project.wikis.create({
-                                        'title': page_slug,
-                                        'content': content})
-            page.save()
+        await gitlab_helpers.run_async(save_wiki_page, project, page_slug, content)
     except Exception as e:
         logging.exception(e)
         logging.exception(traceback.format_exc())
@@ -303,11 +285,11 @@ async def update_wiki_calendar_all():
     try:
         # await update_wiki_calendar_distrolists()
 
-        groups = gitlab_helpers.getAllGroupsWithoutDomainsCache.get_data()
+        groups = await gitlab_helpers.run_async(gitlab_helpers.getAllGroupsWithoutDomainsCache.get_data)
         for g in groups:
             await update_wiki_group_page(g, groups[g])
             
-        project = get_calendar_project()
+        project = await gitlab_helpers.run_async(get_calendar_project)
         await delete_all_calendar_pages(project)
 
         # get calendars saved in database
@@ -334,17 +316,7 @@ async def update_wiki_calendar_all():
 
             content += "</table>"
 
-        try:
-            page = project.wikis.get(page_slug)
-            if page.content == content:
-                # no changes, so skip update
-                return
-            page.content = content
-        except Exception:
-            # create the page
-            page = project.wikis.create({'title': page_slug,
-                                        'content': content})
-        page.save()
+        await gitlab_helpers.run_async(save_wiki_page, project, page_slug, content)
     finally:
         logging.info(f'update_wiki_calendar_all: Updating {page_slug} DONE')
 
@@ -6,24 +6,63 @@ from email.mime.text import MIMEText
 from email.parser import BytesParser
 from email.message import Message
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import re
-from typing import Sequence, TypedDict
+from typing import Dict, List, Sequence, Tuple, TypedDict
 from icalendar import Calendar
-from email import policy, message_from_string
+from email import policy, message_from_bytes, message_from_string
 import logging
 from datetime import datetime, timedelta, timezone
 import dateutil.rrule
 import os
+import threading
 import traceback
 import smtplib
 from database import TLDatabase
 import shared.constants as constants
+from shared.relay_governor import RelayGovernor
+from shared.smtp_pool import SMTPConnectionPool
+from shared.smtp_relays import Relay, SMTPRelays, parse_relays
 
 CHUNK_SIZE = 45
 
 db = TLDatabase()
 
+# smtplib is blocking, so messages sent from coroutines go out on these threads
+smtp_executor = ThreadPoolExecutor(max_workers=constants.SMTP_SEND_PARALLELISM, thread_name_prefix='smtp')
+
+_smtp_pool: SMTPRelays | None = None
+_smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool() -> SMTPRelays:
+    '''
+    The relays set by SMTP_RELAYS, or else the one set by the smtp_address and smtp_port
+    environment variables, each with its own pool of connections
+    '''
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            relays = parse_relays(constants.SMTP_RELAYS, constants.SMTP_POOL_SIZE) or [
+                (os.environ.get("smtp_address"), os.environ.get("smtp_port"), 1, constants.SMTP_POOL_SIZE)]
+            _smtp_pool = SMTPRelays([
+                Relay(SMTPConnectionPool(host, port,
+                                         os.environ.get("smtp_user_name"),
+                                         os.environ.get("smtp_password"),
+                                         max_size=connections,
+                                         idle_timeout_seconds=constants.SMTP_IDLE_TIMEOUT_SECONDS),
+                      weight,
+                      # every relay is paced separately
+                      RelayGovernor(constants.SMTP_RECIPIENTS_PER_SECOND, constants.SMTP_MESSAGES_PER_SECOND))
+                for host, port, weight, connections in relays])
+        return _smtp_pool
+
+
+def close_smtp_pool():
+    if _smtp_pool is not None:
+        _smtp_pool.close_all()
+
 
 def append_footer(email_content, footer):
     try:
@@ -93,39 +132,102 @@ def append_footer(email_content, footer):
     return email_content
 
 
-def send_smtp(sender: str, receiver: str | Sequence[str], msg: str, additionalDetails:str='') -> Sequence[str]:
-    try:
-        logging.warn(f'send_smtp(sender={sender}, to={receiver})')
+class ChunkResult(TypedDict):
+    recipients: List[str]
+    # recipients the relay refused, as smtplib's sendmail returns them
+    refused: Dict[str, Tuple[int, bytes]]
+    # why the whole chunk wasn't sent, or None
+    error: str | None
+    # the relay's reply code for error, if it sent one
+    code: int | None
 
-        sent_success = set()
 
-        # Connect to the server and send the email.
-        host = os.environ.get("smtp_address")
-        port = os.environ.get("smtp_port")
-        smtp_username = os.environ.get("smtp_user_name")
-        smtp_password = os.environ.get("smtp_password")
+def chunk_recipients(receiver: Sequence[str]) -> List[List[str]]:
+    '''
+    Splits receiver into envelopes of at most CHUNK_SIZE recipients
+    '''
+    receiver = list(receiver)
+    return [receiver[i:i+CHUNK_SIZE] for i in range(0, len(receiver), CHUNK_SIZE)]
 
-        # make receiver into a list if it isn't one already
-        if isinstance(receiver, str):
-            receiver = [receiver]
-        else:
-            receiver = list(receiver)
 
-        # Ensure receive doesn't have any address destined for self server
-        removed =  [email for email in receiver if constants.DOMAIN in email]
-        receiver = [email for email in receiver if constants.DOMAIN not in email]
-        if len(removed)>0:
-            logging.error(f'The following destination emails were removed: {removed}')
-        if len(receiver) == 0 :
-            logging.error(f'There are no destination emails provdied, cancel send_smtp')
+def sent_recipients(results: Sequence[ChunkResult]) -> set:
+    '''
+    The recipients the relay accepted, from the results of send_chunk or send_chunks
+    '''
+    sent = set()
+    for result in results:
+        if result['error'] is None:
+            sent.update(email for email in result['recipients'] if email not in result['refused'])
+    return sent
+
+
+class PreparedMessage:
+    '''
+    A message on its way out: parsed once, with footers added to the parsed message,
+    and rendered once (see as_bytes) however many chunks and retries it's sent in.
 
+    message is a str, bytes or an email Message; a Message is used (and changed) as is.
+    '''
+    def __init__(self, message: 'str | bytes | Message | PreparedMessage'):
+        if isinstance(message, PreparedMessage):
+            message = message.message
+        elif isinstance(message, bytes):
+            message = message_from_bytes(message)
+        elif isinstance(message, str):
+            message = message_from_string(message)
+        self.message: Message = message
+        self._rendered: bytes = None
+
+    def add_footer(self, footer: str):
         try:
-            system_name = os.environ.get('BRANDING', 'Timelord')
-            gitlab_url = os.environ.get('gitlab_url', '')
-            gitlab_calendar_wiki_project_url = os.environ.get('GITLAB_CALENDAR_WIKI_PROJECT_URL', '%s/calendar/'%gitlab_url)
-                                                              
-            email_msg = message_from_string(msg)
-            email_msg = append_footer(email_msg, f'''
+            append_footer(self.message, footer)
+        except Exception as e:
+            logging.exception(e)
+            logging.exception(traceback.format_exc())
+        self._rendered = None
+
+    def as_bytes(self) -> bytes:
+        '''
+        The message as sent to the relay, rendered on first use
+        '''
+        if self._rendered is None:
+            try:
+                self._rendered = self.message.as_bytes()
+            except UnicodeEncodeError:
+                # parsed from a str with 8 bit text, which the bytes generator won't encode
+                self._rendered = self.message.as_string().encode('utf-8')
+        return self._rendered
+
+
+def delivery_plan(sender: str, receiver: str | Sequence[str], msg: str | bytes | Message | PreparedMessage,
+                  additionalDetails: str = '') -> Tuple[List[List[str]], PreparedMessage] | None:
+    '''
+    The envelope recipients of each chunk to send, and the message with its footer (already rendered).
+    Returns None in DEBUG_MODE, where the message is only logged.
+    '''
+    host = os.environ.get("smtp_address")
+    port = os.environ.get("smtp_port")
+
+    # make receiver into a list if it isn't one already
+    if isinstance(receiver, str):
+        receiver = [receiver]
+    else:
+        receiver = list(receiver)
+
+    # Ensure receive doesn't have any address destined for self server
+    removed = [email for email in receiver if constants.DOMAIN in email]
+    receiver = [email for email in receiver if constants.DOMAIN not in email]
+    if len(removed) > 0:
+        logging.error(f'The following destination emails were removed: {removed}')
+    if len(receiver) == 0:
+        logging.error('There are no destination emails provdied, cancel send_smtp')
+
+    system_name = os.environ.get('BRANDING', 'Timelord')
+    gitlab_url = os.environ.get('gitlab_url', '')
+    gitlab_calendar_wiki_project_url = os.environ.get('GITLAB_CALENDAR_WIKI_PROJECT_URL', '%s/calendar/' % gitlab_url)
+
+    prepared = PreparedMessage(msg)
+    prepared.add_footer(f'''
     **** {system_name} ****
     {additionalDetails}
     You received this message because you are a member of a {system_name} Gitlab group / Distribution List.
@@ -141,16 +243,9 @@ def send_smtp(sender: str, receiver: str | Sequence[str], msg: str, additionalDe
     *******************
     ''')
 
-            msg = email_msg.as_string()
-        except Exception as e:
-            logging.exception(e)
-            logging.exception(traceback.format_exc())
-
-        if constants.DEBUG_MODE:
-            logging.warn(f'DEBUG MODE (Not sending email) - send_smtp[host={host}:{port} sender={sender}]])')
-            try:
-                email_msg = message_from_string(msg)
-                email_msg = append_footer(email_msg, f'''
+    if constants.DEBUG_MODE:
+        logging.warn(f'DEBUG MODE (Not sending email) - send_smtp[host={host}:{port} sender={sender}]])')
+        prepared.add_footer(f'''
         **** TEST MODE ****
         Envelope - Send to:
 
@@ -158,32 +253,20 @@ def send_smtp(sender: str, receiver: str | Sequence[str], msg: str, additionalDe
 
         *******************
         ''')
-                msg = email_msg.as_string()
-            except Exception as e:
-                logging.exception(e)
-                logging.exception(traceback.format_exc())
 
-            logging.warn(msg)
+        logging.warn(prepared.as_bytes().decode(errors='replace'))
 
-            if len(receiver) > CHUNK_SIZE:
-                logging.warn('Chunking email sending...')
-                # Iterate through the list in chunks of 45
-                for i in range(0, len(receiver), CHUNK_SIZE):
-                    s = receiver[i:i+CHUNK_SIZE]
-                    logging.warn(f'Send Chunk: {s}')
-            else:
-                logging.warn(f'Send: {receiver}')
-            return True
+        if len(receiver) > CHUNK_SIZE:
+            logging.warn('Chunking email sending...')
+            for s in chunk_recipients(receiver):
+                logging.warn(f'Send Chunk: {s}')
+        else:
+            logging.warn(f'Send: {receiver}')
+        return None
 
-        try:
-            server = smtplib.SMTP_SSL(host, port)
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            if constants.TEST_MODE:
-                logging.warn(f'TEST MODE (Reflect to sender) - send_smtp[host={host}:{port} sender={sender}]])')
-                try:
-                    email_msg = message_from_string(msg)
-                    append_footer(email_msg, f'''
+    if constants.TEST_MODE:
+        logging.warn(f'TEST MODE (Reflect to sender) - send_smtp[host={host}:{port} sender={sender}]])')
+        prepared.add_footer(f'''
             **** TEST MODE ****
             Envelope - Send to:
 
@@ -191,34 +274,83 @@ def send_smtp(sender: str, receiver: str | Sequence[str], msg: str, additionalDe
 
             *******************
             ''')
-                    msg = email_msg.as_string()
-                except Exception as e:
-                    logging.exception(e)
-                    logging.exception(traceback.format_exc())
-                server.sendmail(constants.DEFAULT_FROM, sender, msg)
-                sent_success.update(sender)
-            else:
-                if len(receiver) > CHUNK_SIZE:
-                    logging.warn(f'Chunking email sending {len(receiver)} > {CHUNK_SIZE}...')
-                    # Iterate through the list in chunks of 45
-                    for i in range(0, len(receiver), CHUNK_SIZE):
-                        s = receiver[i:i+CHUNK_SIZE]
-                        logging.warn(f'Chunk {i} {len(s)}: {s}')
-                        server.sendmail(constants.DEFAULT_FROM, s, msg)
-                        sent_success.update(s)
-                else:
-                    logging.warn('Sending to all...')
-                    server.sendmail(constants.DEFAULT_FROM, receiver, msg)
-                    sent_success.update(receiver)
-                logging.warn(f'Email sent over SMTP - send_smtp[host={host}:{port} sender={sender}]]({receiver})')
-        except Exception as e:
-            logging.exception(e)
-            logging.exception(traceback.format_exc())
-            logging.error(email_msg)
-        finally:
-            server.quit()
-    finally:
-        return sent_success
+        prepared.as_bytes()
+        return [[sender]], prepared
+
+    if len(receiver) > CHUNK_SIZE:
+        logging.warn(f'Chunking email sending {len(receiver)} > {CHUNK_SIZE}...')
+    # render now, so every chunk sends the same bytes
+    prepared.as_bytes()
+    return chunk_recipients(receiver), prepared
+
+
+def _chunk_result(recipients: List[str], outcome: dict | Exception) -> ChunkResult:
+    '''
+    The ChunkResult of sending to recipients, from what sendmail returned or raised
+    '''
+    if isinstance(outcome, smtplib.SMTPRecipientsRefused):
+        # every recipient was refused, which isn't a problem with the message itself
+        logging.error(f'All recipients refused: {outcome.recipients}')
+        return ChunkResult(recipients=recipients, refused=outcome.recipients, error=None, code=None)
+    if isinstance(outcome, Exception):
+        logging.error(f'Sending to {len(recipients)} recipients failed: {outcome!r}')
+        return ChunkResult(recipients=recipients, refused={}, error=str(outcome) or type(outcome).__name__,
+                           code=getattr(outcome, 'smtp_code', None))
+    return ChunkResult(recipients=recipients, refused=outcome, error=None, code=None)
+
+
+def send_chunk(pool: SMTPRelays, recipients: List[str], msg: str | bytes | PreparedMessage) -> ChunkResult:
+    '''
+    Sends msg to one envelope of recipients. Failures are returned in the result, not raised.
+    '''
+    if isinstance(msg, PreparedMessage):
+        msg = msg.as_bytes()
+    logging.warn(f'Chunk {len(recipients)}: {recipients}')
+    try:
+        outcome = pool.sendmail(constants.DEFAULT_FROM, recipients, msg)
+    except Exception as e:
+        logging.exception(traceback.format_exc())
+        outcome = e
+    return _chunk_result(recipients, outcome)
+
+
+def send_chunks(pool: SMTPRelays,
+                chunks: Sequence[Tuple[List[str], str | bytes | PreparedMessage]]) -> List[ChunkResult]:
+    '''
+    Sends several (recipients, msg) chunks, of the same or different messages, in one relay session.
+    Failures are returned in the results, not raised.
+    '''
+    messages = [(constants.DEFAULT_FROM, recipients, msg.as_bytes() if isinstance(msg, PreparedMessage) else msg)
+                for recipients, msg in chunks]
+    logging.warn(f'Sending {len(chunks)} chunks, {sum(len(recipients) for recipients, msg in chunks)} recipients')
+    outcomes = pool.sendmail_batch(messages)
+    return [_chunk_result(recipients, outcome) for (recipients, msg), outcome in zip(chunks, outcomes)]
+
+
+def send_smtp(sender: str, receiver: str | Sequence[str], msg: str | bytes | Message | PreparedMessage,
+              additionalDetails: str = '') -> Sequence[str]:
+    '''
+    Sends msg to receiver through the relay, in chunks of CHUNK_SIZE recipients.
+    Returns the recipients that were sent to.
+
+    This blocks until every chunk has been sent; coroutines use the outbound spool instead.
+    '''
+    sent_success = set()
+    try:
+        logging.warn(f'send_smtp(sender={sender}, to={receiver})')
+        plan = delivery_plan(sender, receiver, msg, additionalDetails)
+        if plan is None:
+            return sent_success
+        chunks, msg = plan
+        # each sendmail reuses a logged in connection to one of the relays, reset (RSET) for the new transaction
+        pool = get_smtp_pool()
+        sent_success = sent_recipients([send_chunk(pool, chunk, msg) for chunk in chunks])
+        logging.warn(f'Email sent over SMTP - send_smtp[sender={sender}]]({receiver})')
+    except Exception as e:
+        logging.exception(e)
+        logging.exception(traceback.format_exc())
+    return sent_success
+
 
 def remove_emails(email_list, domain):
     '''
@@ -381,7 +513,7 @@ def get_end_date(component):
     return last_occurrence_end
 
 
-async def receive_calendar(raw_email: str, msg: Message, target_groups: Sequence[str],
+async def receive_calendar(raw_email: bytes, msg: Message, target_groups: Sequence[str],
                            send_to: Sequence[str], ics_file: str, method: str) -> str | None:
     # Parse the ics file data to extract the UID and other details
     cal = Calendar.from_ical(ics_file)
@@ -436,7 +568,7 @@ async def receive_calendar(raw_email: str, msg: Message, target_groups: Sequence
                     'uuid': uid,                        # string
                     'meeting_title': meeting_title,     # string
                     'email_from': email_from,           # string
-                    'email': raw_email,                 # string
+                    'email': raw_email,                 # bytes
                     'recurr': (rrule is not None),      # bool
                     'end_date': end_date,               # string
                     'groups': target_groups,            # list of strings
@@ -453,7 +585,11 @@ async def receive_calendar(raw_email: str, msg: Message, target_groups: Sequence
 
 
 async def get_attachments(raw_email, received_groups: Sequence[str] = [],
-                          send_to: Sequence[str] = []) -> TypedDict:
+                          send_to: Sequence[str] = [], original: bytes = None) -> TypedDict:
+    '''
+    Finds the calendar parts of a parsed message, and stores the meeting of each invite.
+    original is the message as it was received, which is what's stored.
+    '''
     msg = raw_email  # BytesParser(policy=policy.default).parsebytes(raw_email)
     uid = None
     results = []
@@ -484,7 +620,9 @@ async def get_attachments(raw_email, received_groups: Sequence[str] = [],
                         'data': data
                     })
 
-                    uid = await receive_calendar(msg.as_string(), msg, received_groups, send_to, data, method)
+                    if original is None:
+                        original = msg.as_bytes()
+                    uid = await receive_calendar(original, msg, received_groups, send_to, data, method)
                     has_calendar = True
             except Exception as e:
                 logging.error(f'Attachment File Process exception: {str(e)}')
@@ -495,13 +633,16 @@ async def get_attachments(raw_email, received_groups: Sequence[str] = [],
     return {'attachments': results, 'has_calendar': has_calendar, 'calendar_uid': uid}
 
 
-def mime_email_send(subject: str, to: Sequence[str], cc: Sequence[str] = [], bcc: Sequence[str] = [],
-                    text: str = None, html: str = None,
-                    attachments: Sequence = [],
-                    sender: str = None, send_from: str = None):
+def mime_email_message(subject: str, to: Sequence[str], cc: Sequence[str] = [], bcc: Sequence[str] = [],
+                       text: str = None, html: str = None,
+                       attachments: Sequence = [],
+                       sender: str = None, send_from: str = None) -> Tuple[MIMEMultipart, List[str]]:
     '''
+    Builds a message, returning it and the addresses to send it to (to, cc and bcc).
     Attachments is a list, with each entry a dictionary in the format of
     {filename, content_type, data}
+
+    outbound_spool.mime_email_send builds and sends one.
     '''
     multipart_content_subtype = 'alternative' if text and html else 'mixed'
     msg = MIMEMultipart(multipart_content_subtype)
@@ -547,9 +688,7 @@ def mime_email_send(subject: str, to: Sequence[str], cc: Sequence[str] = [], bcc
         print('Part: filename=%s content_type=%s' % (attachment['filename'], attachment['content_type']))
 
     destinations = list(set().union(to).union(cc).union(bcc))
-
-    send_smtp(sender, destinations, msg.as_string())
-    return msg
+    return msg, destinations
 
 
 def generate_footer(sender, groups=[], users=[], html=True, group_info=None):
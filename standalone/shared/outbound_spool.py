@@ -0,0 +1,254 @@
+'''
+The outbound spool: messages to send through the relay are written to the database
+once, then delivered in chunks by background workers, with the delivery state of
+each recipient kept in the database.
+
+A chunk that fails (relay down, 4xx reply) is retried later with exponential backoff,
+and anything still pending when the process stops is sent when it starts again.
+The invites of a meeting are recorded (meetings_invites_set) only for recipients
+the relay accepted.
+'''
+import asyncio
+from email.message import Message
+import logging
+import time
+import traceback
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import shared.constants as constants
+import shared.mail_utils as mail_utils
+from database import OutboundChunk, TLDatabase
+
+# longest the dispatcher sleeps before checking the database again
+MAX_IDLE_SECONDS = 60
+# how often messages past SMTP_SPOOL_RETENTION_HOURS are deleted
+PURGE_INTERVAL_SECONDS = 3600
+
+
+def classify_result(result: mail_utils.ChunkResult) -> Tuple[List[str], Dict[str, str], Dict[str, str]]:
+    '''
+    Splits the recipients of a chunk into (delivered, refused for good, to retry);
+    the last two map each address to the reason.
+    5xx replies are permanent, anything else (4xx, connection errors) is retried.
+    '''
+    delivered, refused, retry = [], {}, {}
+    if result['error'] is not None:
+        failed = refused if result['code'] is not None and result['code'] >= 500 else retry
+        for email in result['recipients']:
+            failed[email] = result['error']
+        return delivered, refused, retry
+    for email in result['recipients']:
+        if email not in result['refused']:
+            delivered.append(email)
+            continue
+        code, reason = result['refused'][email]
+        reason = f'{code} {reason.decode(errors="replace") if isinstance(reason, bytes) else reason}'
+        if code >= 500:
+            refused[email] = reason
+        else:
+            retry[email] = reason
+    return delivered, refused, retry
+
+
+def _send_pooled(chunks: List[Tuple[List[str], bytes]]) -> List[mail_utils.ChunkResult]:
+    return mail_utils.send_chunks(mail_utils.get_smtp_pool(), chunks)
+
+
+class OutboundSpool:
+    '''
+    parallelism is the number of relay sessions at once; each sends up to CHUNK_SIZE recipients,
+    of one message or of several small ones.
+    send_chunks([(recipients, msg), ...]) sends the chunks of one session and returns a ChunkResult
+    for each; it runs on the SMTP threads.
+    '''
+    def __init__(self, db: TLDatabase = None, parallelism=None, max_attempts=None, retry_seconds=None,
+                 max_retry_seconds=None, send_chunks: Callable = _send_pooled, clock=time.time):
+        self.db = db or TLDatabase()
+        self.parallelism = parallelism or constants.SMTP_SEND_PARALLELISM
+        self.max_attempts = max_attempts or constants.SMTP_SPOOL_MAX_ATTEMPTS
+        self.retry_seconds = retry_seconds or constants.SMTP_SPOOL_RETRY_SECONDS
+        self.max_retry_seconds = max_retry_seconds or constants.SMTP_SPOOL_MAX_RETRY_SECONDS
+        self.send_chunks = send_chunks
+        self.clock = clock
+
+        # set when there may be something new to send
+        self.wakeup = asyncio.Event()
+        # notified whenever a chunk's result has been recorded
+        self.progress = asyncio.Condition()
+        self.dispatcher: asyncio.Task = None
+        self.deliveries = set()
+        self.purged_at = None
+
+    async def start(self):
+        '''
+        Starts delivering, including anything left in the spool from before a restart
+        '''
+        await self.db.outbound_reset_sending()
+        await self._purge()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout=30):
+        '''
+        Stops taking new chunks, and waits up to timeout for the ones being sent.
+        Chunks still being sent are sent again on the next start.
+        '''
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        if self.deliveries:
+            await asyncio.wait(list(self.deliveries), timeout=timeout)
+
+    async def enqueue(self, sender: str, receiver: str | Sequence[str], msg: str | bytes | Message,
+                      additionalDetails: str = '', meeting_uuid: str = None) -> int | None:
+        '''
+        Adds the footer to msg and spools it for receiver, as send_smtp would send it.
+        If meeting_uuid is set, each recipient is added to the meeting's invites once delivered.
+        When the meeting changes, recipients not yet sent to are dropped (see TLDatabase.meetings_invites_delete).
+        Returns the spooled message id, or None if there's nothing to send (e.g. in DEBUG_MODE).
+        '''
+        return (await self.enqueue_many([(sender, receiver, msg, meeting_uuid)], additionalDetails))[0]
+
+    async def enqueue_many(self, messages: Sequence[Tuple[str, str | Sequence[str], str | bytes | Message, str | None]],
+                           additionalDetails: str = '') -> List[int | None]:
+        '''
+        Spools several (sender, receiver, msg, meeting_uuid) messages in one transaction, see enqueue.
+        Returns the spooled message id of each, or None if there's nothing to send.
+        '''
+        loop = asyncio.get_running_loop()
+        spooled = []
+        for sender, receiver, msg, meeting_uuid in messages:
+            plan = await loop.run_in_executor(mail_utils.smtp_executor, mail_utils.delivery_plan,
+                                              sender, receiver, msg, additionalDetails)
+            if plan is None:
+                spooled.append(None)
+                continue
+            chunks, prepared = plan
+            recipients = [email for chunk in chunks for email in chunk]
+            # the rendered message is stored, so retries send exactly the same bytes without rendering it again
+            spooled.append((sender, prepared.as_bytes(), recipients, meeting_uuid) if recipients else None)
+
+        to_spool = [message for message in spooled if message]
+        message_ids = await self.db.outbound_enqueue_many(to_spool)
+        for message_id, (sender, email, recipients, meeting_uuid) in zip(message_ids, to_spool):
+            logging.info(f'Spooled message {message_id} from {sender} for {len(recipients)} recipients')
+        self.wakeup.set()
+        message_ids = iter(message_ids)
+        return [next(message_ids) if message else None for message in spooled]
+
+    async def wait(self, message_id: int, timeout: float = None) -> set:
+        '''
+        Waits until every recipient of a spooled message has been delivered, refused or
+        given up on, or for at most timeout seconds. Returns the recipients delivered so far.
+        '''
+        async def done():
+            async with self.progress:
+                while not await self.db.outbound_done(message_id):
+                    await self.progress.wait()
+        try:
+            await asyncio.wait_for(done(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'Spooled message {message_id} is still being delivered after {timeout}s')
+        return await self.db.outbound_delivered(message_id)
+
+    async def stats(self):
+        '''
+        The spool's backlog (see TLDatabase.outbound_backlog), and the relay sessions in progress
+        '''
+        return {
+            'backlog': await self.db.outbound_backlog(self.clock()),
+            'sessions_in_progress': len(self.deliveries),
+        }
+
+    async def _purge(self):
+        self.purged_at = self.clock()
+        await self.db.outbound_purge(constants.SMTP_SPOOL_RETENTION_HOURS)
+
+    async def _dispatch(self):
+        slots = asyncio.Semaphore(self.parallelism)
+        while True:
+            await slots.acquire()
+            chunks = []
+            try:
+                self.wakeup.clear()
+                if self.clock() - self.purged_at >= PURGE_INTERVAL_SECONDS:
+                    await self._purge()
+                chunks = await self.db.outbound_claim(self.clock(), mail_utils.CHUNK_SIZE)
+                if len(chunks) == 0:
+                    next_attempt = await self.db.outbound_next_attempt()
+                    idle = MAX_IDLE_SECONDS if next_attempt is None else next_attempt - self.clock()
+            except asyncio.CancelledError:
+                slots.release()
+                raise
+            except Exception as e:
+                logging.exception(traceback.format_exc())
+                logging.error(f'Outbound spool dispatch failed: {e}')
+                idle = 1
+            if len(chunks) == 0:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(max(idle, 0), MAX_IDLE_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._deliver(chunks))
+            self.deliveries.add(task)
+            task.add_done_callback(self.deliveries.discard)
+            task.add_done_callback(lambda task: slots.release())
+
+    async def _deliver(self, chunks: List[OutboundChunk]):
+        message_ids = [chunk['message_id'] for chunk in chunks]
+        try:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(mail_utils.smtp_executor, self.send_chunks,
+                                                 [(chunk['recipients'], chunk['email']) for chunk in chunks])
+            recorded = []
+            for chunk, result in zip(chunks, results):
+                message_id = chunk['message_id']
+                delivered, refused, retry = classify_result(result)
+                recorded.append((message_id, delivered, refused, retry))
+                if retry:
+                    logging.warning(f'Spooled message {message_id}: retrying {len(retry)} recipients later, ' +
+                                    f'{next(iter(retry.values()))}')
+                if refused:
+                    logging.error(f'Spooled message {message_id}: refused {refused}')
+            # the delivery state and the invites delivered are all recorded in one transaction
+            done = await self.db.outbound_record(recorded, self.clock(), self.retry_seconds,
+                                                 self.max_retry_seconds, self.max_attempts)
+            for message_id in sorted(done):
+                logging.info(f'Spooled message {message_id} delivered')
+        except Exception as e:
+            logging.exception(traceback.format_exc())
+            logging.error(f'Spooled messages {message_ids}: delivery failed: {e}')
+            # retried later like any other failure, rather than left claimed until the next start
+            failed = [(chunk['message_id'], [], {}, {email: str(e) for email in chunk['recipients']})
+                      for chunk in chunks]
+            try:
+                await self.db.outbound_record(failed, self.clock(), self.retry_seconds, self.max_retry_seconds,
+                                              self.max_attempts)
+            except Exception as record_error:
+                logging.error(f'Spooled messages {message_ids}: recording the failure failed: {record_error}')
+        finally:
+            async with self.progress:
+                self.progress.notify_all()
+            # retries may now be due sooner than the dispatcher expected
+            self.wakeup.set()
+
+
+outbound_spool = OutboundSpool()
+
+
+async def mime_email_send(subject: str, to: Sequence[str], cc: Sequence[str] = [], bcc: Sequence[str] = [],
+                          text: str = None, html: str = None,
+                          attachments: Sequence = [],
+                          sender: str = None, send_from: str = None) -> int | None:
+    '''
+    Builds a message (see mail_utils.mime_email_message) and spools it for delivery.
+    Returns the spooled message id, see OutboundSpool.enqueue.
+    '''
+    msg, destinations = mail_utils.mime_email_message(subject, to, cc, bcc, text, html, attachments,
+                                                      sender, send_from)
+    return await outbound_spool.enqueue(sender, destinations, msg)
@@ -0,0 +1,68 @@
+'''
+Rate limiting shared by the Gitlab and SMTP clients.
+'''
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Allows rate tokens per second on average, with bursts of up to capacity tokens.
+    A rate of 0 (or less) is unlimited.
+
+    Callers reserve tokens and are told how long to wait before going ahead, so the
+    same bucket works for threads (acquire) and coroutines (await asyncio.sleep(reserve())).
+    A reservation larger than the tokens available is allowed, and later callers wait
+    until it has been paid back.
+    '''
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            if self.rate > 0:
+                self._refill(self.clock())
+            else:
+                self.updated = self.clock()
+            self.rate = rate
+
+    def reserve(self, tokens: float = 1) -> float:
+        '''
+        Takes the tokens, returning the seconds to wait before using them
+        '''
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill(self.clock())
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens: float = 1) -> float:
+        '''
+        Blocks until the tokens are available. Returns the seconds waited.
+        '''
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def available(self) -> float:
+        '''
+        The tokens that could be taken now without waiting (negative while a reservation is being paid back)
+        '''
+        with self.lock:
+            if self.rate <= 0:
+                return float('inf')
+            self._refill(self.clock())
+            return self.tokens
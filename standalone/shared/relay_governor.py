@@ -0,0 +1,132 @@
+'''
+Paces outbound mail to what the SMTP relay will accept (SES, for example, limits the
+recipients sent to per second), and slows down when the relay says it's getting too much.
+'''
+from collections import deque
+import logging
+import threading
+import time
+
+from shared.ratelimit import TokenBucket
+
+# relay replies that mean "slow down": 421 (closing the connection), 451 and 454
+# (SES: "Throttling failure: Maximum sending rate exceeded"), 452 (too many recipients)
+THROTTLE_CODES = (421, 451, 452, 454)
+# an unlimited rate is throttled starting from the throughput measured over this many seconds
+RATE_WINDOW_SECONDS = 10
+# throttling replies this soon after the rates were lowered are about sessions sent at the
+# old rates, so they don't lower them again
+THROTTLE_COOLDOWN_SECONDS = 2
+
+
+class RelayGovernor:
+    '''
+    Token buckets for recipients_per_second and messages_per_second (0 is unlimited).
+
+    Callers acquire() before each relay session, and record() how it went. A throttling
+    reply halves both rates, down to min_fraction of where they started; each session the
+    relay accepts afterwards raises them by recovery of that, back to the configured rates.
+    '''
+    def __init__(self, recipients_per_second=0, messages_per_second=0, min_fraction=0.05, recovery=0.05,
+                 clock=time.monotonic):
+        self.recipients_per_second = recipients_per_second
+        self.messages_per_second = messages_per_second
+        self.min_fraction = min_fraction
+        self.recovery = recovery
+        self.clock = clock
+        self.recipients = TokenBucket(recipients_per_second, clock=clock)
+        self.messages = TokenBucket(messages_per_second, clock=clock)
+
+        # the current rates are ceilings * fraction; 1 means the configured rates
+        self.fraction = 1.0
+        self.ceilings = (recipients_per_second, messages_per_second)
+        self.throttled_at = None
+        # (time, recipients, messages) of recent sessions, to measure the throughput
+        self.recent = deque()
+        self.lock = threading.Lock()
+        # counters, for reporting
+        self.sessions = 0
+        self.throttles = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def reserve(self, recipients: int, messages: int = 1) -> float:
+        '''
+        Takes the tokens for a session, returning the seconds to wait before starting it
+        '''
+        wait = max(self.recipients.reserve(recipients), self.messages.reserve(messages))
+        if wait > 0:
+            with self.lock:
+                self.waits += 1
+                self.wait_seconds += wait
+        return wait
+
+    def acquire(self, recipients: int, messages: int = 1) -> float:
+        '''
+        Blocks until a session may be sent. Returns the seconds waited.
+        '''
+        wait = self.reserve(recipients, messages)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def record(self, recipients: int, messages: int = 1, throttled=False):
+        '''
+        Records a session sent to the relay, and whether the relay throttled any of it
+        '''
+        now = self.clock()
+        with self.lock:
+            self.sessions += 1
+            self.recent.append((now, recipients, messages))
+            while now - self.recent[0][0] > RATE_WINDOW_SECONDS:
+                self.recent.popleft()
+            if throttled:
+                self.throttles += 1
+                if self.throttled_at is not None and now - self.throttled_at < THROTTLE_COOLDOWN_SECONDS:
+                    return
+                if self.fraction == 1.0:
+                    measured = self._measured(now)
+                    self.ceilings = tuple(configured or max(rate, 1) for configured, rate in
+                                          zip((self.recipients_per_second, self.messages_per_second), measured))
+                self.throttled_at = now
+                self.fraction = max(self.fraction / 2, self.min_fraction)
+            elif self.fraction < 1.0:
+                self.fraction = min(self.fraction + self.recovery, 1.0)
+            else:
+                return
+            rates = self._rates()
+            self.recipients.set_rate(rates[0])
+            self.messages.set_rate(rates[1])
+        if throttled:
+            logging.warning(f'SMTP relay throttled, slowing to {rates[0]:.1f} recipients/s, {rates[1]:.1f} messages/s')
+        elif self.fraction == 1.0:
+            logging.warning('SMTP relay no longer throttled, back to the configured rates')
+
+    def _measured(self, now):
+        # recipients and messages per second over the recent sessions
+        recent = [session for session in self.recent if now - session[0] <= RATE_WINDOW_SECONDS]
+        seconds = max(now - recent[0][0], 1) if recent else 1
+        return (sum(r[1] for r in recent) / seconds, sum(r[2] for r in recent) / seconds)
+
+    def _rates(self):
+        if self.fraction == 1.0:
+            return (self.recipients_per_second, self.messages_per_second)
+        return tuple(ceiling * self.fraction for ceiling in self.ceilings)
+
+    def stats(self):
+        with self.lock:
+            rates = self._rates()
+            measured = self._measured(self.clock())
+            return {
+                'recipients_per_second': round(rates[0], 2),
+                'messages_per_second': round(rates[1], 2),
+                'configured': {'recipients_per_second': self.recipients_per_second,
+                               'messages_per_second': self.messages_per_second},
+                'throttled': self.fraction < 1.0,
+                'sent_recipients_per_second': round(measured[0], 2),
+                'sent_messages_per_second': round(measured[1], 2),
+                'sessions': self.sessions,
+                'throttles': self.throttles,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 1),
+            }
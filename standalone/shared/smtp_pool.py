@@ -0,0 +1,218 @@
+'''
+A pool of authenticated SMTP relay connections, so sending doesn't pay for a
+TLS handshake, EHLO and LOGIN on every message.
+'''
+from contextlib import contextmanager
+import logging
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from typing import Callable, List, Sequence, Tuple
+
+# errors that mean the connection itself is no longer usable. Not OSError: the SMTP
+# errors the relay replies with are OSErrors too, and leave the connection usable
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError,
+                     socket.gaierror, ssl.SSLError)
+
+
+class SMTPSessionError(ConnectionError):
+    '''
+    Connecting or logging in to the relay failed (including a 5xx reply to EHLO or AUTH),
+    so nothing was sent: the relay is unavailable, rather than the messages refused
+    '''
+    pass
+
+
+class PooledConnection:
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.transactions = 0
+
+
+class SMTPConnectionPool:
+    '''
+    Keeps up to max_size logged in connections to one relay.
+
+    A connection idle for longer than idle_timeout_seconds is closed rather than reused.
+    Reused connections are reset (RSET) before each transaction, which also checks the
+    relay hasn't dropped them; if it has, a new connection is opened transparently.
+
+    connection_factory(host, port, timeout=) returns a connected smtplib.SMTP (or SMTP_SSL).
+    '''
+    def __init__(self, host: str, port: int, username: str = None, password: str = None,
+                 max_size=4, idle_timeout_seconds=60, timeout=60,
+                 connection_factory: Callable = smtplib.SMTP_SSL):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.timeout = timeout
+        self.connection_factory = connection_factory
+
+        self.idle: List[PooledConnection] = []
+        self.lock = threading.Lock()
+        # limits connections open at once, idle or in use
+        self.slots = threading.BoundedSemaphore(max_size)
+        # counters, for reporting
+        self.opened = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.transactions = 0
+
+    def _open(self) -> PooledConnection:
+        try:
+            server = self.connection_factory(self.host, self.port, timeout=self.timeout)
+        except Exception as e:
+            raise SMTPSessionError(f'Connecting to SMTP relay {self.host}:{self.port} failed: {e!r}') from e
+        try:
+            code, reply = server.ehlo()
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, reply)
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception as e:
+            _close(server)
+            raise SMTPSessionError(f'Logging in to SMTP relay {self.host}:{self.port} failed: {e!r}') from e
+        with self.lock:
+            self.opened += 1
+        return PooledConnection(server)
+
+    def _checkout(self) -> PooledConnection:
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                # most recently used first, so extra connections go idle and get closed
+                connection = self.idle.pop()
+            if time.monotonic() - connection.last_used > self.idle_timeout_seconds:
+                _close(connection.server)
+                continue
+            try:
+                # clears any state left from the last transaction, and checks the relay is still there
+                code, _ = connection.server.rset()
+                if code == 250:
+                    with self.lock:
+                        self.reused += 1
+                    return connection
+            except CONNECTION_ERRORS + (smtplib.SMTPException,):
+                pass
+            with self.lock:
+                self.reconnects += 1
+            _close(connection.server)
+        return self._open()
+
+    def _checkin(self, connection: PooledConnection):
+        connection.last_used = time.monotonic()
+        with self.lock:
+            self.idle.append(connection)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Yields a logged in smtplib connection for one or more transactions.
+        It goes back to the pool afterwards, unless the connection failed.
+        '''
+        self.slots.acquire()
+        try:
+            connection = self._checkout()
+            try:
+                yield connection.server
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                # a rejected recipient or message; the connection is still usable
+                self._checkin(connection)
+                raise
+            except CONNECTION_ERRORS:
+                _close(connection.server)
+                raise
+            except Exception:
+                self._checkin(connection)
+                raise
+            connection.transactions += 1
+            self._checkin(connection)
+        finally:
+            self.slots.release()
+
+    def sendmail(self, from_addr: str, to_addrs: Sequence[str], msg: str | bytes) -> dict:
+        '''
+        Sends one message on a pooled connection, as smtplib's sendmail. If the connection
+        turns out to be dead, the message is sent again once on a new connection.
+        '''
+        for attempt in range(2):
+            try:
+                with self.connection() as server:
+                    refused = server.sendmail(from_addr, to_addrs, msg)
+                with self.lock:
+                    self.transactions += 1
+                return refused
+            except smtplib.SMTPServerDisconnected:
+                if attempt > 0:
+                    raise
+                logging.warning(f'SMTP relay {self.host}:{self.port} disconnected, reconnecting')
+                with self.lock:
+                    self.reconnects += 1
+
+    def sendmail_batch(self, messages: Sequence[Tuple[str, Sequence[str], str | bytes]]) -> List[dict | Exception]:
+        '''
+        Sends several (from_addr, to_addrs, msg) messages as transactions on one connection.
+        Each result is what sendmail returned, or the exception the relay answered that
+        message with. If the connection fails, the messages not sent yet get its exception.
+        '''
+        results = []
+        try:
+            with self.connection() as server:
+                for from_addr, to_addrs, msg in messages:
+                    try:
+                        results.append(server.sendmail(from_addr, to_addrs, msg))
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                        # refused by the relay, the connection is still usable
+                        results.append(e)
+                    with self.lock:
+                        self.transactions += 1
+        except Exception as e:
+            logging.warning(f'SMTP relay {self.host}:{self.port} session failed after {len(results)} of ' +
+                            f'{len(messages)} messages: {e}')
+            results.extend([e] * (len(messages) - len(results)))
+        return results
+
+    def close_idle(self):
+        '''
+        Closes connections that have been idle for longer than idle_timeout_seconds
+        '''
+        now = time.monotonic()
+        with self.lock:
+            expired = [c for c in self.idle if now - c.last_used > self.idle_timeout_seconds]
+            self.idle = [c for c in self.idle if c not in expired]
+        for connection in expired:
+            _close(connection.server, quit=True)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            _close(connection.server, quit=True)
+
+    def stats(self):
+        return {
+            'idle': len(self.idle),
+            'opened': self.opened,
+            'reused': self.reused,
+            'reconnects': self.reconnects,
+            'transactions': self.transactions,
+        }
+
+
+def _close(server: smtplib.SMTP, quit=False):
+    try:
+        if quit:
+            server.quit()
+        else:
+            server.close()
+    except Exception:
+        pass
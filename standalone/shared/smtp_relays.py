@@ -0,0 +1,178 @@
+'''
+Outbound delivery over several SMTP relays: each relay has its own connection pool
+(whose size caps its concurrent sessions), weight, circuit breaker and RelayGovernor.
+Sessions are spread across the relays by weight, and messages a relay couldn't take
+(connection failure, throttling) are moved to another relay.
+'''
+import logging
+import smtplib
+import threading
+from typing import List, Sequence, Tuple
+
+from shared.circuitbreaker import CircuitBreaker
+from shared.relay_governor import THROTTLE_CODES, RelayGovernor
+from shared.smtp_pool import SMTPConnectionPool
+
+
+class SMTPRelaysUnavailable(ConnectionError):
+    pass
+
+
+def parse_relays(spec: str, default_connections: int) -> List[Tuple[str, int, float, int]]:
+    '''
+    Parses a comma separated list of host:port[:weight[:connections]] into
+    (host, port, weight, connections) tuples; invalid entries are logged and skipped
+    '''
+    relays = []
+    for entry in spec.replace(' ', '').split(','):
+        if not entry:
+            continue
+        try:
+            host, port, *rest = entry.split(':')
+            weight = float(rest[0]) if len(rest) > 0 and rest[0] else 1.0
+            connections = int(rest[1]) if len(rest) > 1 and rest[1] else default_connections
+            if not host or weight <= 0 or connections <= 0 or len(rest) > 2:
+                raise ValueError(entry)
+            relays.append((host, int(port), weight, connections))
+        except ValueError:
+            logging.error(f'Invalid SMTP relay "{entry}", expected host:port[:weight[:connections]]')
+    return relays
+
+
+def _throttled(outcome: dict | Exception) -> bool:
+    # only outcomes where nothing was sent, so the message can go to another relay
+    if isinstance(outcome, smtplib.SMTPRecipientsRefused):
+        return any(code in THROTTLE_CODES for code, reason in outcome.recipients.values())
+    return isinstance(outcome, smtplib.SMTPResponseException) and outcome.smtp_code in THROTTLE_CODES
+
+
+def _unavailable(outcome: dict | Exception) -> bool:
+    # the relay couldn't be reached or dropped the session
+    return isinstance(outcome, Exception) and not isinstance(
+        outcome, (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException))
+
+
+class Relay:
+    def __init__(self, pool: SMTPConnectionPool, weight: float = 1, governor: RelayGovernor = None,
+                 breaker: CircuitBreaker = None):
+        self.pool = pool
+        self.weight = weight
+        self.governor = governor or RelayGovernor()
+        self.breaker = breaker or CircuitBreaker(f'SMTP relay {self.name}', failure_threshold=3)
+        # sessions in progress, at most pool.max_size
+        self.active = 0
+        # for the smooth weighted round robin
+        self.current_weight = 0.0
+
+    @property
+    def name(self):
+        return f'{self.pool.host}:{self.pool.port}'
+
+    def stats(self):
+        return {
+            'relay': self.name,
+            'weight': self.weight,
+            'connections': self.pool.max_size,
+            'active': self.active,
+            'circuit': self.breaker.stats(),
+            'governor': self.governor.stats(),
+            'pool': self.pool.stats(),
+        }
+
+
+class SMTPRelays:
+    '''
+    Sends through one of relays, with the same sendmail and sendmail_batch as SMTPConnectionPool.
+
+    Each session goes to the relay next in a smooth weighted round robin, skipping relays
+    whose circuit is open or whose connections are all in use (unless they all are). A
+    throttled relay's weight is lowered in proportion to its governor's rates.
+
+    Messages that weren't sent because the relay failed or throttled them are sent again
+    on another relay, or once more on the same relay if it's the only one.
+    '''
+    def __init__(self, relays: Sequence[Relay]):
+        self.relays = list(relays)
+        self.lock = threading.Lock()
+        self.failovers = 0
+
+    def _choose(self, exclude) -> Relay | None:
+        with self.lock:
+            candidates = [relay for relay in self.relays if relay not in exclude] or list(self.relays)
+            while candidates:
+                free = [relay for relay in candidates if relay.active < relay.pool.max_size] or candidates
+                total = 0.0
+                best = None
+                for relay in free:
+                    weight = relay.weight * relay.governor.fraction
+                    relay.current_weight += weight
+                    total += weight
+                    if best is None or relay.current_weight > best.current_weight:
+                        best = relay
+                best.current_weight -= total
+                if best.breaker.allow():
+                    best.active += 1
+                    return best
+                candidates.remove(best)
+            return None
+
+    def _send(self, relay: Relay, messages: Sequence[Tuple[str, Sequence[str], str | bytes]]) -> List[dict | Exception]:
+        recipients = sum(len(to_addrs) for from_addr, to_addrs, msg in messages)
+        try:
+            relay.governor.acquire(recipients, len(messages))
+            outcomes = relay.pool.sendmail_batch(messages)
+        finally:
+            with self.lock:
+                relay.active -= 1
+        relay.governor.record(recipients, len(messages), throttled=any(_throttled(o) for o in outcomes))
+        if any(_unavailable(outcome) for outcome in outcomes):
+            relay.breaker.record_failure()
+        else:
+            relay.breaker.record_success()
+        return outcomes
+
+    def sendmail_batch(self, messages: Sequence[Tuple[str, Sequence[str], str | bytes]]) -> List[dict | Exception]:
+        '''
+        Sends several (from_addr, to_addrs, msg) messages in one session, as SMTPConnectionPool.sendmail_batch
+        '''
+        results: List[dict | Exception] = [SMTPRelaysUnavailable('No SMTP relay available')] * len(messages)
+        todo = list(range(len(messages)))
+        tried = set()
+        for attempt in range(max(len(self.relays), 2)):
+            relay = self._choose(tried)
+            if relay is None:
+                break
+            tried.add(relay)
+            outcomes = self._send(relay, [messages[i] for i in todo])
+            retry = []
+            for i, outcome in zip(todo, outcomes):
+                results[i] = outcome
+                if _throttled(outcome) or _unavailable(outcome):
+                    retry.append(i)
+            if not retry:
+                break
+            todo = retry
+            with self.lock:
+                self.failovers += 1
+            logging.warning(f'SMTP relay {relay.name} failed or throttled {len(retry)} messages, ' +
+                            'sending them again')
+        return results
+
+    def sendmail(self, from_addr: str, to_addrs: Sequence[str], msg: str | bytes) -> dict:
+        '''
+        Sends one message, as smtplib's sendmail
+        '''
+        outcome = self.sendmail_batch([(from_addr, to_addrs, msg)])[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def close_all(self):
+        for relay in self.relays:
+            relay.pool.close_all()
+
+    def stats(self):
+        return {
+            'relays': [relay.stats() for relay in self.relays],
+            'failovers': self.failovers,
+        }
@@ -0,0 +1,33 @@
+# import pytest
+from shared.circuitbreaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+def test_circuit_breaker():
+    now = [0.0]
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_seconds=30, clock=lambda: now[0])
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    # only consecutive failures count
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    # one trial call after reset_seconds
+    now[0] = 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    now[0] = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+    assert breaker.stats()['times_opened'] == 2
@@ -0,0 +1,63 @@
+import asyncio
+from database import TLDatabase, email_bytes
+
+RAW = b'Subject: Caf\xc3\xa9\r\nContent-Type: text/plain; charset="utf-8"\r\n\r\nLine \'one\'\r\n\\ two\r\n'
+
+
+def test_email_bytes_reads_legacy_rows():
+    assert email_bytes(RAW) is RAW
+    # rows written as the repr of the bytes
+    assert email_bytes(repr(RAW)) == RAW
+    # rows written as text
+    assert email_bytes(RAW.decode('utf-8')) == RAW
+    assert email_bytes(None) == b''
+
+
+def test_meetings_store_message_bytes(tmp_path):
+    async def main():
+        db = TLDatabase()
+        db.db_path = str(tmp_path / 'timelord.db')
+        await db.initialize()
+        try:
+            await db.meetings_insert_record({'uuid': 'meeting-1', 'meeting_title': 'Meeting',
+                                             'email_from': 'sender@example.com', 'email': RAW, 'recurr': False,
+                                             'end_date': None, 'groups': ['group'], 'ics_file_data': ''})
+            return await db.meetings_retrieve_record('meeting-1')
+        finally:
+            await db.close()
+
+    records = asyncio.run(main())
+    assert records[0]['email'] == RAW
+
+
+def test_writes_wait_for_open_transaction(tmp_path):
+    record = {'uuid': 'meeting-1', 'meeting_title': 'Meeting', 'email_from': 'sender@example.com',
+              'email': RAW, 'recurr': False, 'end_date': None, 'groups': ['group'], 'ics_file_data': ''}
+
+    async def main():
+        db = TLDatabase()
+        db.db_path = str(tmp_path / 'timelord.db')
+        await db.initialize()
+        try:
+            started = asyncio.Event()
+
+            async def failing_write():
+                async with db.transaction():
+                    await db.conn.execute('INSERT INTO meetings (uuid, groups) VALUES (?, ?)', ('meeting-2', ''))
+                    started.set()
+                    # let the other writer run while this transaction is open
+                    await asyncio.sleep(0.05)
+                    raise RuntimeError('failed part way')
+
+            async def other_write():
+                await started.wait()
+                # commits only its own statement, after the other transaction rolled back
+                await db.meetings_insert_record(record)
+
+            results = await asyncio.gather(failing_write(), other_write(), return_exceptions=True)
+            assert isinstance(results[0], RuntimeError)
+            return [r['uuid'] for r in await db.meetings_retrieve_all_records()]
+        finally:
+            await db.close()
+
+    assert asyncio.run(main()) == ['meeting-1']
@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
+import threading
+import time
 # import pytest
-from shared.datacache import DataCache
+from shared.datacache import DataCache, StaleWhileRevalidateDataCache, GenerationCache
 
 
 def fetch_function_example(*args, **kwargs):
@@ -25,3 +27,145 @@ def test_data_cache():
     # Test timeout by altering last_updated
     cache.last_updated = datetime.now() - timedelta(seconds=61)
     assert cache.get_data() == 'data'  # fetch_function should be called again
+
+
+class SlowFetch:
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.calls
+
+
+def test_data_cache_single_flight():
+    fetch = SlowFetch()
+    cache = DataCache(fetch, 60)
+
+    threads = [threading.Thread(target=cache.get_data) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert fetch.calls == 1
+    assert cache.get_data() == 1
+    assert cache.generation == 1
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 5
+    assert stats['refreshes'] == 1
+    assert stats['last_refresh_seconds'] >= 0.1
+
+
+def test_stale_while_revalidate_data_cache():
+    fetch = SlowFetch()
+    cache = StaleWhileRevalidateDataCache(fetch, 60, 600)
+
+    # Nothing cached yet, so this blocks
+    assert cache.get_data() == 1
+
+    # Soft expired: the stale value is returned while one background refresh runs
+    cache.last_updated = datetime.now() - timedelta(seconds=61)
+    assert cache.get_data() == 1
+    assert cache.get_data() == 1
+    assert cache.refreshing
+    while cache.refreshing:
+        time.sleep(0.01)
+    assert fetch.calls == 2
+    assert cache.get_data() == 2
+    assert cache.stats()['stale_hits'] == 2
+
+    # Hard expired: blocks again
+    cache.last_updated = datetime.now() - timedelta(seconds=601)
+    assert cache.get_data() == 3
+
+    # Flushed
+    cache.flush()
+    assert cache.get_data() == 4
+
+
+def test_generation_cache():
+    generation = [1]
+    fetch = SlowFetch(0)
+    cache = GenerationCache(fetch, lambda: generation[0])
+
+    assert cache.get_data() == 1
+    assert cache.get_data() == 1
+
+    generation[0] = 2
+    assert cache.get_data() == 2
+    assert cache.get_data() == 2
+
+    cache.flush()
+    assert cache.get_data() == 3
+
+
+def test_stale_while_revalidate_max_wait():
+    fetch = SlowFetch(0.5)
+    cache = StaleWhileRevalidateDataCache(fetch, 60, 600, max_wait_seconds=0.05)
+    cache.prime('snapshot')
+
+    # Past the hard timeout, the older data is returned if the refresh takes too long
+    cache.flush()
+    assert cache.get_data() == 'snapshot'
+    assert cache.stats()['fallbacks'] == 1
+    cache.revalidated.wait()
+    assert cache.get_data() == 1
+
+    def fail():
+        raise ConnectionError('unavailable')
+    failing = StaleWhileRevalidateDataCache(fail, 60, 600, max_wait_seconds=1)
+    failing.prime('snapshot')
+    failing.flush()
+    assert failing.get_data() == 'snapshot'
+    assert failing.fallbacks == 1
+
+
+def test_stale_while_revalidate_waits_once_per_refresh():
+    fetch = SlowFetch(0.5)
+    cache = StaleWhileRevalidateDataCache(fetch, 60, 600, max_wait_seconds=0.2)
+    cache.prime('snapshot')
+    cache.flush()
+
+    # only the first lookup during the refresh waits for it
+    waits = []
+    for i in range(4):
+        start = time.monotonic()
+        assert cache.get_data() == 'snapshot'
+        waits.append(time.monotonic() - start)
+    assert waits[0] >= 0.2
+    assert all(wait < 0.1 for wait in waits[1:])
+    assert fetch.calls == 1
+    cache.revalidated.wait()
+    assert cache.get_data() == 1
+
+    # the next refresh is waited on again
+    cache.flush()
+    start = time.monotonic()
+    assert cache.get_data() == 1
+    assert time.monotonic() - start >= 0.2
+    cache.revalidated.wait()
+
+
+def test_stale_while_revalidate_invalidate():
+    fetch = SlowFetch(0.2)
+    cache = StaleWhileRevalidateDataCache(fetch, 60, 600, max_wait_seconds=1)
+    cache.prime('snapshot')
+
+    # still returned straight away while it's refreshed in the background
+    cache.invalidate()
+    start = time.monotonic()
+    assert cache.get_data() == 'snapshot'
+    assert time.monotonic() - start < 0.1
+    assert cache.stats()['fallbacks'] == 0
+    cache.revalidated.wait()
+    assert cache.get_data() == 1
+    assert fetch.calls == 1
+
+    # without any data, it's fetched by the next caller
+    empty = StaleWhileRevalidateDataCache(SlowFetch(0), 60, 600)
+    empty.invalidate()
+    assert empty.get_data() == 1
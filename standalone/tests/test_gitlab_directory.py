@@ -0,0 +1,264 @@
+from types import SimpleNamespace
+# import pytest
+from shared.gitlab_directory import UserDirectory, GroupHierarchy, GroupMembership, SenderAuthorizationIndex, \
+    GroupEmailIndex, group_email_name, EmailSet, MembershipBitsets
+
+
+def make_user(user_id, email, state='active', is_admin=False):
+    return SimpleNamespace(id=user_id, email=email, state=state, is_admin=is_admin)
+
+
+def make_group(group_id, parent_id=None):
+    return SimpleNamespace(id=group_id, parent_id=parent_id)
+
+
+def make_member(user_id, access_level=30):
+    return SimpleNamespace(id=user_id, access_level=access_level)
+
+
+class FakeMembersApi:
+    '''
+    Stands in for group.members.list(), counting calls per group
+    '''
+    def __init__(self, members):
+        self.members = members
+        self.calls = {}
+
+    def list(self, group_id):
+        self.calls[group_id] = self.calls.get(group_id, 0) + 1
+        return self.members.get(group_id, [])
+
+
+def test_user_directory():
+    users = UserDirectory([
+        make_user(1, 'a@test.test', is_admin=True),
+        make_user(2, 'b@test.test'),
+        make_user(3, 'c@test.test', state='blocked'),
+    ])
+
+    assert len(users) == 3
+    assert users.get(2).email == 'b@test.test'
+    assert users.get(4) is None
+    assert users.get_by_email('c@test.test').id == 3
+
+    # Blocked users are indexed, but not active
+    assert users.get_active(3) is None
+    assert users.get_active(1).email == 'a@test.test'
+    assert users.active_emails == {
+        'a@test.test': {'is_admin': True},
+        'b@test.test': {'is_admin': False},
+    }
+
+
+def test_group_hierarchy():
+    # 1
+    # +- 2
+    # |  +- 4
+    # |     +- 5
+    # +- 3
+    # 6 (parent not in the listing)
+    groups = GroupHierarchy([
+        make_group(1), make_group(2, 1), make_group(3, 1),
+        make_group(4, 2), make_group(5, 4), make_group(6, 99),
+    ])
+
+    assert [g.id for g in groups.children(1)] == [2, 3]
+    assert groups.ancestor_ids(5) == (4, 2, 1)
+    assert groups.ancestor_ids(1) == ()
+    assert groups.ancestor_ids(6) == ()
+    assert set(groups.descendant_ids(1)) == {2, 3, 4, 5}
+    assert groups.descendant_ids(5) == ()
+    assert [g.id for g in groups.ancestors(4)] == [2, 1]
+
+
+def test_group_membership_fetches_each_group_once():
+    # 4 levels deep, 3 children per group: 1 + 3 + 9 + 27 = 40 groups
+    groups = [make_group(1)]
+    members = {1: [make_member(1, 50)]}
+    level = [1]
+    next_id = 2
+    for depth in range(3):
+        next_level = []
+        for parent_id in level:
+            for i in range(3):
+                groups.append(make_group(next_id, parent_id))
+                # every group has one unique member, and also user 1 as a guest
+                members[next_id] = [make_member(next_id), make_member(1, 10)]
+                next_level.append(next_id)
+                next_id += 1
+        level = next_level
+    hierarchy = GroupHierarchy(groups)
+    api = FakeMembersApi(members)
+    membership = GroupMembership(api.list, lambda: hierarchy)
+
+    # Expand every group, top down and bottom up
+    for group_id in list(hierarchy.by_id) + list(reversed(hierarchy.by_id)):
+        membership.members(group_id, recursive=True)
+        membership.members_with_ancestors(group_id)
+
+    assert len(api.calls) == 40
+    assert set(api.calls.values()) == {1}
+    assert membership.fetch_count == 40
+
+    # Transitive members of the top level group are everyone, at their highest access level
+    top = membership.members(1)
+    assert set(top) == set(range(1, 41))
+    assert top[1] == 50
+
+    # A leaf group's senders are its own members plus those of its 3 ancestors
+    leaf = level[-1]
+    senders = membership.members_with_ancestors(leaf)
+    assert set(senders) == {leaf, 1} | set(hierarchy.ancestor_ids(leaf))
+
+    assert set(membership.members(2, recursive=False)) == {2, 1}
+    assert set(membership.members(2, filter_access_level=30)) == {2} | set(hierarchy.descendant_ids(2))
+
+    # Still no additional calls
+    assert membership.fetch_count == 40
+
+
+def test_group_membership_deltas():
+    hierarchy = GroupHierarchy([make_group(1), make_group(2, 1)])
+    api = FakeMembersApi({1: [make_member(1)], 2: [make_member(2)]})
+    membership = GroupMembership(api.list, lambda: hierarchy)
+
+    assert set(membership.members(1)) == {1, 2}
+    assert membership.version == 0
+
+    assert membership.apply_member_update(2, 3, 40)
+    assert membership.members(1) == {1: 30, 2: 30, 3: 40}
+    assert set(membership.members_with_ancestors(2)) == {1, 2, 3}
+
+    assert membership.apply_member_removal(2, 2)
+    assert set(membership.members(1)) == {1, 3}
+    assert membership.version == 2
+
+    # Unknown groups can't be applied
+    assert not membership.apply_member_update(99, 3, 40)
+    assert not membership.apply_member_removal(99, 3)
+
+    # Deltas never cause a refetch
+    assert membership.fetch_count == 2
+
+
+def test_group_membership_deltas_during_fetch():
+    hierarchy = GroupHierarchy([make_group(1), make_group(2)])
+    membership = None
+
+    def list_members(group_id):
+        # a hook is applied while the members are being fetched, so the listing doesn't include it
+        membership.apply_member_update(group_id, 3, 40)
+        membership.apply_member_removal(group_id, 1)
+        return [make_member(1), make_member(2)]
+
+    membership = GroupMembership(list_members, lambda: hierarchy)
+    membership.prefetch([1])
+    assert membership.direct_members(1) == {2: 30, 3: 40}
+    assert membership.direct_members(2) == {2: 30, 3: 40}
+
+
+def test_group_membership_prefetch():
+    groups = [make_group(1)] + [make_group(i, 1) for i in range(2, 50)]
+    members = {i: [make_member(i), make_member(100 + i % 7, 20)] for i in range(1, 50)}
+    hierarchy = GroupHierarchy(groups)
+
+    serial_api = FakeMembersApi(members)
+    serial = GroupMembership(serial_api.list, lambda: hierarchy)
+    concurrent_api = FakeMembersApi(members)
+    concurrent = GroupMembership(concurrent_api.list, lambda: hierarchy)
+
+    concurrent.prefetch([g.id for g in groups], max_workers=4)
+    assert concurrent.fetch_count == 49
+    assert set(concurrent_api.calls.values()) == {1}
+
+    # Already fetched, so no more calls
+    concurrent.prefetch([1, 2, 3], max_workers=4)
+    assert concurrent.fetch_count == 49
+
+    for group_id in hierarchy.by_id:
+        assert concurrent.members(group_id) == serial.members(group_id)
+    assert concurrent.fetch_count == 49
+    assert serial.fetch_count == 49
+
+
+def test_group_membership_crawl():
+    hierarchy = GroupHierarchy([make_group(1), make_group(2, 1), make_group(3, 2)])
+    api = FakeMembersApi({1: [make_member(1)], 3: [make_member(3)]})
+    membership = GroupMembership(api.list, lambda: hierarchy)
+
+    membership.crawl(max_workers=2)
+    assert membership.complete
+    assert membership.fetch_count == 3
+
+    # Everything after the crawl is answered locally
+    assert set(membership.members(1)) == {1, 3}
+    assert set(membership.members_with_ancestors(3)) == {1, 3}
+    assert membership.fetch_count == 3
+
+
+def test_sender_authorization_index():
+    hierarchy = GroupHierarchy([make_group(1), make_group(2, 1), make_group(3, 2)])
+    api = FakeMembersApi({1: [make_member(1)], 2: [make_member(2)], 3: [make_member(3), make_member(4)]})
+    membership = GroupMembership(api.list, lambda: hierarchy)
+    users = UserDirectory([
+        make_user(1, 'a@test.test'), make_user(2, 'b@test.test'),
+        make_user(3, 'c@test.test'), make_user(4, 'd@test.test', state='blocked'),
+    ])
+    index = SenderAuthorizationIndex({'top': 1, 'middle': 2, 'leaf': 3}, membership, users)
+
+    # Members of ancestors may send, members of subgroups and blocked users may not
+    assert index.senders('leaf') == {'a@test.test', 'b@test.test', 'c@test.test'}
+    assert index.is_authorized('middle', 'b@test.test')
+    assert not index.is_authorized('middle', 'c@test.test')
+    assert index.senders('unknown') == frozenset()
+
+    fetch_count = membership.fetch_count
+    assert index.is_authorized('leaf', 'a@test.test')
+    assert membership.fetch_count == fetch_count
+
+
+def test_group_email_index():
+    assert group_email_name('Team/Sub Group/Ops_1') == 'team.sub-group.ops1'
+
+    index = GroupEmailIndex([
+        SimpleNamespace(id=1, full_path='team'),
+        SimpleNamespace(id=2, full_path='team/Sub Group'),
+        # same email as group 2, the first one wins
+        SimpleNamespace(id=3, full_path='team/sub-group!'),
+    ], 'test.test')
+
+    assert len(index) == 2
+    entry = index.get_by_email('team.sub-group@test.test')
+    assert entry['id'] == 2
+    assert entry['name'] == 'team.sub-group'
+    assert index.get_by_name('team.sub-group') is entry
+    assert index.by_id[2] is entry
+    assert index.get_by_name('team.sub-group@test.test') is None
+
+
+def test_membership_bitsets():
+    hierarchy = GroupHierarchy([make_group(1), make_group(2, 1), make_group(3, 1)])
+    api = FakeMembersApi({1: [make_member(1)], 2: [make_member(2), make_member(4)], 3: [make_member(3)]})
+    membership = GroupMembership(api.list, lambda: hierarchy)
+    users = UserDirectory([
+        make_user(1, 'a@test.test'), make_user(2, 'b@test.test'),
+        make_user(3, 'c@test.test'), make_user(4, 'd@test.test', state='blocked'),
+    ])
+    bitsets = MembershipBitsets(membership, users)
+
+    top = bitsets.emails(bitsets.members(1))
+    assert isinstance(top, EmailSet)
+    assert top == {'a@test.test', 'b@test.test', 'c@test.test'}
+    assert len(top) == 3
+    assert 'b@test.test' in top and 'd@test.test' not in top
+    assert set(bitsets.emails(bitsets.members(1, recursive=False))) == {'a@test.test'}
+
+    # Differences with plain sets stay bitsets, and ignore unknown emails
+    sent = top - {'a@test.test', 'other@example.com'}
+    assert isinstance(sent, EmailSet)
+    assert sorted(sent) == ['b@test.test', 'c@test.test']
+    assert isinstance(sent | bitsets.emails(bitsets.members(3)), EmailSet)
+    # Unions with emails outside the directory are plain sets
+    assert sent | {'other@example.com'} == {'b@test.test', 'c@test.test', 'other@example.com'}
+    assert {'a@test.test', 'x@test.test'} - top == {'x@test.test'}
+    assert bitsets.emails(users.active_bits) == top
@@ -0,0 +1,153 @@
+import threading
+import time
+from types import SimpleNamespace
+import shared.constants as constants
+import shared.gitlab_helpers as gitlab_helpers
+from shared.datacache import GenerationCache, StaleWhileRevalidateDataCache
+from shared.gitlab_directory import GroupHierarchy, GroupMembership
+
+
+def make_group(group_id, parent_id=None):
+    return SimpleNamespace(id=group_id, parent_id=parent_id)
+
+
+def test_cold_start_fetches_members_on_demand_until_crawled(monkeypatch):
+    crawl_started = threading.Event()
+    release = threading.Event()
+
+    def list_members(group_id):
+        if threading.current_thread().name.startswith('gitlab-members'):
+            # the crawl takes its time
+            crawl_started.set()
+            release.wait(5)
+        return [SimpleNamespace(id=group_id, access_level=30)]
+
+    groups = StaleWhileRevalidateDataCache(lambda: GroupHierarchy([make_group(1), make_group(2)]), 600, 1200)
+    membership_cache = StaleWhileRevalidateDataCache(gitlab_helpers.buildGitlabGroupMembership, 600, 1200,
+                                                     max_wait_seconds=1)
+    monkeypatch.setattr(gitlab_helpers, 'groupDataCache', groups)
+    monkeypatch.setattr(gitlab_helpers, 'groupMembershipCache', membership_cache)
+    monkeypatch.setattr(gitlab_helpers, 'listGitlabGroupMembers', list_members)
+    monkeypatch.setattr(constants, 'GITLAB_MEMBERSHIP_CRAWL', True)
+    monkeypatch.setattr(constants, 'GITLAB_SNAPSHOT_PATH', '')
+
+    membership = membership_cache.get_data()
+    assert crawl_started.wait(5)
+    assert not membership.complete
+    assert membership.direct_members(1) == {1: 30}
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while not membership_cache.cached_data.complete and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert membership_cache.cached_data.complete
+    assert membership_cache.cached_data.direct == {1: {1: 30}, 2: {2: 30}}
+
+
+def test_groups_to_recipients_cache(monkeypatch):
+    generation = [1]
+    calls = []
+
+    def expand(mail_to, as_groups=False, sender=None):
+        calls.append(list(mail_to))
+        return {'groups': [mail_to[0]], 'group_emails': {mail_to[0]}, 'send_to': frozenset(),
+                'valid': set(), 'invalid_access_groups': set()}
+
+    monkeypatch.setattr(gitlab_helpers, '_groups_to_recipients', expand)
+    monkeypatch.setattr(gitlab_helpers, 'RECIPIENTS_CACHE_SIZE', 2)
+    monkeypatch.setattr(gitlab_helpers, 'recipientsCache',
+                        GenerationCache(gitlab_helpers.buildRecipientsLookup, lambda: generation[0]))
+
+    first = gitlab_helpers.groups_to_recipients(['a@example.com'])
+    assert gitlab_helpers.groups_to_recipients(['a@example.com']) == first
+    assert len(calls) == 1
+    # the cached values can't be changed by callers
+    assert first['groups'] == ('a@example.com',)
+    assert isinstance(first['invalid_access_groups'], frozenset)
+
+    # the least recently used entry is evicted once the cache is full
+    gitlab_helpers.groups_to_recipients(['b@example.com'])
+    gitlab_helpers.groups_to_recipients(['c@example.com'])
+    gitlab_helpers.groups_to_recipients(['c@example.com'])
+    assert len(calls) == 3
+    gitlab_helpers.groups_to_recipients(['a@example.com'])
+    assert len(calls) == 4
+
+    # a new cache generation (refresh or member hook) invalidates everything
+    generation[0] = 2
+    gitlab_helpers.groups_to_recipients(['a@example.com'])
+    assert len(calls) == 5
+
+
+def test_flush_caches_refreshes_what_the_event_changes(monkeypatch):
+    caches = {name: StaleWhileRevalidateDataCache(lambda name=name: name, 600, 1200)
+              for name in ('userDataCache', 'groupDataCache', 'groupMembershipCache')}
+    for name, cache in caches.items():
+        cache.prime('cached')
+        monkeypatch.setattr(gitlab_helpers, name, cache)
+
+    def refreshed():
+        for cache in caches.values():
+            cache.revalidated.wait(5)
+        expired = {name for name, cache in caches.items() if cache.is_expired()}
+        for cache in caches.values():
+            cache.prime('cached')
+        return expired
+
+    gitlab_helpers.flush_caches('project_create')
+    assert refreshed() == set()
+    gitlab_helpers.flush_caches('group_rename')
+    assert refreshed() == {'groupDataCache'}
+    gitlab_helpers.flush_caches('user_create')
+    assert refreshed() == {'userDataCache'}
+
+    # the membership is refreshed in the background, and used in the meantime
+    gitlab_helpers.flush_caches('user_add_to_group')
+    assert caches['groupMembershipCache'].get_data() in ('cached', 'groupMembershipCache')
+    assert refreshed() == {'userDataCache'}
+    assert caches['groupMembershipCache'].refreshes == 1
+
+    gitlab_helpers.flush_caches()
+    assert refreshed() == {'userDataCache', 'groupDataCache'}
+    assert caches['groupMembershipCache'].refreshes == 2
+
+    # a member hook that can't be applied
+    gitlab_helpers.flush_caches('user_access_request_to_group', membership=True)
+    assert refreshed() == set()
+    assert caches['groupMembershipCache'].refreshes == 3
+
+
+def test_member_hooks_during_crawl_reach_the_new_membership(monkeypatch):
+    def hook(event_name, group_id, user_id):
+        assert gitlab_helpers.apply_member_event({'event_name': event_name, 'group_id': group_id,
+                                                  'user_id': user_id, 'group_access': 'Developer'})
+
+    def list_members(group_id):
+        if group_id == 1:
+            # arrives after group 2 was fetched without it
+            hook('user_add_to_group', 2, 8)
+        return [SimpleNamespace(id=group_id, access_level=30)]
+
+    groups = StaleWhileRevalidateDataCache(lambda: GroupHierarchy([make_group(1), make_group(2)]), 600, 1200)
+    groups.prime(groups.fetch_function())
+    users = StaleWhileRevalidateDataCache(lambda: {}, 600, 1200)
+    users.prime({7: 'user7', 8: 'user8', 9: 'user9'})
+    membership_cache = StaleWhileRevalidateDataCache(gitlab_helpers.buildGitlabGroupMembership, 600, 1200)
+    membership_cache.prime(GroupMembership(list_members, groups.get_data, {1: {1: 30}, 2: {2: 30}}))
+    monkeypatch.setattr(gitlab_helpers, 'groupDataCache', groups)
+    monkeypatch.setattr(gitlab_helpers, 'userDataCache', users)
+    monkeypatch.setattr(gitlab_helpers, 'groupMembershipCache', membership_cache)
+    monkeypatch.setattr(gitlab_helpers, 'listGitlabGroupMembers', list_members)
+    monkeypatch.setattr(gitlab_helpers, '_incoming_membership', None)
+    monkeypatch.setattr(constants, 'GITLAB_MAX_CONCURRENCY', 1)
+    monkeypatch.setattr(constants, 'GITLAB_SNAPSHOT_PATH', '')
+
+    # before the crawl
+    hook('user_add_to_group', 1, 7)
+    crawled = gitlab_helpers._crawl_membership()
+    # after the crawl, but before the cache swaps the crawled membership in
+    hook('user_remove_from_group', 1, 7)
+    hook('user_add_to_group', 1, 9)
+
+    assert membership_cache.cached_data is not crawled
+    assert crawled.direct == {1: {1: 30, 9: 30}, 2: {2: 30, 8: 30}}
@@ -0,0 +1,24 @@
+import sys
+from types import SimpleNamespace
+import pytest
+from shared.gitlab_records import UserRecord, GroupRecord
+
+
+def test_records():
+    user = UserRecord.from_object(SimpleNamespace(id=1, username='a', name='A', email='a@test.test',
+                                                  state=''.join(['act', 'ive']), is_admin=False,
+                                                  avatar_url='not kept'))
+    assert user.email == 'a@test.test'
+    assert not hasattr(user, 'avatar_url')
+    assert not hasattr(user, '__dict__')
+    # interned, so every active user shares one string
+    assert user.state is sys.intern('active')
+    assert UserRecord.from_attributes(user.attributes) == user
+
+    with pytest.raises(AttributeError):
+        user.email = 'b@test.test'
+
+    group = GroupRecord.from_attributes({'id': 10, 'full_path': 'a/b', 'parent_id': 9})
+    assert group.parent_id == 9
+    assert group.web_url is None
+    assert group.attributes['full_path'] == 'a/b'
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+# import pytest
+import shared.gitlab_snapshot as gitlab_snapshot
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'gitlab_snapshot.json')
+    assert gitlab_snapshot.load(path) is None
+
+    users = [SimpleNamespace(id=1, username='a', email='a@test.test', state='active', is_admin=True,
+                             avatar_url='not saved')]
+    groups = [SimpleNamespace(id=10, name='A', full_name='A', full_path='a', parent_id=None, web_url='')]
+    gitlab_snapshot.save(path,
+                         gitlab_snapshot.to_records(users, gitlab_snapshot.USER_FIELDS),
+                         gitlab_snapshot.to_records(groups, gitlab_snapshot.GROUP_FIELDS),
+                         {10: {1: 50}})
+
+    snapshot = gitlab_snapshot.load(path)
+    assert snapshot['users'] == [{'id': 1, 'username': 'a', 'name': None, 'email': 'a@test.test',
+                                  'state': 'active', 'is_admin': True}]
+    assert snapshot['groups'][0]['full_path'] == 'a'
+    assert snapshot['members'] == {10: {1: 50}}
+
+    # Snapshots from another version are ignored
+    with open(path, 'w') as f:
+        f.write('{"version": 0}')
+    assert gitlab_snapshot.load(path) is None
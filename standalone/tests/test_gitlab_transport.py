@@ -0,0 +1,57 @@
+import requests
+from requests.structures import CaseInsensitiveDict
+from shared.gitlab_transport import GitlabTransportAdapter
+
+
+class FakeRaw:
+    '''
+    Stands in for the urllib3 response under a requests.Response, recording whether
+    its connection went back to the pool
+    '''
+    def __init__(self, body=b''):
+        self.body = body
+        self.closed = False
+        self.released = False
+
+    def stream(self, chunk_size, decode_content=True):
+        if self.body:
+            yield self.body
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        self.released = True
+
+
+def test_not_modified_answers_from_cache_and_releases_connection(monkeypatch):
+    raws = []
+
+    def send(adapter, request, **kwargs):
+        response = requests.Response()
+        if 'If-None-Match' in request.headers:
+            assert request.headers['If-None-Match'] == '"v1"'
+            response.status_code = 304
+            response.headers = CaseInsensitiveDict({'ETag': '"v1"'})
+            response.raw = FakeRaw()
+        else:
+            response.status_code = 200
+            response.headers = CaseInsensitiveDict({'ETag': '"v1"', 'Content-Type': 'application/json'})
+            response.raw = FakeRaw(b'[{"id": 1}]')
+        response.url = request.url
+        response.request = request
+        raws.append(response.raw)
+        return response
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+    adapter = GitlabTransportAdapter()
+    session = requests.Session()
+    session.mount('https://', adapter)
+
+    assert session.get('https://gitlab.example.com/api/v4/groups').json() == [{'id': 1}]
+    response = session.get('https://gitlab.example.com/api/v4/groups')
+    assert (response.status_code, response.json()) == (200, [{'id': 1}])
+    assert response.headers['Content-Type'] == 'application/json'
+    # the 304 was read and its connection released, not left checked out
+    assert raws[1].released
+    assert adapter.stats()['endpoints']['GET /groups']['not_modified'] == 1
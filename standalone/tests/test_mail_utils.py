@@ -0,0 +1,50 @@
+import smtplib
+import shared.constants as constants
+import shared.mail_utils as mail_utils
+
+
+class FakePool:
+    '''
+    Stands in for SMTPRelays, refusing the first recipient of each chunk
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.chunks.append(list(to_addrs))
+        if 'bad0@example.net' in to_addrs:
+            raise smtplib.SMTPDataError(554, b'rejected')
+        return {to_addrs[0]: (550, b'no such user')}
+
+
+def test_send_smtp_sends_in_chunks(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(mail_utils, 'get_smtp_pool', lambda: pool)
+    monkeypatch.setattr(constants, 'DEBUG_MODE', False)
+    monkeypatch.setattr(constants, 'TEST_MODE', False)
+    monkeypatch.setattr(constants, 'DOMAIN', 'example.com')
+    receiver = [f'user{i}@example.net' for i in range(4 * mail_utils.CHUNK_SIZE)] + ['bad0@example.net']
+    msg = 'From: sender@example.com\nSubject: Test\n\nbody\n'
+
+    sent = mail_utils.send_smtp('sender@example.com', receiver, msg)
+    assert pool.chunks == mail_utils.chunk_recipients(receiver)
+    # the first recipient of each chunk is refused, and the last chunk failed
+    assert len(sent) == 4 * (mail_utils.CHUNK_SIZE - 1)
+    assert 'user0@example.net' not in sent and 'user1@example.net' in sent
+
+
+def test_delivery_plan_renders_message_once(monkeypatch):
+    monkeypatch.setattr(constants, 'DEBUG_MODE', False)
+    monkeypatch.setattr(constants, 'TEST_MODE', False)
+    monkeypatch.setattr(constants, 'DOMAIN', 'example.com')
+    message = mail_utils.message_from_string('From: sender@example.com\nSubject: Test\n' +
+                                             'Content-Type: text/plain; charset="utf-8"\n\nbody\n')
+    receiver = [f'user{i}@example.net' for i in range(2 * mail_utils.CHUNK_SIZE)]
+
+    chunks, prepared = mail_utils.delivery_plan('sender@example.com', receiver, message)
+    assert len(chunks) == 2
+    # the caller's message is used, not a copy parsed from a string
+    assert prepared.message is message
+    rendered = prepared.as_bytes()
+    assert b'body' in rendered and b'Distribution Lists' in rendered
+    assert prepared.as_bytes() is rendered
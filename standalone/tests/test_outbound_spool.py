@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import shared.constants as constants
+from database import TLDatabase
+from shared.mail_utils import ChunkResult
+from shared.outbound_spool import OutboundSpool
+
+MESSAGE = 'From: sender@example.com\nSubject: Invite\n\nbody\n'
+
+
+async def open_database(tmp_path, meeting_uuids):
+    db = TLDatabase()
+    db.db_path = str(tmp_path / 'timelord.db')
+    await db.initialize()
+    for uuid in meeting_uuids:
+        await db.meetings_insert_record({'uuid': uuid, 'meeting_title': uuid, 'email_from': 'sender@example.com',
+                                         'email': b'', 'recurr': False, 'end_date': None, 'groups': ['group'],
+                                         'ics_file_data': ''})
+    return db
+
+
+def use_relay(monkeypatch):
+    monkeypatch.setattr(constants, 'DEBUG_MODE', False)
+    monkeypatch.setattr(constants, 'TEST_MODE', False)
+    monkeypatch.setattr(constants, 'DOMAIN', 'example.com')
+
+
+def test_spool_retries_and_records_delivered_invites(tmp_path, monkeypatch):
+    use_relay(monkeypatch)
+    now = [1000.0]
+    calls = []
+
+    def send_chunks(chunks):
+        [(recipients, msg)] = chunks
+        calls.append(list(recipients))
+        if len(calls) == 1:
+            # the relay throttles the first chunk
+            return [ChunkResult(recipients=recipients, refused={}, error='451 slow down', code=451)]
+        return [ChunkResult(recipients=recipients, refused={'bad@example.net': (550, b'no such user')},
+                            error=None, code=None)]
+
+    async def main():
+        db = await open_database(tmp_path, ['meeting-1'])
+        spool = OutboundSpool(db, parallelism=1, retry_seconds=30, send_chunks=send_chunks, clock=lambda: now[0])
+        await spool.start()
+        try:
+            receiver = [f'user{i}@example.net' for i in range(50)] + ['bad@example.net']
+            message_id = await spool.enqueue('sender@example.com', receiver, MESSAGE, meeting_uuid='meeting-1')
+            # the second chunk is delivered, the first waits for its retry
+            delivered = await spool.wait(message_id, timeout=1)
+            assert delivered == set(receiver[45:50])
+            assert (await db.outbound_queued(['meeting-1']))['meeting-1'] == set(receiver[:45])
+            assert set((await db.meetings_invites_get(['meeting-1']))['meeting-1']) == delivered
+
+            now[0] += 60
+            spool.wakeup.set()
+            delivered = await spool.wait(message_id, timeout=5)
+            assert delivered == set(receiver[:50])
+            assert set((await db.meetings_invites_get(['meeting-1']))['meeting-1']) == delivered
+            assert await db.outbound_done(message_id)
+            assert len(calls) == 3
+        finally:
+            await spool.stop()
+            await db.close()
+
+    asyncio.run(main())
+
+
+def test_spool_sends_small_messages_in_one_session(tmp_path, monkeypatch):
+    use_relay(monkeypatch)
+    sessions = []
+
+    def send_chunks(chunks):
+        sessions.append([recipients for recipients, msg in chunks])
+        return [ChunkResult(recipients=recipients, refused={}, error=None, code=None) for recipients, msg in chunks]
+
+    async def main():
+        uuids = [f'meeting-{i}' for i in range(3)]
+        db = await open_database(tmp_path, uuids)
+        spool = OutboundSpool(db, parallelism=1, send_chunks=send_chunks)
+        try:
+            # queued before the workers start, as after a restart
+            message_ids = await spool.enqueue_many([('sender@example.com', 'new@example.net', MESSAGE, uuid)
+                                                    for uuid in uuids])
+            await spool.start()
+            for message_id in message_ids:
+                assert await spool.wait(message_id, timeout=5) == {'new@example.net'}
+            backlog = (await spool.stats())['backlog']
+            assert (backlog['sent'], backlog['pending'], backlog['due']) == (3, 0, 0)
+            return await db.meetings_invites_get(uuids)
+        finally:
+            await spool.stop()
+            await db.close()
+
+    invites = asyncio.run(main())
+    assert sessions == [[['new@example.net']] * 3]
+    assert all(emails == ['new@example.net'] for emails in invites.values())
+
+
+def test_spool_drops_copies_of_changed_meeting(tmp_path, monkeypatch):
+    use_relay(monkeypatch)
+    sending = threading.Event()
+    release = threading.Event()
+
+    def send_chunks(chunks):
+        sending.set()
+        release.wait(5)
+        return [ChunkResult(recipients=recipients, refused={}, error=None, code=None) for recipients, msg in chunks]
+
+    async def main():
+        db = await open_database(tmp_path, ['meeting-1'])
+        spool = OutboundSpool(db, parallelism=1, send_chunks=send_chunks)
+        await spool.start()
+        try:
+            # one copy of the invite is being sent and another is waiting when the meeting is updated
+            in_flight = await spool.enqueue('sender@example.com', 'old@example.net', MESSAGE, meeting_uuid='meeting-1')
+            await asyncio.get_running_loop().run_in_executor(None, sending.wait, 5)
+            waiting = await spool.enqueue('sender@example.com', 'waiting@example.net', MESSAGE,
+                                          meeting_uuid='meeting-1')
+            await db.meetings_invites_delete('meeting-1')
+            assert (await db.outbound_queued(['meeting-1']))['meeting-1'] == set()
+            assert await db.outbound_done(waiting)
+
+            # the old copy is delivered, but isn't recorded as the meeting's invite
+            release.set()
+            assert await spool.wait(in_flight, timeout=5) == {'old@example.net'}
+            assert (await db.meetings_invites_get(['meeting-1']))['meeting-1'] == []
+
+            current = await spool.enqueue('sender@example.com', 'old@example.net', MESSAGE, meeting_uuid='meeting-1')
+            assert await spool.wait(current, timeout=5) == {'old@example.net'}
+            assert (await db.meetings_invites_get(['meeting-1']))['meeting-1'] == ['old@example.net']
+            backlog = (await spool.stats())['backlog']
+            assert (backlog['sent'], backlog['superseded'], backlog['pending']) == (2, 1, 0)
+        finally:
+            await spool.stop()
+            await db.close()
+
+    asyncio.run(main())
+
+
+def test_spool_retries_chunks_whose_delivery_raised(tmp_path, monkeypatch):
+    use_relay(monkeypatch)
+    now = [1000.0]
+    calls = []
+
+    def send_chunks(chunks):
+        calls.append(chunks)
+        if len(calls) == 1:
+            raise RuntimeError('executor failed')
+        return [ChunkResult(recipients=recipients, refused={}, error=None, code=None) for recipients, msg in chunks]
+
+    async def main():
+        db = await open_database(tmp_path, ['meeting-1'])
+        spool = OutboundSpool(db, parallelism=1, retry_seconds=30, send_chunks=send_chunks, clock=lambda: now[0])
+        await spool.start()
+        try:
+            message_id = await spool.enqueue('sender@example.com', 'new@example.net', MESSAGE, meeting_uuid='meeting-1')
+            # not left claimed: pending again, due after the backoff
+            assert await spool.wait(message_id, timeout=0.5) == set()
+            backlog = (await spool.stats())['backlog']
+            assert (backlog['sending'], backlog['pending'], backlog['due']) == (0, 1, 0)
+            assert await db.outbound_next_attempt() == 1030.0
+
+            now[0] += 30
+            spool.wakeup.set()
+            assert await spool.wait(message_id, timeout=5) == {'new@example.net'}
+            assert (await db.meetings_invites_get(['meeting-1']))['meeting-1'] == ['new@example.net']
+            assert len(calls) == 2
+        finally:
+            await spool.stop()
+            await db.close()
+
+    asyncio.run(main())
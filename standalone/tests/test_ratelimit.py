@@ -0,0 +1,33 @@
+# import pytest
+from shared.ratelimit import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(10, 5, clock=clock)
+
+    # a burst of up to capacity doesn't wait
+    assert [bucket.reserve() for i in range(5)] == [0.0] * 5
+    # then each token takes 1/rate seconds
+    assert bucket.reserve() == 0.1
+    assert bucket.reserve() == 0.2
+
+    clock.now = 10
+    assert bucket.available() == 5
+    # reservations larger than the capacity are paid back before the next caller goes
+    assert bucket.reserve(15) == 1.0
+    assert bucket.reserve() == 1.1
+
+    unlimited = TokenBucket(0, clock=clock)
+    assert unlimited.reserve(1000) == 0.0
+
+    bucket.set_rate(0)
+    assert bucket.reserve(1000) == 0.0
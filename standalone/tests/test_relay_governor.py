@@ -0,0 +1,51 @@
+from shared.relay_governor import RelayGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_governor_slows_down_when_throttled_and_recovers():
+    clock = FakeClock()
+    governor = RelayGovernor(recipients_per_second=100, messages_per_second=10, recovery=0.25, clock=clock)
+    assert governor.reserve(100) == 0.0
+    assert governor.reserve(50) == 0.5
+
+    clock.now = 10
+    governor.record(45, throttled=True)
+    assert governor.stats()['recipients_per_second'] == 50
+    assert governor.stats()['messages_per_second'] == 5
+    # throttling replies to sessions sent before the rates were lowered don't lower them again
+    governor.record(45, throttled=True)
+    assert governor.stats()['recipients_per_second'] == 50
+
+    clock.now = 20
+    governor.record(45, throttled=True)
+    assert governor.stats()['recipients_per_second'] == 25
+    for i in range(2):
+        governor.record(45)
+    assert governor.stats()['recipients_per_second'] == 75
+    governor.record(45)
+    stats = governor.stats()
+    assert not stats['throttled']
+    assert stats['recipients_per_second'] == 100
+    assert stats['throttles'] == 3
+
+
+def test_unlimited_governor_is_throttled_from_measured_rate():
+    clock = FakeClock()
+    governor = RelayGovernor(clock=clock)
+    for i in range(5):
+        clock.now = i
+        assert governor.reserve(45) == 0.0
+        governor.record(45)
+    governor.record(45, throttled=True)
+    # 270 recipients and 6 messages in 4 seconds, halved
+    stats = governor.stats()
+    assert stats['recipients_per_second'] == 270 / 4 / 2
+    assert stats['messages_per_second'] == 6 / 4 / 2
+    assert governor.reserve(100) > 0
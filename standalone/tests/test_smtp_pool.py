@@ -0,0 +1,111 @@
+import smtplib
+import time
+# import pytest
+from shared.mail_utils import _chunk_result
+from shared.outbound_spool import classify_result
+from shared.smtp_pool import SMTPConnectionPool, SMTPSessionError
+from shared.smtp_relays import Relay, SMTPRelays
+
+
+class FakeSMTP:
+    '''
+    Stands in for smtplib.SMTP_SSL, recording the commands sent
+    '''
+    connections = []
+
+    def __init__(self, host, port, timeout=None):
+        self.commands = []
+        self.connected = True
+        FakeSMTP.connections.append(self)
+
+    def ehlo(self):
+        self.commands.append('EHLO')
+        return 250, b'OK'
+
+    def login(self, user, password):
+        self.commands.append('AUTH')
+
+    def rset(self):
+        if not self.connected:
+            raise smtplib.SMTPServerDisconnected()
+        self.commands.append('RSET')
+        return 250, b'OK'
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if not self.connected:
+            raise smtplib.SMTPServerDisconnected()
+        self.commands.append('MAIL')
+        if 'refused@test.test' in to_addrs:
+            raise smtplib.SMTPRecipientsRefused({'refused@test.test': (550, b'no such user')})
+        return {}
+
+    def close(self):
+        self.connected = False
+
+    def quit(self):
+        self.commands.append('QUIT')
+        self.connected = False
+
+
+def test_smtp_pool():
+    FakeSMTP.connections = []
+    pool = SMTPConnectionPool('relay', 465, 'user', 'password', max_size=2, idle_timeout_seconds=60,
+                              connection_factory=FakeSMTP)
+
+    for i in range(3):
+        pool.sendmail('a@test.test', ['b@test.test'], 'message')
+    # one login, then RSET before each reuse
+    assert len(FakeSMTP.connections) == 1
+    assert FakeSMTP.connections[0].commands == ['EHLO', 'AUTH', 'MAIL', 'RSET', 'MAIL', 'RSET', 'MAIL']
+
+    # the relay dropped the idle connection, so a new one is opened transparently
+    FakeSMTP.connections[0].connected = False
+    pool.sendmail('a@test.test', ['b@test.test'], 'message')
+    assert len(FakeSMTP.connections) == 2
+    assert pool.stats()['reconnects'] == 1
+
+    # idle for too long, so closed rather than reused
+    pool.idle[0].last_used = time.monotonic() - 61
+    pool.sendmail('a@test.test', ['b@test.test'], 'message')
+    assert len(FakeSMTP.connections) == 3
+    assert pool.stats()['transactions'] == 5
+
+    pool.close_all()
+    assert FakeSMTP.connections[2].commands[-1] == 'QUIT'
+
+
+def test_smtp_pool_keeps_connection_after_refusal():
+    FakeSMTP.connections = []
+    pool = SMTPConnectionPool('relay', 465, 'user', 'password', connection_factory=FakeSMTP)
+
+    try:
+        pool.sendmail('a@test.test', ['refused@test.test'], 'message')
+        assert False
+    except smtplib.SMTPRecipientsRefused:
+        pass
+    assert pool.stats()['idle'] == 1
+    pool.sendmail('a@test.test', ['b@test.test'], 'message')
+    assert len(FakeSMTP.connections) == 1
+    assert pool.stats()['reused'] == 1
+
+
+def test_smtp_pool_login_failure_makes_relay_unavailable():
+    class RejectingSMTP(FakeSMTP):
+        def login(self, user, password):
+            raise smtplib.SMTPAuthenticationError(535, b'Authentication Credentials Invalid')
+
+    FakeSMTP.connections = []
+    rejecting = SMTPConnectionPool('bad-relay', 465, 'user', 'old-password', connection_factory=RejectingSMTP)
+    messages = [('a@test.test', [f'user{i}@test.test'], 'message') for i in range(2)]
+    results = rejecting.sendmail_batch(messages)
+    assert all(isinstance(result, SMTPSessionError) for result in results)
+    # retried later, not refused for good
+    delivered, refused, retry = classify_result(_chunk_result(['user0@test.test'], results[0]))
+    assert (delivered, refused, list(retry)) == ([], {}, ['user0@test.test'])
+
+    # the messages go to another relay instead, and the failing relay counts towards opening its circuit
+    good = SMTPConnectionPool('relay', 465, 'user', 'password', connection_factory=FakeSMTP)
+    relays = SMTPRelays([Relay(rejecting, weight=2), Relay(good)])
+    assert relays.sendmail_batch(messages) == [{}, {}]
+    assert relays.relays[0].breaker.stats()['failures'] == 1
+    assert good.stats()['transactions'] == 2
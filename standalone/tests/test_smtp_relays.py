@@ -0,0 +1,77 @@
+import smtplib
+from shared.smtp_relays import Relay, SMTPRelays, SMTPRelaysUnavailable, parse_relays
+
+
+class FakePool:
+    '''
+    Stands in for SMTPConnectionPool, answering each message with the next of outcomes (or accepting it)
+    '''
+    max_size = 2
+
+    def __init__(self, host, outcomes=()):
+        self.host = host
+        self.port = 465
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def sendmail_batch(self, messages):
+        results = []
+        for from_addr, to_addrs, msg in messages:
+            self.sent.append(list(to_addrs))
+            results.append(self.outcomes.pop(0) if self.outcomes else {})
+        return results
+
+    def stats(self):
+        return {}
+
+
+def test_parse_relays():
+    assert parse_relays('a.example.com:465, b.example.com:587:3, c:25:2:8,bad,d:x', 4) == [
+        ('a.example.com', 465, 1.0, 4), ('b.example.com', 587, 3.0, 4), ('c', 25, 2.0, 8)]
+    assert parse_relays('', 4) == []
+
+
+def test_relays_share_sessions_by_weight():
+    a, b = FakePool('a'), FakePool('b')
+    relays = SMTPRelays([Relay(a, weight=3), Relay(b, weight=1)])
+    for i in range(8):
+        relays.sendmail('sender@example.com', [f'user{i}@example.net'], b'msg')
+    assert (len(a.sent), len(b.sent)) == (6, 2)
+
+
+def test_failed_and_throttled_messages_move_to_another_relay():
+    throttled = smtplib.SMTPDataError(454, b'Throttling failure: Maximum sending rate exceeded.')
+    refused = {'x@example.net': (550, b'no such user')}
+    a = FakePool('a', [ConnectionResetError('reset'), throttled, refused])
+    b = FakePool('b')
+    relays = SMTPRelays([Relay(a, weight=2), Relay(b)])
+    results = relays.sendmail_batch([('sender@example.com', [f'user{i}@example.net'], b'msg') for i in range(3)])
+    # only what the first relay didn't send is sent again
+    assert results == [{}, {}, refused]
+    assert b.sent == [['user0@example.net'], ['user1@example.net']]
+    assert relays.relays[0].governor.fraction < 1
+    assert relays.failovers == 1
+
+    # a relay that keeps failing is skipped once its circuit opens
+    for i in range(3):
+        relays.relays[0].breaker.record_failure()
+    assert relays.relays[0].breaker.state == 'open'
+    for i in range(4):
+        assert relays.sendmail('sender@example.com', ['new@example.net'], b'msg') == {}
+    assert b.sent[-4:] == [['new@example.net']] * 4
+
+
+def test_single_relay_retries_once():
+    a = FakePool('a', [smtplib.SMTPServerDisconnected('gone'), smtplib.SMTPServerDisconnected('gone again')])
+    relays = SMTPRelays([Relay(a)])
+    try:
+        relays.sendmail('sender@example.com', ['user@example.net'], b'msg')
+        assert False
+    except smtplib.SMTPServerDisconnected:
+        pass
+    assert len(a.sent) == 2
+
+    # the two failures above, and one more opens the circuit
+    relays.relays[0].breaker.record_failure()
+    assert isinstance(relays.sendmail_batch([('sender@example.com', ['user@example.net'], b'msg')])[0],
+                      SMTPRelaysUnavailable)
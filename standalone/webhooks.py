@@ -4,6 +4,7 @@ import asyncio
 import json
 import shared.gitlab_helpers as gitlab_helpers
 import shared.mail_utils as mail_utils
+from shared.outbound_spool import mime_email_send, outbound_spool
 
 async def handle_gitlab_test(request: web.Request):
     logging.info(request)
@@ -18,9 +19,15 @@ async def handle_refresh_wiki(request: web.Request):
     Refreshes calendars and meeting info on the Gitlab Wiki
     '''
     logging.info(request)
+    payload = None
+    try:
+        # When called as a system hook, a membership change can be applied to the cache
+        payload = await request.json()
+    except Exception:
+        pass
     # await request.app['actionQueue'].put((10, {'action':'test'}))
     request.app['mainEventLoop'].call_soon_threadsafe(request.app['actionQueue'].put_nowait,
-                                                      (10, {'action': 'refresh_wiki'}))
+                                                      (10, {'action': 'refresh_wiki', 'payload': payload}))
     return web.Response(text='Request received')
 
 
@@ -34,6 +41,13 @@ async def handle_gitlab_flush(request: web.Request):
                                                       (0, {'action': 'flush_gitlab_cache'}))
     return web.Response(text='Request received')
 
+
+async def handle_gitlab_stats(request: web.Request):
+    '''
+    Returns Gitlab API call counts and latency per endpoint, and cache statistics
+    '''
+    return web.json_response(gitlab_helpers.stats())
+
 '''
             uuid TEXT PRIMARY KEY,
             meeting_title TEXT,
@@ -44,6 +58,20 @@ async def handle_gitlab_flush(request: web.Request):
             groups TEXT,
             ics_file_data TEXT'''
 
+
+async def handle_smtp_stats(request: web.Request):
+    '''
+    Returns the state of each relay (send rates, circuit, connection pool) and the outbound spool backlog
+    '''
+    # the spool's database connection belongs to the main event loop
+    spool = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(outbound_spool.stats(),
+                                                                       request.app['mainEventLoop']))
+    return web.json_response({
+        'relays': mail_utils.get_smtp_pool().stats(),
+        'spool': spool,
+    })
+
+
 async def handle_force_resend_email(request: web.Request):
     try:
         # Extract JSON payload from the request
@@ -98,6 +126,11 @@ async def handle_refresh_email(request: web.Request):
         # Extract JSON payload from the request
         payload = await request.json()
         logging.info(payload)
+        if payload.get('event_name') in gitlab_helpers.GITLAB_MEMBER_EVENTS:
+            # Called as a system hook, so bring the membership cache up to date first
+            request.app['mainEventLoop'].call_soon_threadsafe(request.app['actionQueue'].put_nowait,
+                                                              (0, {'action': 'apply_gitlab_member_event',
+                                                                   'payload': payload}))
     except Exception:
         pass
 
@@ -120,6 +153,9 @@ http://localhost:8080/get-admins
         to_addr=payload['to']
         print(f'from_addr={from_addr}\nto_addr={to_addr}')
         groups = gitlab_helpers.groups_to_recipients(mail_to=to_addr, sender=from_addr)
+        # who may send to each of the requested groups, from the same index used to authorize senders
+        groups['authorized_senders'] = gitlab_helpers.get_authorized_senders(
+            groups['group_emails'] | groups['invalid_access_groups'])
         #return web.json_response(groups, default=list)
         json_str =json.dumps(groups, default=list)
         return web.Response(text=json_str, content_type='application/json')
@@ -181,7 +217,9 @@ http://localhost:8080/send_message
         if len(all_receive) == 0:
             logging.warn('No one to send to')
         print(f'{subject} :: from_addr={from_addr}\nto_addr={all_receive}')
-        mail_utils.mime_email_send(**payload)
+        # spooled from the main event loop, which the spool's database connection belongs to
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(mime_email_send(**payload),
+                                                                   request.app['mainEventLoop']))
         json_str =json.dumps(all_receive, default=list)
         return web.Response(text=json_str, content_type='application/json')
     except Exception as e:
@@ -200,24 +238,28 @@ async def handle_gitlab_member_hook(request: web.Request):
     # Extract JSON payload from the request
     payload = await request.json()
 
-    # flush gitlab caches, high-priority
-    # await request.app['actionQueue'].put((0, {'action':'flush_gitlab_cache'}))
+    event_name = payload['event_name']
+    if event_name not in gitlab_helpers.GITLAB_MEMBER_EVENTS:
+        logging.error(f'Unhandled gitlab-member-hook: {event_name}')
+        # it can't be applied, so the group membership is crawled again instead, high-priority
+        request.app['mainEventLoop'].call_soon_threadsafe(request.app['actionQueue'].put_nowait,
+                                                          (0, {'action': 'flush_gitlab_cache',
+                                                               'event_name': event_name, 'membership': True}))
+        # raise web.HTTPClientError()
+        return web.Response()
+
+    # apply the membership change to the gitlab caches, high-priority
+    # (this falls back to flushing the caches if it can't be applied)
     request.app['mainEventLoop'].call_soon_threadsafe(request.app['actionQueue'].put_nowait,
-                                                      (0, {'action': 'flush_gitlab_cache'}))
+                                                      (0, {'action': 'apply_gitlab_member_event',
+                                                           'payload': payload}))
 
-    event_name = payload['event_name']
-    if event_name == 'user_update_for_group':
+    if event_name in ('user_add_to_group', 'user_update_for_group'):
         # user was added to a group. Refresh all group invites.
         # refresh_emails.refresh_invite_emails()
         request.app['mainEventLoop'].call_soon_threadsafe(request.app['actionQueue'].put_nowait,
                                                           (0, {'action': 'refresh_invites'}))
-
-    elif event_name == 'user_remove_from_group':
-        # user was removed from a group. Remove from tables
-        pass
-    else:
-        logging.error(f'Unhandled gitlab-member-hook: {event_name}')
-        # raise web.HTTPClientError()
+    # else user was removed from a group, nothing more to do
 
     return web.Response()
 
@@ -259,6 +301,8 @@ def run(actionQueue: asyncio.PriorityQueue, mainEventLoop, interface='0.0.0.0',
 
         app.router.add_get('/test', handle_gitlab_test)
         app.router.add_get('/flush', handle_gitlab_flush)
+        app.router.add_get('/gitlab-stats', handle_gitlab_stats)
+        app.router.add_get('/smtp-stats', handle_smtp_stats)
 
         app.router.add_post('/get-admins', handle_get_admins)
         app.router.add_post('/send-message', handle_send_message)